@@ -1,14 +1,19 @@
 #-*-coding:utf-8-*-
+import threading
+
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.authentication import SessionAuthenticationPolicy
-from sqlalchemy import engine_from_config
-
 from autonomie.utils.session import get_session_factory
 from autonomie_base.models.initialize import initialize_sql
 
+from autonomie_oidc_provider.engines import get_engine
 from autonomie_oidc_provider.security import RootFactory
 
+_THREADS_STARTED = threading.Event()
+_THREADS_LOCK = threading.Lock()
+
 
 def base_configure(global_config, **settings):
     session_factory = get_session_factory(settings)
@@ -27,6 +32,20 @@ def base_configure(global_config, **settings):
         'autonomie:static/'
     )
     config.include('.models')
+    config.include('.database')
+    config.include('.cache')
+    config.include('.pool')
+    config.include('.hashers')
+    config.include('.registry')
+    config.include('.token_store')
+    config.include('.revocation')
+    config.include('.access_tokens')
+    config.include('.codes')
+    config.include('.keys')
+    config.include('.backchannel')
+    config.include('.janitor')
+    config.include('.write_behind')
+    config.include('.group_commit')
     config.include('.routes')
     config.include('.subscribers')
     config.include('.layout')
@@ -34,18 +53,43 @@ def base_configure(global_config, **settings):
     config.include('.views.authorize')
     config.include('.views.token')
     config.include('.views.userinfo')
+    config.include('.views.introspect')
+    config.include('.views.revoke')
+    config.include('.views.jwks')
     config.include('.views.logout')
 
     config.include('.views.index')
     return config
 
 
+def start_background_threads(event):
+    """
+    Start the janitor and the backchannel logout retry threads on the first
+    request (scripts bootstrapping the application, like oidc-manage, don't
+    serve requests and don't run them)
+    """
+    if _THREADS_STARTED.is_set():
+        return
+    from autonomie_oidc_provider.janitor import JANITOR
+    from autonomie_oidc_provider.backchannel import BACKCHANNEL_LOGOUT
+    with _THREADS_LOCK:
+        if not _THREADS_STARTED.is_set():
+            JANITOR.start()
+            BACKCHANNEL_LOGOUT.start()
+            _THREADS_STARTED.set()
+
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
+    from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+    from autonomie_oidc_provider.scope_consumer import compile_plans
     config = base_configure(global_config, **settings)
-    engine = engine_from_config(settings, "sqlalchemy.")
+    engine = get_engine(settings, "sqlalchemy.")
     initialize_sql(engine)
+    CLIENT_REGISTRY.warm()
+    compile_plans()
+    config.add_subscriber(start_background_threads, NewRequest)
     return config.make_wsgi_app()
 
 
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Access token formats
+
+opaque (default)
+
+    The access token is the random value stored in OidcToken.access_token,
+    validating it requires a database lookup
+
+jwt
+
+    The access token is a JWS signed with the provider's key (see
+    oidc.access_token.key) carrying the following claims :
+
+        sub, client_id, scope, exp, iat, jti (the value stored in
+        OidcToken.access_token)
+
+    Tokens are validated through their signature and their expiry, the only
+    shared state consulted is the RevocationSet : the jti of the revoked and
+    not yet expired tokens, reloaded periodically
+"""
+import time
+import logging
+import binascii
+import datetime
+import threading
+
+from jwkest import JWKESTException
+from jwkest.jwk import SYMKey
+from jwkest.jws import JWS
+from jwkest.jwt import JWT
+from sqlalchemy import event
+from sqlalchemy.orm import (
+    object_session,
+    Session,
+)
+
+from autonomie_oidc_provider.exceptions import InvalidToken
+from autonomie_oidc_provider.generators import normalize_token
+from autonomie_oidc_provider.models import OidcToken
+from autonomie_oidc_provider.token_store import (
+    add_revocation_listener,
+    get_token_store,
+)
+from autonomie_oidc_provider.util import (
+    dt_to_timestamp,
+    oidc_settings,
+)
+
+
+logger = logging.getLogger(__name__)
+
+ALG = 'HS256'
+FORMATS = ('opaque', 'jwt')
+SESSION_INFO_KEY = 'oidc_revocation_set_dirty'
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return bytes(value)
+
+
+class AccessTokenFormat(object):
+    """
+    Build and validate the access tokens sent to the clients
+    """
+    def __init__(self, format_='opaque', key=b'', issuer=None):
+        self.format = format_
+        self.key = _to_bytes(key)
+        self.issuer = issuer
+
+    def configure(self, format_=None, key=None, issuer=None):
+        if format_ is not None:
+            if format_ not in FORMATS:
+                raise KeyError(u"Unknown access token format %s" % format_)
+            self.format = format_
+        if key is not None:
+            self.key = _to_bytes(key)
+        if self.format == 'jwt' and not self.key:
+            raise KeyError(
+                u"The jwt access token format needs an oidc.access_token.key"
+            )
+        self.issuer = issuer
+
+    def is_jwt(self):
+        return self.format == 'jwt'
+
+    @staticmethod
+    def looks_like_jwt(token_str):
+        """
+        Check if the given bearer token is a JWS compact serialization (opaque
+        tokens are base64url or hexadecimal strings)
+        """
+        return token_str.count('.') == 2
+
+    def _get_key_object(self):
+        return SYMKey(key=self.key, alg=ALG)
+
+    def get_claims(self, token, client, scopes):
+        """
+        Build the claims of the access token
+
+        :param obj token: The OidcToken instance
+        :param obj client: The OidcClient or registry.ClientEntry instance
+        :param list scopes: The scopes granted to the token
+        :rtype: dict
+        """
+        claims = {
+            'sub': token.user_id,
+            'client_id': client.client_id,
+            'scope': u' '.join(scopes),
+            'exp': dt_to_timestamp(token.get_expiry()),
+            'iat': dt_to_timestamp(token.creation_date),
+            'jti': token.access_token,
+        }
+        if self.issuer:
+            claims['iss'] = self.issuer
+        return claims
+
+    def serialize(self, token, client, scopes):
+        """
+        Return the access token to send to the client
+
+        :param obj token: The OidcToken instance (flushed)
+        :param obj client: The OidcClient or registry.ClientEntry instance
+        :param list scopes: The scopes granted to the token
+        :rtype: str
+        """
+        if not self.is_jwt():
+            return token.access_token
+        _jws = JWS(self.get_claims(token, client, scopes), alg=ALG)
+        return _jws.sign_compact([self._get_key_object()])
+
+    def decode(self, token_str, now=None):
+        """
+        Validate a jwt access token and return its claims
+
+        :param str token_str: The bearer token
+        :rtype: dict
+        :raises: InvalidToken
+        """
+        if not self.key:
+            # Never issued by this provider
+            raise InvalidToken(error_description=u"Invalid token")
+        try:
+            header = JWT().unpack(token_str).headers
+            if header.get('alg') != ALG:
+                raise InvalidToken(error_description=u"Invalid token")
+            claims = JWS().verify_compact(
+                token_str, keys=[self._get_key_object()]
+            )
+        except (
+            JWKESTException, binascii.Error, ValueError, TypeError, KeyError
+        ):
+            logger.exception(u"Invalid jwt access token")
+            raise InvalidToken(error_description=u"Invalid token")
+
+        if now is None:
+            now = time.time()
+        if claims.get('exp', 0) < now:
+            raise InvalidToken(error_description=u"Expired token")
+        if self.issuer and claims.get('iss') != self.issuer:
+            raise InvalidToken(error_description=u"Invalid token issuer")
+        return claims
+
+
+class RevocationSet(object):
+    """
+    Process local set of the revoked access tokens' jti
+
+    Only the tokens that could still be valid are loaded. The set is reloaded
+    every refresh_interval seconds and when a token is revoked in this
+    process.
+    """
+    def __init__(self, refresh_interval=30):
+        self.refresh_interval = refresh_interval
+        self._jtis = frozenset()
+        self._generation = 0
+        self._loaded_generation = None
+        self._loaded_at = 0
+        self._load_lock = threading.Lock()
+
+    def configure(self, refresh_interval=None):
+        if refresh_interval is not None:
+            self.refresh_interval = int(refresh_interval)
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Mark the set as stale, it will be reloaded on next access
+        """
+        self._generation += 1
+
+    def _is_stale(self):
+        if self._loaded_generation != self._generation:
+            return True
+        return time.time() - self._loaded_at > self.refresh_interval
+
+    def load(self):
+        generation = self._generation
+        now = datetime.datetime.utcnow()
+        self._jtis = frozenset(get_token_store().revoked_access_tokens(now))
+        self._loaded_generation = generation
+        self._loaded_at = time.time()
+        logger.debug(u"%s revoked access tokens loaded", len(self._jtis))
+
+    def _ensure_loaded(self):
+        if self._is_stale():
+            with self._load_lock:
+                if self._is_stale():
+                    self.load()
+
+    def is_revoked(self, jti):
+        """
+        Check if the access token with the given jti has been revoked
+
+        :rtype: bool
+        """
+        self._ensure_loaded()
+        # Legacy hexadecimal tokens are stored (and loaded) in base64url
+        return (normalize_token(jti) or jti) in self._jtis
+
+
+ACCESS_TOKENS = AccessTokenFormat()
+REVOCATION_SET = RevocationSet()
+
+
+def on_token_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and target.revoked:
+        session.info[SESSION_INFO_KEY] = True
+
+
+def on_bulk_update(update_context):
+    # Bulk updates of the token table revoke tokens or rotate refresh tokens,
+    # both may revoke an access token
+    if update_context.mapper.class_ is OidcToken:
+        update_context.session.info[SESSION_INFO_KEY] = True
+
+
+def on_transaction_end(session, *args):
+    if session.info.pop(SESSION_INFO_KEY, False):
+        REVOCATION_SET.invalidate()
+
+
+# Revocations made by a token store out of the SQLAlchemy session
+add_revocation_listener(REVOCATION_SET.invalidate)
+event.listen(OidcToken, 'after_update', on_token_change)
+event.listen(Session, 'after_bulk_update', on_bulk_update)
+event.listen(Session, 'after_commit', on_transaction_end)
+event.listen(Session, 'after_rollback', on_transaction_end)
+
+
+def includeme(config):
+    """
+    Configure the access token format regarding the current settings
+
+        oidc.access_token.format
+
+            opaque (default) or jwt
+
+        oidc.access_token.key
+
+            Key used to sign the jwt access tokens (required by the jwt
+            format, must differ from oidc.salt and oidc.code.key)
+
+        oidc.access_token.revocation_refresh
+
+            Max number of seconds before a revocation made by another process
+            is seen (default 30)
+    """
+    settings = config.get_settings()
+    key = oidc_settings(settings, 'access_token.key', '')
+    if key and key in (
+        oidc_settings(settings, 'salt'),
+        oidc_settings(settings, 'code.key'),
+    ):
+        raise KeyError(
+            u"oidc.access_token.key must differ from oidc.salt and "
+            u"oidc.code.key"
+        )
+    ACCESS_TOKENS.configure(
+        format_=oidc_settings(settings, 'access_token.format'),
+        key=key,
+        issuer=oidc_settings(settings, 'issuer_url'),
+    )
+    REVOCATION_SET.configure(
+        refresh_interval=oidc_settings(
+            settings, 'access_token.revocation_refresh', 30
+        ),
+    )
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Back-channel logout as described in :
+    https://openid.net/specs/openid-connect-backchannel-1_0.html
+
+When a user logs out, the clients the user has non-revoked tokens with (and
+a logout uri) are notified : one logout token signed with the provider's key
+(RS256/ES256, see keys.py) whose audience lists all of them is POSTed to each
+client's logout_uri.
+
+Deliveries run on a bounded WorkerPool, the logout response never waits for
+them. Each delivery has its own timeout and is retried with an exponential
+backoff, notifications that still fail (or that the full pool rejected) are
+stored as OidcLogoutRetry rows. Those rows are retried (with a fresh logout
+token) every retry_interval seconds by a background thread or through the
+"oidc-manage <config_uri> logoutretry" command, and dropped after
+max_attempts attempts.
+"""
+import time
+import logging
+import datetime
+import threading
+
+import transaction
+from jwkest.jws import JWS
+from pyramid.settings import asbool
+from six.moves.urllib.parse import urlencode
+from six.moves.urllib.request import (
+    Request,
+    urlopen,
+)
+
+from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.generators import gen_token
+from autonomie_oidc_provider.keys import SIGNING_KEYS
+from autonomie_oidc_provider.models import OidcLogoutRetry
+from autonomie_oidc_provider.pool import (
+    PoolFull,
+    WorkerPool,
+)
+from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+EVENT = 'http://schemas.openid.net/event/backchannel-logout'
+
+
+class DeliveryError(Exception):
+    """
+    Raised when a client doesn't acknowledge a logout token
+    """
+
+
+class BackChannelLogout(object):
+    """
+    Sign and deliver the logout tokens
+    """
+    def __init__(self, enabled=False, issuer=None, timeout=5, retries=2,
+                 backoff=0.5, token_lifetime=120, retry_interval=60,
+                 max_attempts=10, batch_size=100):
+        self.enabled = enabled
+        self.issuer = issuer
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.token_lifetime = token_lifetime
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.pool = WorkerPool('backchannel-logout', size=4, queue_size=256)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def configure(self, enabled=None, issuer=None, timeout=None, retries=None,
+                  backoff=None, retry_interval=None, max_attempts=None,
+                  pool_size=None, queue_size=None):
+        if enabled is not None:
+            self.enabled = asbool(enabled)
+        if issuer is not None:
+            self.issuer = issuer
+        if timeout is not None:
+            self.timeout = float(timeout)
+        if retries is not None:
+            self.retries = int(retries)
+        if backoff is not None:
+            self.backoff = float(backoff)
+        if retry_interval is not None:
+            self.retry_interval = int(retry_interval)
+        if max_attempts is not None:
+            self.max_attempts = int(max_attempts)
+        self.pool.configure(size=pool_size, queue_size=queue_size)
+
+    def build_logout_token(self, user_id, clients, now=None):
+        """
+        Build a logout token addressed to all the given clients
+
+        :param int user_id: The user who logged out
+        :param list clients: registry.ClientEntry instances
+        :returns: A JWS signed with the provider's current key
+        :rtype: str
+        """
+        if now is None:
+            now = time.time()
+        claims = {
+            'iss': self.issuer,
+            'sub': unicode(user_id),
+            'aud': [client.client_id for client in clients],
+            'iat': int(now),
+            'exp': int(now) + self.token_lifetime,
+            'jti': gen_token(),
+            'events': {EVENT: {}},
+        }
+        key = SIGNING_KEYS.get_signing_key()
+        return JWS(claims, alg=key.alg).sign_compact([key.key])
+
+    def post(self, uri, logout_token):
+        """
+        POST the logout token to the given uri
+
+        :raises: DeliveryError if the client doesn't answer 200 or 204 in
+        time
+        """
+        request = Request(
+            uri,
+            data=urlencode({'logout_token': logout_token}),
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
+        )
+        try:
+            response = urlopen(request, timeout=self.timeout)
+            try:
+                status = response.getcode()
+            finally:
+                response.close()
+        except Exception as exc:
+            raise DeliveryError(u"%s : %s" % (uri, exc))
+        if status not in (200, 204):
+            raise DeliveryError(u"%s : HTTP %s" % (uri, status))
+
+    def deliver(self, user_id, client, logout_token, session=None):
+        """
+        Deliver a logout token to a client (run by the pool's workers)
+
+        The delivery is retried self.retries times with an exponential
+        backoff, a notification that still fails is stored for later
+
+        :param obj session: The session the failed notification is added to
+        (default : stored in its own transaction)
+        :returns: True if the client acknowledged the logout token
+        :rtype: bool
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                self.post(client.logout_uri, logout_token)
+                return True
+            except DeliveryError as exc:
+                logger.warn(u"Back-channel logout failed : %s", exc)
+                error = exc
+        retry = self._new_retry(user_id, client.id, error)
+        if session is not None:
+            session.add(retry)
+            return False
+        try:
+            with transaction.manager:
+                DBSESSION().add(retry)
+        finally:
+            DBSESSION.remove()
+        return False
+
+    def _new_retry(self, user_id, client_id, error):
+        next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=self.retry_interval
+        )
+        return OidcLogoutRetry(user_id, client_id, error, next_attempt_at)
+
+    def notify(self, user_id, client_ids):
+        """
+        Notify the given clients that the user logged out, without waiting
+        for the deliveries
+
+        Notifications rejected by the full pool are added to the current
+        session (stored with the request's transaction)
+
+        :param int user_id: The user who logged out
+        :param iter client_ids: OidcClient primary keys
+        :returns: The submitted pool.Job instances
+        :rtype: list
+        """
+        if not self.enabled:
+            return []
+        clients = [
+            client for client in (
+                CLIENT_REGISTRY.get_by_id(client_id)
+                for client_id in client_ids
+            )
+            if client is not None and client.logout_uri
+        ]
+        if not clients:
+            return []
+        try:
+            logout_token = self.build_logout_token(user_id, clients)
+        except KeyError:
+            logger.exception(u"No key to sign the logout token")
+            return []
+        # A pool without threads runs the deliveries in the request's thread
+        session = DBSESSION() if self.pool.size <= 0 else None
+        jobs = []
+        for client in clients:
+            try:
+                jobs.append(self.pool.submit(
+                    self.deliver, user_id, client, logout_token, session
+                ))
+            except PoolFull:
+                DBSESSION().add(
+                    self._new_retry(user_id, client.id, u"Pool full")
+                )
+        return jobs
+
+    def _retry(self, session, now, result):
+        retries = session.query(OidcLogoutRetry).filter(
+            OidcLogoutRetry.next_attempt_at <= now
+        ).order_by(OidcLogoutRetry.next_attempt_at).limit(
+            self.batch_size
+        ).all()
+
+        jobs = []
+        for retry in retries:
+            client = CLIENT_REGISTRY.get_by_id(retry.client_id)
+            if client is None or not client.logout_uri:
+                session.delete(retry)
+                result['dropped'] += 1
+                continue
+            # The stored notification's token may have expired
+            logout_token = self.build_logout_token(retry.user_id, [client])
+            try:
+                job = self.pool.submit(
+                    self.post, client.logout_uri, logout_token
+                )
+            except PoolFull:
+                break
+            jobs.append((retry, job))
+
+        for retry, job in jobs:
+            try:
+                job.wait()
+            except DeliveryError as exc:
+                retry.attempts += 1
+                retry.set_error(exc)
+                if retry.attempts >= self.max_attempts:
+                    logger.error(
+                        u"Back-channel logout of user %s dropped after "
+                        u"%s attempts : %s",
+                        retry.user_id, retry.attempts, exc,
+                    )
+                    session.delete(retry)
+                    result['dropped'] += 1
+                else:
+                    retry.next_attempt_at = now + datetime.timedelta(
+                        seconds=self.retry_interval * 2 ** retry.attempts
+                    )
+                    result['failed'] += 1
+            else:
+                session.delete(retry)
+                result['delivered'] += 1
+
+    def retry_pending(self, now=None):
+        """
+        Retry the stored notifications that are due (at most batch_size), in
+        their own transaction
+
+        :returns: The number of delivered, failed and dropped notifications
+        :rtype: dict
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        result = {'delivered': 0, 'failed': 0, 'dropped': 0}
+        try:
+            self._retry(DBSESSION(), now, result)
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            raise
+        return result
+
+    def _loop(self):
+        while not self._stop.wait(self.retry_interval):
+            try:
+                self.retry_pending()
+            except Exception:
+                logger.exception(u"Error while retrying the logout tokens")
+            finally:
+                DBSESSION.remove()
+
+    def start(self):
+        """
+        Start the retry thread (if enabled)
+        """
+        if not self.enabled or self.retry_interval <= 0 \
+                or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name='oidc-backchannel-retry'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+
+BACKCHANNEL_LOGOUT = BackChannelLogout()
+
+
+def includeme(config):
+    """
+    Configure the back-channel logout regarding the current settings
+
+        oidc.backchannel_logout
+
+            true to notify the clients' logout uris (default false), needs an
+            asymmetric oidc.id_token.signing_alg (RS256 or ES256)
+
+        oidc.backchannel_logout.timeout
+
+            Number of seconds a client has to answer (default 5)
+
+        oidc.backchannel_logout.retries
+
+            Number of immediate retries (default 2), the nth one waits
+            backoff * 2 ** (n - 1) seconds
+
+        oidc.backchannel_logout.backoff
+
+            See above (default 0.5)
+
+        oidc.backchannel_logout.pool_size
+
+            Number of delivery threads (default 4)
+
+        oidc.backchannel_logout.queue_size
+
+            Max number of pending deliveries (default 256)
+
+        oidc.backchannel_logout.retry_interval
+
+            Number of seconds between two runs of the retry thread (default
+            60, 0 disables the thread)
+
+        oidc.backchannel_logout.max_attempts
+
+            Number of delayed attempts before a notification is dropped
+            (default 10)
+    """
+    settings = config.get_settings()
+    enabled = asbool(oidc_settings(settings, 'backchannel_logout', False))
+    if enabled and SIGNING_KEYS.is_symmetric():
+        raise KeyError(
+            u"oidc.backchannel_logout needs oidc.id_token.signing_alg set to "
+            u"RS256 or ES256"
+        )
+    BACKCHANNEL_LOGOUT.configure(
+        enabled=enabled,
+        issuer=settings.get('oidc.issuer_url'),
+        timeout=oidc_settings(settings, 'backchannel_logout.timeout'),
+        retries=oidc_settings(settings, 'backchannel_logout.retries'),
+        backoff=oidc_settings(settings, 'backchannel_logout.backoff'),
+        retry_interval=oidc_settings(
+            settings, 'backchannel_logout.retry_interval'
+        ),
+        max_attempts=oidc_settings(
+            settings, 'backchannel_logout.max_attempts'
+        ),
+        pool_size=oidc_settings(settings, 'backchannel_logout.pool_size'),
+        queue_size=oidc_settings(settings, 'backchannel_logout.queue_size'),
+    )
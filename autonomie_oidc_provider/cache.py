@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Process local caches
+"""
+import os
+import copy
+import hmac
+import time
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """
+    Thread-safe, size bounded, LRU cache whose entries expire after ttl
+    seconds
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize=None, ttl=None):
+        """
+        Change the cache bounds, the current entries are dropped
+        """
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = int(maxsize)
+            if ttl is not None:
+                self.ttl = int(ttl)
+            self._data.clear()
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key if it's still valid
+        """
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires < time.time():
+                return default
+            # Re-insert the key to mark it as the most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        """
+        Store value under key, evicting the least recently used entries if
+        needed
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_where(self, predicate):
+        """
+        Drop all the entries for which predicate(key, value) is True
+
+        :returns: The number of dropped entries
+        :rtype: int
+        """
+        with self._lock:
+            keys = [
+                key for key, (expires, value) in self._data.items()
+                if predicate(key, value)
+            ]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class VerifiedSecretCache(object):
+    """
+    Cache of the recently verified (client_id, client_secret) pairs
+
+    The clear secret is never stored, entries are keyed on an HMAC of the
+    credentials computed with a random key generated for the current process.
+    The stored hash of the client secret is kept with each entry so that any
+    change of the secret makes the entry useless.
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self._key = os.urandom(32)
+        self._cache = TTLCache(maxsize, ttl)
+
+    def configure(self, maxsize=None, ttl=None):
+        self._cache.configure(maxsize, ttl)
+
+    def _digest(self, client_id, client_secret):
+        if isinstance(client_id, unicode):
+            client_id = client_id.encode('utf-8')
+        if isinstance(client_secret, unicode):
+            client_secret = client_secret.encode('utf-8')
+        msg = b"%s:%s" % (client_id, client_secret)
+        return hmac.new(self._key, msg, hashlib.sha256).digest()
+
+    def is_verified(self, client_id, client_secret, secret_hash):
+        """
+        Check if the given credentials have recently been verified against
+        the given stored secret hash
+
+        :param str client_id: The client's client_id
+        :param str client_secret: The clear secret provided by the client
+        :param str secret_hash: The currently stored secret hash
+        :rtype: bool
+        """
+        entry = self._cache.get(self._digest(client_id, client_secret))
+        if entry is None:
+            return False
+        return entry == (client_id, secret_hash)
+
+    def remember(self, client_id, client_secret, secret_hash):
+        """
+        Remember the given credentials have been successfully verified
+        """
+        self._cache.set(
+            self._digest(client_id, client_secret),
+            (client_id, secret_hash),
+        )
+
+    def invalidate(self, client_id):
+        """
+        Forget all the verified credentials of the given client
+        """
+        count = self._cache.discard_where(
+            lambda key, value: value[0] == client_id
+        )
+        logger.debug(
+            u"%s verified credentials dropped for client %s",
+            count,
+            client_id,
+        )
+
+    def clear(self):
+        self._cache.clear()
+
+
+class ClaimCache(object):
+    """
+    Cache of the claims collected for a user and a set of scopes
+
+    Callers get their own copy of the cached claims (they add the nonce,
+    at_hash ... to it)
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self._cache = TTLCache(maxsize, ttl)
+
+    def configure(self, maxsize=None, ttl=None):
+        self._cache.configure(maxsize, ttl)
+
+    @staticmethod
+    def _key(user_id, scopes):
+        return (user_id, frozenset(scopes))
+
+    def get(self, user_id, scopes):
+        """
+        Return a copy of the cached claims (None if not cached)
+
+        :rtype: dict
+        """
+        claims = self._cache.get(self._key(user_id, scopes))
+        if claims is not None:
+            claims = copy.deepcopy(claims)
+        return claims
+
+    def set(self, user_id, scopes, claims):
+        self._cache.set(self._key(user_id, scopes), copy.deepcopy(claims))
+
+    def invalidate(self, user_id):
+        """
+        Forget all the claims cached for the given user
+        """
+        self._cache.discard_where(lambda key, value: key[0] == user_id)
+
+    def clear(self):
+        self._cache.clear()
+
+
+SECRET_CACHE = VerifiedSecretCache()
+CLAIM_CACHE = ClaimCache()
+
+
+def includeme(config):
+    """
+    Configure the caches regarding the current settings
+
+        oidc.secret_cache.size
+
+            Max number of verified credentials kept in memory (0 disables the
+            cache)
+
+        oidc.secret_cache.ttl
+
+            Number of seconds verified credentials are kept
+
+        oidc.claim_cache.size
+
+            Max number of (user, scopes) claim sets kept in memory (0 disables
+            the cache)
+
+        oidc.claim_cache.ttl
+
+            Number of seconds claims are kept, changes made by another process
+            (e.g : Autonomie) are seen after this delay
+    """
+    settings = config.get_settings()
+    SECRET_CACHE.configure(
+        maxsize=oidc_settings(settings, 'secret_cache.size', 1024),
+        ttl=oidc_settings(settings, 'secret_cache.ttl', 300),
+    )
+    CLAIM_CACHE.configure(
+        maxsize=oidc_settings(settings, 'claim_cache.size', 1024),
+        ttl=oidc_settings(settings, 'claim_cache.ttl', 60),
+    )
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Authorization code formats
+
+opaque (default)
+
+    The code is the random value stored in OidcCode.authcode (one INSERT on
+    authorization, one SELECT and one UPDATE on exchange)
+
+jwe
+
+    The code is a JWE (A256KW + A128CBC-HS256) encrypted with the provider's
+    key (see oidc.code.key) carrying the client, the user, the redirect uri,
+    the scopes, the nonce and the expiry : the code table isn't used at all.
+
+    Single use is enforced by the ReplayCache, a process local set of the
+    consumed codes' jti whose entries are dropped on a timing wheel once the
+    code has expired. With several worker processes a code could be
+    exchanged once per process : use the opaque format (or route the token
+    endpoint to a single process) where that matters.
+
+Codes issued in one format are accepted on exchange whatever the current
+format is, switching from one to the other doesn't break pending exchanges.
+"""
+import json
+import time
+import logging
+import binascii
+import datetime
+import threading
+
+from jwkest import JWKESTException
+from jwkest.jwe import JWE
+from jwkest.jwk import SYMKey
+
+from autonomie_oidc_provider.exceptions import InvalidCredentials
+from autonomie_oidc_provider.generators import gen_token
+from autonomie_oidc_provider.models import CODE_LIFETIME
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+ALG = 'A256KW'
+ENC = 'A128CBC-HS256'
+FORMATS = ('opaque', 'jwe')
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return bytes(value)
+
+
+class ReplayCache(object):
+    """
+    Bounded set of consumed code ids
+
+    Each entry is stored in the slot of the wheel matching the second after
+    its code's expiry, slots are emptied as the wheel moves forward : the
+    cleanup costs nothing on the request path and entries never outlive
+    their code for more than resolution seconds.
+    """
+    def __init__(self, horizon=CODE_LIFETIME, resolution=1, max_size=100000):
+        self.resolution = resolution
+        self.max_size = max_size
+        self._slot_count = int(horizon // resolution) + 2
+        self._slots = [set() for index in range(self._slot_count)]
+        self._seen = set()
+        self._current = None
+        self._lock = threading.Lock()
+
+    def configure(self, max_size=None):
+        if max_size is not None:
+            self.max_size = int(max_size)
+
+    def _tick(self, timestamp):
+        return int(timestamp // self.resolution)
+
+    def _advance(self, tick):
+        """
+        Move the wheel to the given tick, dropping the expired entries
+        """
+        if self._current is None:
+            self._current = tick
+            return
+        steps = min(tick - self._current, self._slot_count)
+        for offset in range(1, steps + 1):
+            slot = self._slots[(self._current + offset) % self._slot_count]
+            self._seen.difference_update(slot)
+            slot.clear()
+        self._current = max(self._current, tick)
+
+    def add(self, jti, expires_at, now=None):
+        """
+        Record the use of the code with the given jti
+
+        :param str jti: The code's unique id
+        :param float expires_at: The code's expiry timestamp
+        :returns: True if the code had not been used yet, False if it's a
+        replay (or if the cache is full, failing closed)
+        :rtype: bool
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._advance(self._tick(now))
+            if jti in self._seen:
+                return False
+            if len(self._seen) >= self.max_size:
+                logger.warn(u"The code replay cache is full")
+                return False
+            # Codes never live longer than the horizon
+            tick = min(
+                self._tick(expires_at) + 1,
+                self._current + self._slot_count - 1,
+            )
+            self._slots[tick % self._slot_count].add(jti)
+            self._seen.add(jti)
+            return True
+
+    def __len__(self):
+        return len(self._seen)
+
+
+REPLAY_CACHE = ReplayCache()
+
+
+class StatelessCode(object):
+    """
+    Decrypted jwe code, provides what the token endpoint expects from an
+    OidcCode
+    """
+    def __init__(self, claims):
+        self.jti = claims['jti']
+        self.audience = claims['aud']
+        self.user_id = claims['sub']
+        self.uri = claims['uri']
+        self.scopes = claims['scope']
+        self.nonce = claims.get('nonce')
+        self.exp = claims['exp']
+        self.creation_date = datetime.datetime.utcfromtimestamp(claims['iat'])
+
+    def get_expiry(self):
+        return datetime.datetime.utcfromtimestamp(self.exp)
+
+    def is_expired(self, now=None):
+        if now is None:
+            now = time.time()
+        return now > self.exp
+
+    def consume(self, now=None):
+        """
+        Mark the code as used in the replay cache
+
+        :returns: True if this call consumed the code
+        :rtype: bool
+        """
+        if self.is_expired(now):
+            return False
+        return REPLAY_CACHE.add(self.jti, self.exp, now)
+
+
+class CodeFormat(object):
+    """
+    Build and decode the authorization codes sent to the clients
+    """
+    def __init__(self, format_='opaque', key=b'', lifetime=CODE_LIFETIME):
+        self.format = format_
+        self.key = _to_bytes(key)
+        self.lifetime = lifetime
+
+    def configure(self, format_=None, key=None):
+        if format_ is not None:
+            if format_ not in FORMATS:
+                raise KeyError(u"Unknown code format %s" % format_)
+            self.format = format_
+        if key is not None:
+            self.key = _to_bytes(key)
+        if self.format == 'jwe' and not self.key:
+            raise KeyError(u"The jwe code format needs an oidc.code.key")
+
+    def is_stateless(self):
+        return self.format == 'jwe'
+
+    @staticmethod
+    def looks_like_jwe(code_str):
+        """
+        Check if the given code is a JWE compact serialization (opaque codes
+        are base64url or hexadecimal strings)
+        """
+        return code_str.count('.') == 4
+
+    def _get_key_object(self):
+        return SYMKey(key=self.key)
+
+    def serialize(self, client, user_id, uri, scopes, nonce=None, now=None):
+        """
+        Build an encrypted code
+
+        :param obj client: The registry.ClientEntry instance
+        :param int user_id: The authenticated user's id
+        :param str uri: The redirect uri the code is issued for
+        :param str scopes: The space delimited granted scopes
+        :param str nonce: The nonce transmitted by the client
+        :rtype: str
+        """
+        if now is None:
+            now = time.time()
+        claims = {
+            'jti': gen_token(),
+            'aud': client.client_id,
+            'sub': user_id,
+            'uri': uri,
+            'scope': scopes,
+            'iat': int(now),
+            'exp': int(now) + self.lifetime,
+        }
+        if nonce is not None:
+            claims['nonce'] = nonce
+        _jwe = JWE(json.dumps(claims), alg=ALG, enc=ENC)
+        return _jwe.encrypt([self._get_key_object()])
+
+    def decode(self, code_str):
+        """
+        Decrypt an encrypted code
+
+        :rtype: StatelessCode
+        :raises: InvalidCredentials
+        """
+        try:
+            claims = json.loads(
+                JWE().decrypt(code_str, keys=[self._get_key_object()])
+            )
+            return StatelessCode(claims)
+        except (
+            JWKESTException, binascii.Error, ValueError, TypeError, KeyError
+        ):
+            logger.exception(u"Invalid jwe auth code")
+            raise InvalidCredentials(error_description="Invalid auth code")
+
+
+CODE_FORMAT = CodeFormat()
+
+
+def includeme(config):
+    """
+    Configure the authorization code format regarding the current settings
+
+        oidc.code.format
+
+            opaque (default) or jwe
+
+        oidc.code.key
+
+            Key used to encrypt the jwe codes (required by the jwe format,
+            must differ from oidc.salt)
+
+        oidc.code.replay_cache_size
+
+            Max number of consumed codes remembered (default 100000), codes
+            are rejected when it's full
+    """
+    settings = config.get_settings()
+    key = oidc_settings(settings, 'code.key', '')
+    if key and key == oidc_settings(settings, 'salt'):
+        raise KeyError(u"oidc.code.key must differ from oidc.salt")
+    CODE_FORMAT.configure(
+        format_=oidc_settings(settings, 'code.format'),
+        key=key,
+    )
+    REPLAY_CACHE.configure(
+        max_size=oidc_settings(settings, 'code.replay_cache_size'),
+    )
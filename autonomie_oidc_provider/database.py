@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Dedicated database for the OIDC tables
+
+When oidc.sqlalchemy.url is set, the OIDC models are bound to their own
+engine (and connection pool) through the binds of DBSESSION : logins and
+token requests don't compete with the ERP's traffic anymore. The User (and
+Login) reads made to build the claims stay on the Autonomie database.
+
+Any oidc.sqlalchemy.* setting is passed to the engine (pool_size,
+pool_recycle ...), SQLite engines are set up as described in engines.py. The
+OIDC tables are created on the dedicated database if they're missing.
+
+Both databases are committed by the same transaction (one after the other, not
+in two phases).
+"""
+import logging
+
+from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.engines import get_engine
+from autonomie_oidc_provider.models import (
+    OidcClient,
+    OidcCode,
+    OidcIdToken,
+    OidcLogoutRetry,
+    OidcRedirectUri,
+    OidcToken,
+)
+
+
+logger = logging.getLogger(__name__)
+
+OIDC_MODELS = (
+    OidcClient,
+    OidcRedirectUri,
+    OidcCode,
+    OidcToken,
+    OidcIdToken,
+    OidcLogoutRetry,
+)
+
+
+def get_oidc_engine(settings):
+    """
+    Build the engine of the dedicated OIDC database
+
+    :returns: An engine or None if no oidc.sqlalchemy.url is configured
+    """
+    if not settings.get('oidc.sqlalchemy.url'):
+        return None
+    return get_engine(settings, 'oidc.sqlalchemy.')
+
+
+def bind_oidc_models(engine, session=DBSESSION, create=True):
+    """
+    Bind the OIDC models to the given engine, the other models keep the
+    session's default bind
+
+    :param obj engine: The dedicated engine
+    :param obj session: The scoped session to configure
+    :param bool create: Should the missing OIDC tables be created
+    """
+    if create:
+        OidcClient.metadata.create_all(
+            engine, tables=[model.__table__ for model in OIDC_MODELS]
+        )
+    binds = dict(session.session_factory.kw.get('binds') or {})
+    for model in OIDC_MODELS:
+        binds[model] = engine
+    session.configure(binds=binds)
+    logger.info(u"OIDC tables bound to %s", engine.url)
+
+
+def includeme(config):
+    """
+    Bind the OIDC models regarding the current settings
+
+        oidc.sqlalchemy.url
+
+            Url of the dedicated OIDC database (default : the Autonomie
+            database)
+    """
+    engine = get_oidc_engine(config.get_settings())
+    if engine is not None:
+        bind_oidc_models(engine)
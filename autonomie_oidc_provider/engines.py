@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Engine setup
+
+SQLite databases are tuned for concurrent request threads, the following
+pragmas are set on each new connection (oidc.sqlite.* settings) :
+
+    journal_mode (default WAL)
+
+        Readers don't block the writer anymore
+
+    busy_timeout (default 5000 ms)
+
+        A connection waits for the write lock instead of failing with
+        "database is locked"
+
+    synchronous (default NORMAL)
+
+        Safe in WAL mode, the WAL file is only synced on checkpoints
+
+    mmap_size (default 256Mo)
+
+        Reads are made through memory mapping
+"""
+import logging
+
+from sqlalchemy import (
+    engine_from_config,
+    event,
+)
+
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('busy_timeout', 5000),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+)
+
+
+def get_sqlite_pragmas(settings):
+    """
+    Return the pragmas to set on the SQLite connections
+
+    :rtype: list of (name, value) tuples
+    """
+    return [
+        (name, oidc_settings(settings, 'sqlite.%s' % name, default))
+        for name, default in SQLITE_PRAGMAS
+    ]
+
+
+def setup_sqlite(engine, pragmas):
+    """
+    Set the given pragmas on each new connection of the engine
+    """
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+        finally:
+            cursor.close()
+
+    event.listen(engine, 'connect', on_connect)
+
+
+def get_engine(settings, prefix='sqlalchemy.'):
+    """
+    Build the engine configured by the settings starting with prefix, SQLite
+    engines get the oidc.sqlite.* pragmas
+
+    :rtype: obj
+    """
+    engine = engine_from_config(settings, prefix)
+    if engine.dialect.name == 'sqlite':
+        pragmas = get_sqlite_pragmas(settings)
+        setup_sqlite(engine, pragmas)
+        logger.debug(u"SQLite pragmas : %s", pragmas)
+    return engine
@@ -14,6 +14,7 @@ from pyramid.httpexceptions import (
     HTTPUnauthorized,
     HTTPBadRequest,
     HTTPForbidden,
+    HTTPServiceUnavailable,
 )
 
 
@@ -114,3 +115,14 @@ class InvalidCredentials(BaseOauth2Error):
     """
     error_name = "invalid_grant"
     response_class = HTTPForbidden
+
+
+class TemporarilyUnavailable(BaseOauth2Error):
+    """
+    The authorization server is currently unable to handle the request due
+    to a temporary overloading or maintenance of the server.
+
+    https://tools.ietf.org/html/rfc6749#section-4.1.2.1
+    """
+    error_name = 'temporarily_unavailable'
+    response_class = HTTPServiceUnavailable
@@ -10,8 +10,10 @@
 # or fitness for a particular purpose. See the MIT License for full details.
 #
 
+import os
 import sys
 import time
+import string
 import random
 import hashlib
 
@@ -25,7 +27,11 @@ if getattr(hashlib, 'pbkdf2_hmac', None) is None:
 else:
     hash_tool = hashlib.pbkdf2_hmac
 
-from base64 import b64encode
+from base64 import (
+    b64encode,
+    urlsafe_b64decode,
+    urlsafe_b64encode,
+)
 import binascii
 
 def _get_hash():
@@ -67,17 +73,72 @@ def gen_client_secret():
     """
     return _get_hash().hexdigest()
 
-def gen_token(client):
+TOKEN_BYTES = 32
+# Length of the unpadded base64url representation
+TOKEN_LENGTH = 43
+TOKEN_CHARS = frozenset(string.ascii_letters + string.digits + '-_')
+
+def encode_token(raw):
+    """
+    Return the base64url (unpadded) representation of a raw token
+
+    :param bytes raw: The TOKEN_BYTES bytes of the token
+    :rtype: unicode
+    """
+    return urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def decode_token(token_str):
+    """
+    Return the raw bytes of a token given as base64url or as hexadecimal (the
+    64 characters tokens generated by the previous versions)
+
+    :param str token_str: The token as sent by the client
+    :returns: The TOKEN_BYTES raw bytes or None if it's not a token
+    :rtype: bytes
     """
-    Generates a random token for the given client
+    if not token_str:
+        return None
+    if isinstance(token_str, unicode):
+        try:
+            token_str = token_str.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+    try:
+        if len(token_str) == TOKEN_BYTES * 2:
+            raw = binascii.unhexlify(token_str)
+        elif len(token_str) == TOKEN_LENGTH:
+            if not TOKEN_CHARS.issuperset(token_str):
+                return None
+            raw = urlsafe_b64decode(token_str + b'=')
+        else:
+            return None
+    except (TypeError, ValueError, binascii.Error):
+        return None
+    return raw
+
+def normalize_token(token_str):
+    """
+    Return the canonical (base64url) form of a token, legacy hexadecimal
+    tokens included
+
+    :returns: The token or None if it's not a token
+    """
+    raw = decode_token(token_str)
+    if raw is None:
+        return None
+    return encode_token(raw)
 
-    :param obj client: An OidcClient instance
+def gen_token(client=None):
+    """
+    Generates a random token (TOKEN_BYTES bytes from the system's random
+    source, base64url encoded)
+
+    :param obj client: An OidcClient instance (unused, kept for
+    compatibility)
     :returns: A token
-    :rtype: str
+    :rtype: unicode
     """
-    sha = _get_hash()
-    sha.update(client.client_id.encode('utf8'))
-    return sha.hexdigest()
+    return encode_token(os.urandom(TOKEN_BYTES))
 
 def crypt_secret(secret, salt):
     """
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Single writer queue for the code and token inserts
+
+When oidc.group_commit is enabled, request threads don't insert the new
+OidcCode and OidcToken rows themselves : they hand them to a single writer
+thread and wait until they're committed. The writer inserts all the rows
+pending at once (at most max_batch rows, waiting at most max_wait seconds for
+more) in a single transaction : one commit (and one lock acquisition on
+SQLite) per batch instead of one per request.
+
+The rows are committed out of the request's transaction, before the response
+is sent. If a batch fails, its rows are retried one by one so that a single
+bad row only fails its own request.
+
+SQLite has a single write lock, held by a transaction from its first write
+until its commit : when the request's session has already written (e.g the
+code consumption or the refresh token rotation), the writer thread would wait
+for the request which waits for the writer. Those rows are added to the
+request's session instead.
+"""
+import time
+import logging
+import threading
+
+from six.moves import queue
+
+import transaction
+from pyramid.settings import asbool
+from sqlalchemy import (
+    event,
+    inspect,
+)
+from sqlalchemy.orm import Session
+from zope.sqlalchemy import mark_changed
+
+from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.util import oidc_settings
+from autonomie_oidc_provider.write_behind import instance_to_row
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_INFO_KEY = 'oidc_has_written'
+
+
+class WriteTimeout(Exception):
+    """
+    Raised when a row hasn't been committed in time
+    """
+
+
+class _PendingWrite(object):
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitWriter(object):
+    """
+    Single writer thread committing the queued rows in batches
+    """
+    def __init__(self, enabled=False, max_batch=500, max_wait=0.005,
+                 timeout=10):
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'batches': 0, 'rows': 0, 'failed': 0}
+
+    def configure(self, enabled=None, max_batch=None, max_wait=None,
+                  timeout=None):
+        if enabled is not None:
+            self.enabled = asbool(enabled)
+        if max_batch is not None:
+            self.max_batch = int(max_batch)
+        if max_wait is not None:
+            self.max_wait = float(max_wait)
+        if timeout is not None:
+            self.timeout = float(timeout)
+
+    def write(self, instance):
+        """
+        Insert the given model instance and wait for the commit
+
+        :param obj instance: A new OidcCode or OidcToken instance (never added
+        to the session)
+        :raises: WriteTimeout or the error raised by the insert
+        """
+        table = instance.__table__
+        pending = _PendingWrite(table, instance_to_row(table, instance))
+        self._start()
+        self._queue.put(pending)
+        if not pending.done.wait(self.timeout):
+            raise WriteTimeout(u"No commit after %ss" % self.timeout)
+        if pending.error is not None:
+            raise pending.error
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, batch):
+        tables = []
+        rows = {}
+        for pending in batch:
+            if pending.table not in rows:
+                tables.append(pending.table)
+                rows[pending.table] = []
+            rows[pending.table].append(pending.row)
+
+        with transaction.manager:
+            session = DBSESSION()
+            for table in tables:
+                session.execute(table.insert(), rows[table])
+            mark_changed(session)
+
+    def _commit(self, batch):
+        try:
+            self._insert(batch)
+        except Exception as exc:
+            if len(batch) == 1:
+                logger.exception(u"Unable to insert a row")
+                batch[0].error = exc
+                self._stats['failed'] += 1
+            else:
+                for pending in batch:
+                    self._commit([pending])
+                return
+        else:
+            self._stats['batches'] += 1
+            self._stats['rows'] += len(batch)
+        for pending in batch:
+            pending.done.set()
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._commit(batch)
+            finally:
+                DBSESSION.remove()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._loop, name='oidc-group-commit'
+                )
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stats(self):
+        result = dict(self._stats)
+        result['pending'] = self._queue.qsize()
+        return result
+
+
+GROUP_COMMIT = GroupCommitWriter()
+
+
+def holds_sqlite_lock(session, instance):
+    """
+    Check if the session's transaction holds the write lock of the SQLite
+    database the given instance is stored in
+
+    :rtype: bool
+    """
+    if not session.info.get(SESSION_INFO_KEY):
+        return False
+    bind = session.get_bind(mapper=inspect(type(instance)))
+    return bind.dialect.name == 'sqlite'
+
+
+def insert(session, instance):
+    """
+    Insert a new code or token : through the writer queue if it's enabled,
+    in the request's session otherwise (or if it holds the SQLite write lock)
+
+    :param obj session: The request's session
+    :param obj instance: The new OidcCode or OidcToken
+    """
+    if GROUP_COMMIT.enabled and not holds_sqlite_lock(session, instance):
+        GROUP_COMMIT.write(instance)
+    else:
+        session.add(instance)
+
+
+def on_flush(session, flush_context):
+    session.info[SESSION_INFO_KEY] = True
+
+
+def on_bulk_write(context):
+    context.session.info[SESSION_INFO_KEY] = True
+
+
+def on_transaction_end(session, *args):
+    session.info.pop(SESSION_INFO_KEY, None)
+
+
+event.listen(Session, 'after_flush', on_flush)
+event.listen(Session, 'after_bulk_update', on_bulk_write)
+event.listen(Session, 'after_bulk_delete', on_bulk_write)
+event.listen(Session, 'after_commit', on_transaction_end)
+event.listen(Session, 'after_rollback', on_transaction_end)
+
+
+def includeme(config):
+    """
+    Configure the writer queue regarding the current settings
+
+        oidc.group_commit
+
+            true to enable the writer queue (default false), it only helps
+            with concurrent inserts : with SQLite the rows of the requests
+            that already wrote are inserted in their own transaction
+
+        oidc.group_commit.max_batch
+
+            Max number of rows per commit (default 500)
+
+        oidc.group_commit.max_wait
+
+            Max number of seconds the writer waits for more rows before
+            committing (default 0.005)
+
+        oidc.group_commit.timeout
+
+            Max number of seconds a request waits for its commit (default 10)
+    """
+    settings = config.get_settings()
+    GROUP_COMMIT.configure(
+        enabled=oidc_settings(settings, 'group_commit', False),
+        max_batch=oidc_settings(settings, 'group_commit.max_batch'),
+        max_wait=oidc_settings(settings, 'group_commit.max_wait'),
+        timeout=oidc_settings(settings, 'group_commit.timeout'),
+    )
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Client secret hashing schemes
+
+Hashes are stored in a self-describing format :
+
+    <algorithm>$<params>$<salt>$<hexdigest>
+
+pbkdf2_sha256
+
+    params is the iteration count, this is the expensive scheme to use for
+    low entropy secrets
+
+hmac_sha256
+
+    params is the fingerprint of the server key, the digest is an HMAC of the
+    salted secret computed with the server key (see oidc.secret_hash.key).
+    Client secrets generated by gen_client_secret are 256 bits random values,
+    stretching them doesn't add any security.
+
+Hashes stored before this format was introduced are bare hexadecimal digests
+produced by generators.crypt_secret (salt taken from the OidcClient.salt
+column), they are upgraded on the next successful check.
+"""
+import abc
+import hmac
+import hashlib
+import binascii
+import logging
+
+import six
+
+from autonomie_oidc_provider.generators import (
+    crypt_secret,
+    gen_salt,
+    hash_tool,
+)
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = u'$'
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return bytes(value)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class BaseHasher(object):
+    """
+    Verification of a stored hash
+    """
+    algorithm = None
+    # Should the hasher be run outside of the request thread ?
+    expensive = False
+
+    @abc.abstractmethod
+    def verify(self, secret, encoded, client_salt=None):
+        """
+        Check the given secret matches the encoded hash
+
+        :param str secret: The clear secret
+        :param str encoded: The stored hash
+        :param str client_salt: The salt stored on the client (legacy hashes)
+        :rtype: bool
+        """
+
+    @abc.abstractmethod
+    def must_update(self, encoded):
+        """
+        Check if the encoded hash was produced with outdated parameters
+        """
+
+
+class EncodingHasher(BaseHasher):
+    """
+    Hashers producing the self-describing format
+    """
+    def encode(self, secret, salt=None):
+        """
+        Hash the given secret
+
+        :param str secret: The clear secret
+        :param str salt: The salt to use (a new one is generated by default)
+        :returns: The encoded hash
+        :rtype: unicode
+        """
+        if salt is None:
+            salt = gen_salt()
+        params = self.params()
+        digest = self.digest(_to_bytes(secret), salt, params)
+        return SEPARATOR.join((self.algorithm, params, salt, digest))
+
+    def verify(self, secret, encoded, client_salt=None):
+        algorithm, params, salt, digest = encoded.split(SEPARATOR, 3)
+        expected = self.digest(_to_bytes(secret), salt, params)
+        return hmac.compare_digest(_to_bytes(expected), _to_bytes(digest))
+
+    @abc.abstractmethod
+    def params(self):
+        """
+        Return the parameters stored in the hash (unicode)
+        """
+
+    @abc.abstractmethod
+    def digest(self, secret, salt, params):
+        """
+        Return the hexadecimal digest of the secret (unicode)
+        """
+
+    def must_update(self, encoded):
+        algorithm, params, salt, digest = encoded.split(SEPARATOR, 3)
+        return params != self.params()
+
+
+class PBKDF2Hasher(EncodingHasher):
+    algorithm = u'pbkdf2_sha256'
+    expensive = True
+
+    def __init__(self, iterations=100000):
+        self.iterations = iterations
+
+    def params(self):
+        return unicode(self.iterations)
+
+    def digest(self, secret, salt, params):
+        hash_ = hash_tool('sha256', secret, _to_bytes(salt), int(params))
+        return binascii.hexlify(hash_).decode('ascii')
+
+
+class HMACHasher(EncodingHasher):
+    algorithm = u'hmac_sha256'
+
+    def __init__(self, key=b''):
+        self.key = _to_bytes(key)
+
+    def params(self):
+        return hashlib.sha256(self.key).hexdigest()[:8].decode('ascii')
+
+    def digest(self, secret, salt, params):
+        if params != self.params():
+            logger.error(
+                u"The client secret hash was produced with another key, "
+                u"check the oidc.secret_hash.key setting"
+            )
+        return hmac.new(
+            self.key, _to_bytes(salt) + secret, hashlib.sha256
+        ).hexdigest().decode('ascii')
+
+
+class LegacyPBKDF2Hasher(BaseHasher):
+    """
+    Bare hexadecimal digests produced by generators.crypt_secret (only
+    verified, never produced)
+    """
+    algorithm = None
+    expensive = True
+
+    def verify(self, secret, encoded, client_salt=None):
+        return hmac.compare_digest(
+            crypt_secret(_to_bytes(secret), client_salt),
+            _to_bytes(encoded),
+        )
+
+    def must_update(self, encoded):
+        return True
+
+
+class HasherRegistry(object):
+    """
+    The hashers indexed by algorithm and the one used to hash new secrets
+    """
+    def __init__(self):
+        self.hashers = {
+            PBKDF2Hasher.algorithm: PBKDF2Hasher(),
+            HMACHasher.algorithm: HMACHasher(),
+        }
+        self.legacy_hasher = LegacyPBKDF2Hasher()
+        self.default_algorithm = HMACHasher.algorithm
+
+    def configure(self, algorithm=None, iterations=None, key=None):
+        """
+        Configure the hashing schemes
+
+        :param str algorithm: The algorithm used to hash new secrets
+        :param int iterations: The PBKDF2 iteration count
+        :param str key: The HMAC server key
+        :raises: KeyError if hmac_sha256 is the default algorithm and no key
+        is configured
+        """
+        if algorithm is not None:
+            if algorithm not in self.hashers:
+                raise KeyError(
+                    u"Unknown secret hash algorithm %s" % algorithm
+                )
+            self.default_algorithm = algorithm
+        if iterations is not None:
+            self.hashers[PBKDF2Hasher.algorithm].iterations = int(iterations)
+        if key is not None:
+            self.hashers[HMACHasher.algorithm].key = _to_bytes(key)
+        if self.default_algorithm == HMACHasher.algorithm and \
+                not self.hashers[HMACHasher.algorithm].key:
+            raise KeyError(
+                u"The hmac_sha256 secret hash needs an oidc.secret_hash.key "
+                u"(or oidc.salt)"
+            )
+
+    def get_default_hasher(self):
+        """
+        Return the hasher used to hash new secrets
+        """
+        return self.hashers[self.default_algorithm]
+
+    def identify_hasher(self, encoded):
+        """
+        Return the hasher that produced the given encoded hash
+
+        :raises: KeyError if the algorithm is unknown
+        """
+        if SEPARATOR not in encoded:
+            return self.legacy_hasher
+        algorithm = encoded.split(SEPARATOR, 1)[0]
+        return self.hashers[algorithm]
+
+    def needs_rehash(self, encoded):
+        """
+        Check if the encoded hash should be replaced by a hash produced with
+        the current default scheme and parameters
+
+        :rtype: bool
+        """
+        hasher = self.identify_hasher(encoded)
+        if hasher is not self.get_default_hasher():
+            return True
+        return hasher.must_update(encoded)
+
+
+HASHER_REGISTRY = HasherRegistry()
+
+
+def get_default_hasher():
+    return HASHER_REGISTRY.get_default_hasher()
+
+
+def identify_hasher(encoded):
+    return HASHER_REGISTRY.identify_hasher(encoded)
+
+
+def needs_rehash(encoded):
+    return HASHER_REGISTRY.needs_rehash(encoded)
+
+
+def includeme(config):
+    """
+    Configure the hashers regarding the current settings
+
+        oidc.secret_hash.algorithm
+
+            hmac_sha256 (default) or pbkdf2_sha256
+
+        oidc.secret_hash.iterations
+
+            PBKDF2 iteration count (default 100000)
+
+        oidc.secret_hash.key
+
+            HMAC server key (defaults to oidc.salt, one of them is required
+            by hmac_sha256), changing it invalidates all the hmac_sha256
+            hashes
+    """
+    settings = config.get_settings()
+    HASHER_REGISTRY.configure(
+        algorithm=oidc_settings(settings, 'secret_hash.algorithm'),
+        iterations=oidc_settings(settings, 'secret_hash.iterations'),
+        key=oidc_settings(
+            settings,
+            'secret_hash.key',
+            oidc_settings(settings, 'salt', ''),
+        ),
+    )
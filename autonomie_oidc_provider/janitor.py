@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Purge of the expired codes and tokens
+
+Rows are deleted in batches of batch_size rows, each batch is committed in its
+own transaction so that locks are held briefly. Deleted rows can be archived
+in jsonl files (one file per table and per day, secret values are not
+archived).
+
+Purge rules :
+
+    OidcCode
+
+        expires_at is over
+
+    OidcToken
+
+        expires_at is over since the refresh token lifetime (the refresh
+        token may be used until then, oidc.refresh_token_lifetime), tokens
+        are kept if refresh tokens never expire
+
+    OidcIdToken
+
+        expiration_time is over
+
+Tokens kept out of the database by the sqlite token store are purged by the
+store itself with the OidcToken rule.
+
+The janitor can run in a background thread (oidc.janitor.interval) or through
+the "oidc-manage <config_uri> purge" command.
+"""
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+
+import transaction
+from sqlalchemy import (
+    and_,
+    func,
+    or_,
+)
+
+from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.models import (
+    CODE_LIFETIME,
+    ACCESS_TOKEN_LIFETIME,
+    OidcCode,
+    OidcIdToken,
+    OidcToken,
+)
+from autonomie_oidc_provider.token_store import get_token_store
+from autonomie_oidc_provider.util import (
+    get_refresh_token_lifetime,
+    oidc_settings,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Columns never written to the archive files
+SECRET_COLUMNS = ('authcode', 'access_token', 'refresh_token')
+
+
+def _serialize(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _empty_stats():
+    return {
+        'deleted': 0, 'batches': 0, 'lag': 0.0, 'duration': 0.0,
+        'throughput': 0.0,
+    }
+
+
+class PurgeRule(object):
+    """
+    Describe which rows of a model can be purged
+    """
+    def __init__(self, model, expiry_column, legacy_lifetime=None):
+        self.model = model
+        self.expiry_column = expiry_column
+        # Rows created before the expires_at column was added
+        self.legacy_lifetime = legacy_lifetime
+
+    @property
+    def name(self):
+        return self.model.__table__.name
+
+    def criterion(self, cutoff):
+        """
+        Return the sql criterion matching the rows expired before cutoff
+        """
+        criterion = self.expiry_column < cutoff
+        if self.legacy_lifetime is not None:
+            legacy_cutoff = cutoff - datetime.timedelta(
+                seconds=self.legacy_lifetime
+            )
+            criterion = or_(
+                criterion,
+                and_(
+                    self.expiry_column == None,  # NOQA
+                    self.model.creation_date < legacy_cutoff,
+                )
+            )
+        return criterion
+
+
+class Janitor(object):
+    """
+    Purge (and optionnaly archive) the expired rows in bounded batches
+    """
+    def __init__(self, batch_size=1000, interval=0, archive_dir=None,
+                 refresh_token_lifetime=30 * 24 * 60 * 60):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.archive_dir = archive_dir
+        self.refresh_token_lifetime = refresh_token_lifetime
+        self.rules = (
+            PurgeRule(OidcCode, OidcCode.expires_at, CODE_LIFETIME),
+            PurgeRule(OidcToken, OidcToken.expires_at, ACCESS_TOKEN_LIFETIME),
+            PurgeRule(OidcIdToken, OidcIdToken.expiration_time),
+        )
+        self.last_run = None
+        self.totals = {'runs': 0, 'deleted': 0, 'archived': 0}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def configure(self, batch_size=None, interval=None, archive_dir=None,
+                  refresh_token_lifetime=None):
+        if batch_size is not None:
+            self.batch_size = int(batch_size)
+        if interval is not None:
+            self.interval = int(interval)
+        self.archive_dir = archive_dir
+        if refresh_token_lifetime is not None:
+            self.refresh_token_lifetime = int(refresh_token_lifetime)
+
+    def get_cutoff(self, rule, now):
+        """
+        Return the date before which the rows of the given rule expired are
+        purged (None : never purged)
+        """
+        if rule.model is OidcToken:
+            if not self.refresh_token_lifetime:
+                return None
+            return now - datetime.timedelta(
+                seconds=self.refresh_token_lifetime
+            )
+        return now
+
+    def _archive(self, rule, rows):
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        path = os.path.join(
+            self.archive_dir,
+            "%s-%s.jsonl" % (
+                rule.name, datetime.date.today().strftime('%Y%m%d')
+            ),
+        )
+        columns = [
+            column.key for column in rule.model.__table__.columns
+            if column.key not in SECRET_COLUMNS
+        ]
+        with open(path, 'a') as fbuf:
+            for row in rows:
+                fbuf.write(json.dumps(
+                    dict(
+                        (column, _serialize(getattr(row, column)))
+                        for column in columns
+                    )
+                ))
+                fbuf.write('\n')
+
+    def _purge_batch(self, rule, criterion):
+        """
+        Purge one batch of rows, in its own transaction
+
+        :returns: The number of deleted rows
+        """
+        session = DBSESSION()
+        model = rule.model
+        try:
+            if self.archive_dir:
+                query = session.query(model).filter(criterion)
+                rows = query.order_by(rule.expiry_column).limit(
+                    self.batch_size
+                ).all()
+                ids = [row.id for row in rows]
+                if ids:
+                    self._archive(rule, rows)
+            else:
+                query = session.query(model.id).filter(criterion)
+                ids = [
+                    row[0] for row in query.order_by(
+                        rule.expiry_column
+                    ).limit(self.batch_size)
+                ]
+            if ids:
+                session.query(model).filter(model.id.in_(ids)).delete(
+                    synchronize_session=False
+                )
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            raise
+        return len(ids)
+
+    def _get_lag(self, rule, criterion, cutoff):
+        """
+        Return the number of seconds the oldest purgeable row has been waiting
+        """
+        oldest = DBSESSION().query(func.min(rule.expiry_column)).filter(
+            criterion
+        ).scalar()
+        if oldest is None:
+            return 0.0
+        return max((cutoff - oldest).total_seconds(), 0.0)
+
+    def purge(self, rule, now=None):
+        """
+        Purge the expired rows of the given rule
+
+        :returns: The metrics of the purge
+        :rtype: dict
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        result = _empty_stats()
+        cutoff = self.get_cutoff(rule, now)
+        if cutoff is None:
+            return result
+
+        criterion = rule.criterion(cutoff)
+        result['lag'] = self._get_lag(rule, criterion, cutoff)
+        start = time.time()
+        while not self._stop.is_set():
+            deleted = self._purge_batch(rule, criterion)
+            result['deleted'] += deleted
+            if deleted:
+                result['batches'] += 1
+            if deleted < self.batch_size:
+                break
+        result['duration'] = time.time() - start
+        if result['duration'] > 0:
+            result['throughput'] = result['deleted'] / result['duration']
+        return result
+
+    def purge_token_store(self, now=None):
+        """
+        Purge the tokens stored out of the database by the token store
+
+        :returns: The metrics of the purge, None if the store's tokens are
+        OidcToken rows
+        :rtype: dict
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        if not self.refresh_token_lifetime:
+            return None
+        cutoff = now - datetime.timedelta(seconds=self.refresh_token_lifetime)
+        start = time.time()
+        deleted = get_token_store().purge(cutoff, self.batch_size)
+        if deleted is None:
+            return None
+        result = _empty_stats()
+        result['deleted'] = deleted
+        result['batches'] = -(-deleted // self.batch_size)
+        result['duration'] = time.time() - start
+        if result['duration'] > 0:
+            result['throughput'] = deleted / result['duration']
+        return result
+
+    def run_once(self, now=None):
+        """
+        Purge all the tables
+
+        :returns: The metrics of the run by table name
+        :rtype: dict
+        """
+        stats = {}
+        for rule in self.rules:
+            stats[rule.name] = self.purge(rule, now)
+        store_stats = self.purge_token_store(now)
+        if store_stats is not None:
+            stats['token_store'] = store_stats
+        for name, result in stats.items():
+            logger.info(
+                u"Purged %(deleted)s rows from %(name)s in %(duration).2fs "
+                u"(%(throughput).0f rows/s, lag %(lag).0fs)",
+                dict(result, name=name),
+            )
+        deleted = sum(item['deleted'] for item in stats.values())
+        self.last_run = {'date': datetime.datetime.utcnow(), 'tables': stats}
+        self.totals['runs'] += 1
+        self.totals['deleted'] += deleted
+        if self.archive_dir:
+            self.totals['archived'] += deleted
+        return stats
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception(u"Error while purging the expired tokens")
+            finally:
+                DBSESSION.remove()
+
+    def start(self):
+        """
+        Start the background thread (if an interval is configured)
+        """
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='oidc-janitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+
+JANITOR = Janitor()
+
+
+def includeme(config):
+    """
+    Configure the janitor regarding the current settings
+
+        oidc.janitor.interval
+
+            Number of seconds between two purges made by the background
+            thread (default 0 : no background purge)
+
+        oidc.janitor.batch_size
+
+            Number of rows deleted per transaction (default 1000)
+
+        oidc.janitor.archive_dir
+
+            Directory where the purged rows are archived (default : no
+            archive)
+    """
+    settings = config.get_settings()
+    JANITOR.configure(
+        batch_size=oidc_settings(settings, 'janitor.batch_size', 1000),
+        interval=oidc_settings(settings, 'janitor.interval', 0),
+        archive_dir=oidc_settings(settings, 'janitor.archive_dir'),
+        refresh_token_lifetime=get_refresh_token_lifetime(settings),
+    )
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Provider key set used to sign the id tokens
+
+With the default HS256 algorithm, id tokens are signed with the client
+secret and no key set is needed.
+
+With RS256 or ES256, id tokens are signed with a provider private key and the
+public keys are published on the /jwks endpoint so that relying parties can
+verify the tokens by themselves.
+
+Keys are stored as JWK json files in the oidc.signing_keys.dir directory, each
+file is named after its activation timestamp :
+
+    <activation timestamp>-<random>.json (the file name is also the key id)
+
+Key rotation (oidc-manage keyrotate) adds a new key, the most recent active
+key signs the new tokens. A retired key stays published
+oidc.signing_keys.overlap seconds so that the tokens it signed can still be
+verified.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import binascii
+import threading
+
+from jwkest.jwk import (
+    keyrep,
+    ECKey,
+    RSAKey,
+)
+from jwkest.ecc import NISTEllipticCurve
+
+try:
+    from Cryptodome.PublicKey import RSA
+except ImportError:
+    from Crypto.PublicKey import RSA
+
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+MAC = 'HS256'
+ASYMMETRIC_ALGS = ('RS256', 'ES256')
+SUFFIX = '.json'
+
+
+def _generate_key_object(alg, kid):
+    """
+    Generate a new jwkest key object for the given algorithm
+    """
+    if alg == 'RS256':
+        return RSAKey(key=RSA.generate(2048), kid=kid, alg=alg, use='sig')
+    elif alg == 'ES256':
+        curve = NISTEllipticCurve.by_name('P-256')
+        private, public = curve.key_pair()
+        return ECKey(
+            x=public[0],
+            y=public[1],
+            d=private,
+            crv='P-256',
+            kid=kid,
+            alg=alg,
+            use='sig',
+        )
+    raise KeyError(u"Unsupported signing algorithm %s" % alg)
+
+
+class SigningKey(object):
+    """
+    A provider signing key loaded from a JWK file
+    """
+    def __init__(self, kid, activation, jwk):
+        self.kid = kid
+        self.activation = activation
+        self.alg = jwk.get('alg')
+        self.key = keyrep(jwk)
+        self.key.kid = kid
+
+    def __repr__(self):
+        return "<SigningKey %s %s>" % (self.kid, self.alg)
+
+    def public_jwk(self):
+        """
+        Return the public part of the key as a JWK dict
+        """
+        result = self.key.serialize(private=False)
+        result['kid'] = self.kid
+        result['alg'] = self.alg
+        result['use'] = 'sig'
+        return result
+
+
+class KeySet(object):
+    """
+    The provider's signing keys
+
+    The key directory is checked (at most once every check_interval seconds)
+    so that keys added by another process are loaded.
+    """
+    def __init__(self, alg=MAC, key_dir=None, overlap=24 * 60 * 60,
+                 check_interval=10):
+        self.alg = alg
+        self.key_dir = key_dir
+        self.overlap = overlap
+        self.check_interval = check_interval
+        self._keys = []
+        self._dir_stamp = None
+        self._checked_at = 0
+        self._jwks_cache = None
+        self._lock = threading.Lock()
+
+    def configure(self, alg=None, key_dir=None, overlap=None):
+        if alg is not None:
+            if alg != MAC and alg not in ASYMMETRIC_ALGS:
+                raise KeyError(u"Unsupported signing algorithm %s" % alg)
+            self.alg = alg
+        self.key_dir = key_dir
+        if overlap is not None:
+            self.overlap = int(overlap)
+        self._dir_stamp = None
+        self._checked_at = 0
+        self._keys = []
+        self._jwks_cache = None
+
+    def is_symmetric(self):
+        return self.alg == MAC
+
+    def _read_dir_stamp(self):
+        try:
+            return os.stat(self.key_dir).st_mtime
+        except OSError:
+            return None
+
+    def _check_dir(self):
+        if not self.key_dir:
+            return
+        now = time.time()
+        if now - self._checked_at < self.check_interval and self._keys:
+            return
+        self._checked_at = now
+        stamp = self._read_dir_stamp()
+        if stamp != self._dir_stamp:
+            self.load()
+            self._dir_stamp = stamp
+
+    def load(self):
+        """
+        Load all the keys stored in the key directory
+        """
+        keys = []
+        for filename in os.listdir(self.key_dir):
+            if not filename.endswith(SUFFIX):
+                continue
+            kid = filename[:-len(SUFFIX)]
+            try:
+                activation = int(kid.split('-', 1)[0])
+                with open(os.path.join(self.key_dir, filename)) as fbuf:
+                    jwk = json.load(fbuf)
+                keys.append(SigningKey(kid, activation, jwk))
+            except Exception:
+                logger.exception(u"Unable to load the signing key %s", kid)
+        keys.sort(key=lambda key: key.activation)
+        with self._lock:
+            self._keys = keys
+            self._jwks_cache = None
+        logger.debug(u"%s signing keys loaded", len(keys))
+
+    def generate_key(self, alg=None, activation=None):
+        """
+        Generate a new key and store it in the key directory
+
+        :param str alg: RS256 or ES256 (default : the configured algorithm)
+        :param int activation: The timestamp from which the key is used to
+        sign the tokens (default : now)
+        :returns: The new SigningKey
+        """
+        if alg is None:
+            alg = self.alg
+        if activation is None:
+            activation = int(time.time())
+        if not self.key_dir:
+            raise KeyError(u"Missing oidc.signing_keys.dir setting")
+
+        kid = u"%d-%s" % (
+            activation, binascii.hexlify(os.urandom(4)).decode('ascii')
+        )
+        key_object = _generate_key_object(alg, kid)
+        jwk = key_object.serialize(private=True)
+        jwk['kid'] = kid
+        jwk['alg'] = alg
+
+        if not os.path.isdir(self.key_dir):
+            os.makedirs(self.key_dir, 0o700)
+        path = os.path.join(self.key_dir, kid + SUFFIX)
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as fbuf:
+            json.dump(jwk, fbuf)
+        os.rename(tmp_path, path)
+        logger.info(u"New %s signing key %s generated", alg, kid)
+
+        self.load()
+        self._dir_stamp = self._read_dir_stamp()
+        return self.get_key(kid)
+
+    def get_key(self, kid):
+        for key in self._keys:
+            if key.kid == kid:
+                return key
+        return None
+
+    def get_signing_key(self, now=None):
+        """
+        Return the most recent active key matching the configured algorithm
+
+        :rtype: SigningKey
+        :raises: KeyError if no key is available
+        """
+        self._check_dir()
+        if now is None:
+            now = time.time()
+        for key in reversed(self._keys):
+            if key.activation <= now and key.alg == self.alg:
+                return key
+        raise KeyError(u"No active %s signing key" % self.alg)
+
+    def published_keys(self, now=None):
+        """
+        Return the keys that should be published :
+
+            - The keys that aren't active yet
+            - The active key
+            - The retired keys for oidc.signing_keys.overlap seconds
+        """
+        self._check_dir()
+        if now is None:
+            now = time.time()
+        result = []
+        keys = self._keys
+        for index, key in enumerate(keys):
+            successors = [
+                successor for successor in keys[index + 1:]
+                if successor.alg == key.alg and successor.activation <= now
+            ]
+            if not successors:
+                result.append(key)
+            elif successors[0].activation + self.overlap > now:
+                result.append(key)
+        return result
+
+    def get_jwks(self, now=None):
+        """
+        Return the serialized public key set and its etag
+
+        :returns: A 2-uple (json body, etag)
+        :rtype: tuple
+        """
+        kids = tuple(key.kid for key in self.published_keys(now))
+        cache = self._jwks_cache
+        if cache is None or cache[0] != kids:
+            body = json.dumps(
+                {
+                    'keys': [
+                        self.get_key(kid).public_jwk() for kid in kids
+                    ]
+                },
+                sort_keys=True,
+            )
+            etag = hashlib.sha1(body).hexdigest()
+            cache = self._jwks_cache = (kids, body, etag)
+        return cache[1], cache[2]
+
+    def prune(self, now=None):
+        """
+        Delete the key files that aren't published anymore
+
+        :returns: The list of deleted key ids
+        """
+        published = set(key.kid for key in self.published_keys(now))
+        deleted = []
+        for key in self._keys:
+            if key.kid not in published:
+                os.remove(os.path.join(self.key_dir, key.kid + SUFFIX))
+                deleted.append(key.kid)
+        if deleted:
+            self.load()
+        return deleted
+
+    def ensure_key(self):
+        """
+        Generate a first key if no key is active for the configured algorithm
+        """
+        if self.is_symmetric():
+            return
+        try:
+            self.get_signing_key()
+        except KeyError:
+            self.generate_key()
+
+
+SIGNING_KEYS = KeySet()
+
+
+def get_jwks_max_age(settings):
+    """
+    Return the number of seconds relying parties may cache the key set
+    (oidc.jwks.max_age, default 3600)
+    """
+    return int(oidc_settings(settings, 'jwks.max_age', 3600))
+
+
+def includeme(config):
+    """
+    Configure the signing keys regarding the current settings
+
+        oidc.id_token.signing_alg
+
+            HS256 (default, signed with the client secret), RS256 or ES256
+
+        oidc.signing_keys.dir
+
+            Directory where the provider keys are stored (mandatory with RS256
+            and ES256)
+
+        oidc.signing_keys.overlap
+
+            Number of seconds a retired key stays published (default 86400),
+            should be longer than the id tokens lifetime and the jwks cache
+            max age
+    """
+    settings = config.get_settings()
+    SIGNING_KEYS.configure(
+        alg=oidc_settings(settings, 'id_token.signing_alg'),
+        key_dir=oidc_settings(settings, 'signing_keys.dir'),
+        overlap=oidc_settings(settings, 'signing_keys.overlap'),
+    )
+    SIGNING_KEYS.ensure_key()
@@ -4,6 +4,7 @@
 #       * Arezki Feth <f.a@majerti.fr>;
 #       * Miotte Julien <j.m@majerti.fr>;
 import datetime
+import logging
 import deform
 
 from jwkest.jws import (
@@ -14,26 +15,47 @@ from jwkest.jwk import SYMKey
 
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import and_
+from sqlalchemy import or_
 
 from sqlalchemy import Integer
 from sqlalchemy import Boolean
 from sqlalchemy import DateTime
 from sqlalchemy import Unicode
+from sqlalchemy.types import (
+    BINARY,
+    LargeBinary,
+    TypeDecorator,
+)
 
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import synonym
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from .util import (
     dt_to_timestamp,
 )
 
+from .cache import SECRET_CACHE
+from .keys import SIGNING_KEYS
+from .pool import DERIVATION_POOL
 from .generators import (
+    TOKEN_BYTES,
+    decode_token,
+    encode_token,
     gen_token,
     gen_client_id,
     gen_client_secret,
-    crypt_secret,
     gen_salt,
 )
+from .hashers import (
+    get_default_hasher,
+    identify_hasher,
+    needs_rehash,
+)
 
 from autonomie_base.models.base import (
     DBBASE,
@@ -42,7 +64,38 @@ from autonomie_base.models.base import (
 )
 
 
+logger = logging.getLogger(__name__)
+
+
+class Token(TypeDecorator):
+    """
+    Random tokens (codes, access and refresh tokens) stored as TOKEN_BYTES
+    raw bytes, handled as base64url strings (legacy hexadecimal tokens are
+    accepted as parameters)
+    """
+    impl = BINARY(TOKEN_BYTES)
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(LargeBinary())
+        return dialect.type_descriptor(BINARY(TOKEN_BYTES))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        # Values that aren't tokens never match (None)
+        return decode_token(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return encode_token(bytes(value))
+
+
 MAC = 'HS256'
+# Default lifetimes in seconds
+CODE_LIFETIME = 10 * 60
+ACCESS_TOKEN_LIFETIME = 60 * 60
 
 
 def get_client_by_client_id(client_id, valid=True):
@@ -74,7 +127,110 @@ def get_code_by_client_id(client_id, code):
     return query.first()
 
 
-class OidcClient(DBBASE):
+def get_code_for_exchange(client_id, code, redirect_uri=None):
+    """
+    Find a non-revoked code issued to a valid client, with its client, in one
+    query (used by the token endpoint)
+
+    :param str client_id: The client_id of the OidcClient (not its primary
+    key)
+    :param str code: The code to check
+    :param str redirect_uri: The redirect uri the code should have been
+    issued for
+    :returns: The OidcCode instance (its client is loaded) or None
+    :rtype: obj
+    """
+    query = OidcCode.query().join(OidcCode.client)
+    query = query.options(contains_eager(OidcCode.client))
+    query = query.filter(OidcCode.authcode == code)
+    query = query.filter(OidcCode.revoked == False)
+    query = query.filter(OidcClient.client_id == client_id)
+    query = query.filter(OidcClient.revoked == False)
+    if redirect_uri is not None:
+        query = query.filter(OidcCode.uri == redirect_uri)
+    return query.first()
+
+
+class ClientMixin(object):
+    """
+    Client behaviour shared by OidcClient and its read-only snapshots (see
+    registry.ClientEntry)
+
+    Classes using it provide the client_id, scopes, revoked, salt and
+    _client_secret attributes and a _upgrade_secret_hash(client_secret)
+    method storing a new hash of the (verified) secret produced with the
+    current hashing scheme (not declared abstract here : the declarative
+    metaclass of OidcClient can't be combined with abc.ABCMeta)
+    """
+    def get_scopes(self):
+        return self.scopes.split(' ')
+
+    @staticmethod
+    def _run_hasher(hasher, method, *args):
+        """
+        Run the given hasher method, expensive hashers are run in the
+        DERIVATION_POOL to bound the number of concurrent derivations
+
+        :raises: pool.PoolFull if too many derivations are pending
+        """
+        func = getattr(hasher, method)
+        if hasher.expensive:
+            return DERIVATION_POOL.run(func, *args)
+        else:
+            return func(*args)
+
+    def is_revoked(self):
+        """
+        Check if the current client is still valid
+        """
+        return self.revoked
+
+    def check_secret(self, client_secret, upgrade=True):
+        """
+        Check that the given secret matches the current one
+
+        :param str client_secret: The client secret transmitted by the Resource
+        Consumer
+        :param bool upgrade: Should an outdated hash be replaced (a write) ?
+        """
+        if SECRET_CACHE.is_verified(
+            self.client_id, client_secret, self._client_secret
+        ):
+            return True
+
+        result = self._run_hasher(
+            identify_hasher(self._client_secret),
+            'verify',
+            client_secret,
+            self._client_secret,
+            self.salt,
+        )
+        if result:
+            if needs_rehash(self._client_secret):
+                if not upgrade:
+                    # Not cached : the next upgrading check must run
+                    return result
+                logger.info(u"Upgrading the secret hash of %s", self.client_id)
+                self._upgrade_secret_hash(client_secret)
+            SECRET_CACHE.remember(
+                self.client_id, client_secret, self._client_secret
+            )
+        return result
+
+    def check_scope(self, scopes):
+        """
+        Check that the scopes are allowed for the current client
+
+        :param list scope: list of requested scopes
+        :returns: True / False
+        :rtype: bool
+        """
+        scopes = set(scopes)
+        allowed_scopes = set(self.get_scopes())
+        return scopes.issubset(allowed_scopes)
+
+
+class OidcClient(ClientMixin, DBBASE):
     __table_args__ = default_table_args,
     id = Column(
         Integer,
@@ -204,9 +360,6 @@ class OidcClient(DBBASE):
         if cert_salt:
             self.cert_salt = cert_salt
 
-    def get_scopes(self):
-        return self.scopes.split(' ')
-
     def new_client_secret(self):
         """
         Create a new client secret and stores its encrypted value in db
@@ -216,6 +369,7 @@ class OidcClient(DBBASE):
         """
         secret = gen_client_secret()
         self.client_secret = secret
+        SECRET_CACHE.invalidate(self.client_id)
         return secret
 
     def _get_client_secret(self):
@@ -232,13 +386,12 @@ class OidcClient(DBBASE):
         Returns a crypted version of the client_secret
 
         :param unicode client_secret: The clear client secret
-        :returns: A crypted client secret
+        :returns: A crypted client secret (see the hashers module for the
+        format)
         :rtype: unicode
+        :raises: pool.PoolFull if too many derivations are pending
         """
-        if isinstance(client_secret, unicode):
-            client_secret = client_secret.encode('utf-8')
-        client_secret = bytes(client_secret)
-        return crypt_secret(client_secret, self.salt)
+        return self._run_hasher(get_default_hasher(), 'encode', client_secret)
 
     def _set_client_secret(self, client_secret):
         """
@@ -249,41 +402,16 @@ class OidcClient(DBBASE):
     client_secret = synonym('_client_secret', descriptor=property(
         _get_client_secret, _set_client_secret))
 
+    def _upgrade_secret_hash(self, client_secret):
+        self.client_secret = client_secret
+
     def revoke(self):
         """
         Revoke the given client
         """
         self.revoked = True
         self.revocation_date = datetime.datetime.utcnow()
-
-    def is_revoked(self):
-        """
-        Check if the current client is still valid
-        """
-        return self.revoked
-
-    def check_secret(self, client_secret):
-        """
-        Check that the given secret matches the current one
-
-        :param str client_secret: The client secret transmitted by the Resource
-        Consumer
-        :param str salt: The salt used for encryption (see configuration)
-        """
-        encrypted = self._crypt_secret(client_secret)
-        return encrypted == self.client_secret
-
-    def check_scope(self, scopes):
-        """
-        Check that the scopes are allowed for the current client
-
-        :param list scope: list of requested scopes
-        :returns: True / False
-        :rtype: bool
-        """
-        scopes = set(scopes)
-        allowed_scopes = set(self.get_scopes())
-        return scopes.issubset(allowed_scopes)
+        SECRET_CACHE.invalidate(self.client_id)
 
 
 class OidcRedirectUri(DBBASE):
@@ -319,9 +447,9 @@ class OidcCode(DBBASE):
     __table_args__ = default_table_args
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
-    authcode = Column(Unicode(64), unique=True, nullable=False)
+    authcode = Column(Token(), unique=True, nullable=False)
     uri = Column(Unicode(255), nullable=False)
-    expires_in = Column(Integer, nullable=False, default=10*60)
+    expires_in = Column(Integer, nullable=False, default=CODE_LIFETIME)
     nonce = Column(Unicode(255))
     scopes = Column(Unicode(255))
 
@@ -329,17 +457,23 @@ class OidcCode(DBBASE):
     revocation_date = Column(DateTime)
 
     creation_date = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
 
-    client_id = Column(Integer, ForeignKey(OidcClient.id))
+    client_id = Column(Integer, ForeignKey(OidcClient.id), index=True)
     client = relationship(OidcClient)
 
     def __init__(self, client, user_id, uri, scopes):
-        self.client = client
+        self.client_id = client.id
         self.user_id = user_id
         self.uri = uri
         self.scopes = scopes
+        self.expires_in = CODE_LIFETIME
+        self.creation_date = datetime.datetime.utcnow()
+        self.expires_at = self.creation_date + datetime.timedelta(
+            seconds=self.expires_in
+        )
 
-        self.authcode = gen_token(self.client)
+        self.authcode = gen_token()
 
     def revoke(self):
         """
@@ -348,76 +482,221 @@ class OidcCode(DBBASE):
         self.revoked = True
         self.revocation_date = datetime.datetime.utcnow()
 
-    def is_revoked(self):
+    def get_expiry(self):
+        """
+        Return the date after which the code can't be used anymore
+
+        :rtype: datetime.datetime
         """
-        Check if the code is revoked or not
+        if self.expires_at is not None:
+            return self.expires_at
+        # Rows created before the expires_at column was added
+        return self.creation_date + datetime.timedelta(
+            seconds=self.expires_in
+        )
+
+    def is_expired(self, now=None):
+        """
+        Check if the code is expired (without revoking it)
 
         :rtype: bool
         """
-        if not self.revoked:
-            expiry = self.creation_date + datetime.timedelta(
-                minutes=self.expires_in
-            )
+        if now is None:
             now = datetime.datetime.utcnow()
-            if now > expiry:
-                self.revoke()
-                DBSESSION().merge(self)
+        return now > self.get_expiry()
 
-        return self.revoked
+    def consume(self, now=None):
+        """
+        Atomically mark the code as used
+
+        The row is only updated if it's neither revoked nor expired, two
+        concurrent exchanges of the same code can't both succeed (no table
+        lock, the affected row count tells who won)
+
+        :returns: True if this call consumed the code
+        :rtype: bool
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        # Rows created before the expires_at column was added
+        legacy_limit = now - datetime.timedelta(seconds=CODE_LIFETIME)
+        session = object_session(self) or DBSESSION()
+        query = session.query(OidcCode).filter(
+            OidcCode.id == self.id,
+            OidcCode.revoked == False,  # NOQA
+            or_(
+                OidcCode.expires_at > now,
+                and_(
+                    OidcCode.expires_at == None,  # NOQA
+                    OidcCode.creation_date > legacy_limit,
+                ),
+            ),
+        )
+        count = query.update(
+            {'revoked': True, 'revocation_date': now},
+            synchronize_session=False,
+        )
+        if count:
+            set_committed_value(self, 'revoked', True)
+            set_committed_value(self, 'revocation_date', now)
+        return count == 1
+
+    def is_revoked(self, now=None):
+        """
+        Check if the code is revoked or expired (nothing is written, expired
+        rows are purged by the janitor)
+
+        :rtype: bool
+        """
+        return bool(self.revoked) or self.is_expired(now)
 
 
 class OidcToken(DBBASE):
-    __table_args__ = default_table_args
+    __table_args__ = (
+        # Logout revokes all the tokens of a user for a client
+        Index('ix_oidc_token_user_id_client_id', 'user_id', 'client_id'),
+        default_table_args,
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
-    access_token = Column(Unicode(64), unique=True, nullable=False)
-    refresh_token = Column(Unicode(64), unique=True, nullable=False)
-    expires_in = Column(Integer, nullable=False, default=60*60)
+    access_token = Column(Token(), unique=True, nullable=False)
+    refresh_token = Column(Token(), unique=True, nullable=False)
+    expires_in = Column(
+        Integer, nullable=False, default=ACCESS_TOKEN_LIFETIME
+    )
 
     revoked = Column(Boolean, default=False)
     revocation_date = Column(DateTime)
+    # Set when the refresh token has been exchanged for a new token
+    rotated = Column(Boolean, default=False)
+    # The scopes granted to the token (kept when the token is refreshed)
+    scopes = Column(Unicode(255))
 
     creation_date = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
 
-    client_id = Column(Integer, ForeignKey(OidcClient.id))
+    client_id = Column(Integer, ForeignKey(OidcClient.id), index=True)
     client = relationship(OidcClient)
 
-    def __init__(self, client, user_id):
-        self.client = client
+    def __init__(self, client, user_id, scopes=None):
+        self.client_id = client.id
         self.user_id = user_id
+        self.scopes = scopes
+        self.expires_in = ACCESS_TOKEN_LIFETIME
+        self.creation_date = datetime.datetime.utcnow()
+        self.expires_at = self.creation_date + datetime.timedelta(
+            seconds=self.expires_in
+        )
 
-        self.access_token = gen_token(self.client)
-        self.refresh_token = gen_token(self.client)
+        self.access_token = gen_token()
+        self.refresh_token = gen_token()
 
     def revoke(self):
         self.revoked = True
         self.revocation_date = datetime.datetime.utcnow()
 
-    def is_revoked(self):
+    def get_scopes(self, client):
+        """
+        Return the scopes granted to the token, still allowed for its client
+
+        :param obj client: The token's OidcClient or registry.ClientEntry
+        :rtype: list
+        """
+        if not self.scopes:
+            # Rows created before the scopes column was added
+            return client.get_scopes()
+        return [
+            scope for scope in self.scopes.split(' ')
+            if client.check_scope([scope])
+        ]
+
+    def get_expiry(self):
+        """
+        Return the date after which the access token can't be used anymore
+
+        :rtype: datetime.datetime
+        """
+        if self.expires_at is not None:
+            return self.expires_at
+        # Rows created before the expires_at column was added
+        return self.creation_date + datetime.timedelta(
+            seconds=self.expires_in
+        )
+
+    def is_expired(self, now=None):
+        """
+        Check if the access token is expired (without revoking it)
+
+        :rtype: bool
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        return now > self.get_expiry()
+
+    def is_revoked(self, now=None):
         """
-        Check if the code is revoked or not
+        Check if the access token is revoked or expired (nothing is written,
+        expired rows are purged by the janitor)
 
         :rtype: bool
         """
-        if not self.revoked:
-            expiry = self.creation_date + \
-                datetime.timedelta(minutes=self.expires_in)
+        return bool(self.revoked) or self.is_expired(now)
+
+    def is_refresh_expired(self, lifetime, now=None):
+        """
+        Check if the refresh token is expired
 
+        :param int lifetime: The refresh token lifetime in seconds (0 : no
+        limit)
+        :rtype: bool
+        """
+        if not lifetime:
+            return False
+        if now is None:
             now = datetime.datetime.utcnow()
-            if now > expiry:
-                self.revoke()
-                DBSESSION().merge(self)
-        return self.revoked
+        return now > self.creation_date + datetime.timedelta(seconds=lifetime)
+
+    def rotate(self):
+        """
+        Atomically mark the refresh token as used (and the token as revoked)
 
-    def refresh(self):
+        The row is only updated if it's still active, two concurrent refresh
+        requests can't both succeed
+
+        :returns: True if this call rotated the token
+        :rtype: bool
         """
-        Generate a new token for this client.
+        now = datetime.datetime.utcnow()
+        query = DBSESSION().query(OidcToken).filter_by(
+            id=self.id,
+            revoked=False,
+            rotated=False,
+        )
+        count = query.update(
+            {'revoked': True, 'rotated': True, 'revocation_date': now},
+            synchronize_session=False,
+        )
+        if count:
+            for key, value in (
+                ('revoked', True), ('rotated', True), ('revocation_date', now)
+            ):
+                set_committed_value(self, key, value)
+        return count == 1
+
+    def refresh(self, client=None):
         """
+        Rotate the refresh token : revoke this token and generate a new one
+        for the same client, user and scopes
 
-        cls = self.__class__
-        self.revoke()
-        DBSESSION().merge(self)
-        return cls(self.client, self.user_id)
+        :param obj client: The token's client (loaded if not provided)
+        :returns: The new OidcToken or None if the refresh token was already
+        used
+        """
+        if client is None:
+            client = self.client
+        if not self.rotate():
+            return None
+        return self.__class__(client, self.user_id, self.scopes)
 
     def __json__(self, request):
         token = {
@@ -428,12 +707,17 @@ class OidcToken(DBBASE):
         }
         return token
 
-    def at_hash(self):
+    def at_hash(self, access_token=None):
         """
         Returns a "at_hash" as described here
         http://openid.net/specs/openid-connect-core-1_0.html#HybridIDToken
+
+        :param str access_token: The access token sent to the client if it
+        differs from the stored one (jwt format)
         """
-        return left_hash(self.access_token.encode("utf-8"), MAC)
+        if access_token is None:
+            access_token = self.access_token
+        return left_hash(access_token.encode("utf-8"), MAC)
 
     @classmethod
     def find(cls, token_str):
@@ -442,13 +726,157 @@ class OidcToken(DBBASE):
         token = token_query.first()
         return token
 
+    @classmethod
+    def find_by_refresh_token(cls, token_str):
+        """
+        Find the token matching the given refresh token (revoked ones
+        included, used for replay detection)
+        """
+        return cls.query().filter_by(refresh_token=token_str).first()
+
+
+def get_tokens_by_access_token(access_tokens):
+    """
+    Load the tokens matching the given access tokens in a single IN query
+
+    :param list access_tokens: The access_token values to look for
+    :returns: A dict access_token -> OidcToken
+    :rtype: dict
+    """
+    if not access_tokens:
+        return {}
+    query = OidcToken.query().filter(
+        OidcToken.access_token.in_(set(access_tokens))
+    )
+    return dict((token.access_token, token) for token in query)
+
+
+def revoke_user_tokens(user_id, client_id):
+    """
+    Revoke all the active tokens issued to a user for a given client in a
+    single UPDATE
+
+    :param int user_id: The user's id
+    :param int client_id: The OidcClient's primary key
+    :returns: The number of revoked tokens
+    :rtype: int
+    """
+    query = DBSESSION().query(OidcToken).filter_by(
+        user_id=user_id,
+        client_id=client_id,
+        revoked=False,
+    )
+    return query.update(
+        {'revoked': True, 'revocation_date': datetime.datetime.utcnow()},
+        synchronize_session=False,
+    )
+
+
+def revoke_tokens(client_id, token_values):
+    """
+    Revoke the tokens of a client matching the given access or refresh token
+    values in a single UPDATE
+
+    :param int client_id: The OidcClient's primary key (tokens issued to
+    other clients are left untouched)
+    :param list token_values: Access and/or refresh token values
+    :returns: The number of revoked tokens
+    :rtype: int
+    """
+    token_values = set(token_values)
+    if not token_values:
+        return 0
+    query = DBSESSION().query(OidcToken).filter(
+        OidcToken.client_id == client_id,
+        OidcToken.revoked == False,  # NOQA
+        or_(
+            OidcToken.access_token.in_(token_values),
+            OidcToken.refresh_token.in_(token_values),
+        ),
+    )
+    return query.update(
+        {'revoked': True, 'revocation_date': datetime.datetime.utcnow()},
+        synchronize_session=False,
+    )
+
+
+def _revoke_in_batches(model, criterion, batch_size, commit=None, now=None):
+    """
+    Revoke the non-revoked rows matching criterion, at most batch_size rows
+    per UPDATE (selected by primary key) so that each statement only locks a
+    bounded number of rows
+
+    :param obj model: OidcCode or OidcToken
+    :param obj criterion: The filter selecting the rows to revoke
+    :param func commit: Called after each batch (e.g transaction.commit to
+    release the locks between batches)
+    :returns: The number of revoked rows
+    :rtype: int
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    revoked = 0
+    while True:
+        session = DBSESSION()
+        ids = [
+            row[0] for row in session.query(model.id).filter(
+                criterion,
+                model.revoked == False,  # NOQA
+            ).limit(batch_size)
+        ]
+        if ids:
+            revoked += session.query(model).filter(
+                model.id.in_(ids),
+                model.revoked == False,  # NOQA
+            ).update(
+                {'revoked': True, 'revocation_date': now},
+                synchronize_session=False,
+            )
+            if commit is not None:
+                commit()
+        if len(ids) < batch_size:
+            return revoked
+
+
+def revoke_client_codes(client_id, batch_size=1000, commit=None, now=None):
+    """
+    Revoke the live authorization codes of a client in batches
+
+    :param int client_id: The OidcClient's primary key
+    :returns: The number of revoked codes
+    :rtype: int
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    criterion = and_(
+        OidcCode.client_id == client_id,
+        or_(
+            OidcCode.expires_at > now,
+            OidcCode.expires_at == None,  # NOQA
+        ),
+    )
+    return _revoke_in_batches(OidcCode, criterion, batch_size, commit, now)
+
+
+def revoke_client_tokens(client_id, batch_size=1000, commit=None, now=None):
+    """
+    Revoke the tokens of a client in batches (expired access tokens included,
+    their refresh token may still be valid)
+
+    :param int client_id: The OidcClient's primary key
+    :returns: The number of revoked tokens
+    :rtype: int
+    """
+    criterion = OidcToken.client_id == client_id
+    return _revoke_in_batches(OidcToken, criterion, batch_size, commit, now)
+
 
 class OidcIdToken(DBBASE):
     __table_args__ = default_table_args
     id = Column(Integer, primary_key=True)
     issuer = Column(Unicode(255), nullable=False)
     sub = Column(Unicode(255), nullable=False)
-    expiration_time = Column(DateTime)
+    expiration_time = Column(DateTime, index=True)
     issue_time = Column(DateTime)
 
     client_id = Column(Integer, ForeignKey(OidcClient.id))
@@ -458,8 +886,9 @@ class OidcIdToken(DBBASE):
     revocation_date = Column(DateTime)
 
     def __init__(self, issuer, client, code):
-        self.client = client
         self.client_id = client.id
+        # Avoid loading the client relationship to build the audience
+        self._aud = client.client_id
         self.sub = code.user_id
         self.issuer = issuer
         self.issue_time = datetime.datetime.utcnow()
@@ -470,17 +899,22 @@ class OidcIdToken(DBBASE):
         self.revoked = True
         self.revocation_date = datetime.datetime.utcnow()
 
-    def is_revoked(self):
-        if not self.revoked:
+    def is_revoked(self, now=None):
+        """
+        Check if the id token is revoked or expired (nothing is written)
+
+        :rtype: bool
+        """
+        if now is None:
             now = datetime.datetime.utcnow()
-            if self.expiration_time > now:
-                self.revoke()
-                DBSESSION().merge(self)
-        return self.revoked
+        return bool(self.revoked) or now > self.expiration_time
 
     @property
     def aud(self):
-        return self.client.client_id
+        aud = getattr(self, '_aud', None)
+        if aud is None:
+            aud = self.client.client_id
+        return aud
 
     def __json__(self, request, claims=None):
         result = {
@@ -510,7 +944,8 @@ class OidcIdToken(DBBASE):
 
     def __jwt__(self, request, claims, client_secret):
         """
-        Jwt tokens encoded with the client_secret as key
+        Jwt tokens encoded with the client_secret as key (HS256) or with the
+        provider's current signing key (RS256/ES256, see keys.py)
         :param obj request; The pyramid request object
         :param dict claims: Dict containing userdatas that should be added to
         the current request (standard claims are described here :
@@ -522,8 +957,41 @@ class OidcIdToken(DBBASE):
         :rtype: str
         """
         json_datas = self.__json__(request, claims)
-        _jws = JWS(json_datas, alg=MAC)
-        return _jws.sign_compact([self._get_key_object(client_secret)])
+        if SIGNING_KEYS.is_symmetric():
+            alg = MAC
+            key = self._get_key_object(client_secret)
+        else:
+            alg = SIGNING_KEYS.alg
+            key = SIGNING_KEYS.get_signing_key().key
+        _jws = JWS(json_datas, alg=alg)
+        return _jws.sign_compact([key])
+
+
+class OidcLogoutRetry(DBBASE):
+    """
+    Back-channel logout notification that couldn't be delivered, retried by
+    backchannel.BackChannelLogout.retry_pending
+    """
+    __table_args__ = default_table_args
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    client_id = Column(Integer, ForeignKey(OidcClient.id), nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, index=True)
+    last_error = Column(Unicode(255))
+    creation_date = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __init__(self, user_id, client_id, error=None, next_attempt_at=None):
+        self.user_id = user_id
+        self.client_id = client_id
+        self.attempts = 0
+        self.creation_date = datetime.datetime.utcnow()
+        self.next_attempt_at = next_attempt_at or self.creation_date
+        self.set_error(error)
+
+    def set_error(self, error):
+        if error is not None:
+            self.last_error = unicode(error)[:255]
 
 
 def includeme(config):
@@ -20,6 +20,16 @@ def customize_tmpl_api():
 
 
 def includeme(config):
+    # The OIDC tables may live in their own database (oidc.sqlalchemy.url)
+    config.include('autonomie_oidc_provider.database')
+    # Client secrets are hashed from the admin views, the hashing scheme
+    # should match the provider's one
+    config.include('autonomie_oidc_provider.hashers')
+    # Notify the provider's processes when clients are edited
+    config.include('autonomie_oidc_provider.registry')
+    # Revoking a client revokes its codes and tokens
+    config.include('autonomie_oidc_provider.token_store')
+    config.include('autonomie_oidc_provider.revocation')
     config.include('.security')
     config.include('.views.client')
     customize_tmpl_api()
@@ -30,12 +30,14 @@ from autonomie.views import (
     submit_btn,
 )
 from autonomie.views.admin import AdminIndexView
+from autonomie_oidc_provider.cache import SECRET_CACHE
 from autonomie_oidc_provider.models import (
     OidcClient,
 )
 from autonomie_oidc_provider.plugin.views.forms import (
     get_client_schema,
 )
+from autonomie_oidc_provider.revocation import REVOKER
 from autonomie.utils.widgets import Link
 
 logger = logging.getLogger('autonomie.oidc.plugin.views')
@@ -277,6 +279,14 @@ class ClientEditView(BaseAdminEditView):
     schema = get_client_schema()
     factory = OidcClient
 
+    def submit_success(self, appstruct):
+        """
+        Forget the previously verified credentials of the edited client
+        """
+        result = super(ClientEditView, self).submit_success(appstruct)
+        SECRET_CACHE.invalidate(self.context.client_id)
+        return result
+
 
 def client_revoke_view(context, request):
     """
@@ -286,9 +296,11 @@ def client_revoke_view(context, request):
     """
     context.revoke()
     request.dbsession.merge(context)
+    result = REVOKER.revoke_client_grants(context)
     request.session.flash(
-        u"Les droits de l'application {0} ont bien été supprimés.".format(
-            context.name
+        u"Les droits de l'application {0} ont bien été supprimés "
+        u"({1[tokens]} jeton(s) et {1[codes]} code(s) révoqués).".format(
+            context.name, result
         )
     )
     return HTTPFound(request.route_path(OIDC_CLIENT_URL))
@@ -305,6 +317,11 @@ def client_secret_refresh_view(context, request):
         context.revocation_date = None
 
     refresh_client_secret(request, context, newone=False)
+    # Revoke the grants obtained with the previous secret
+    result = REVOKER.revoke_client_grants(context)
+    request.session.flash(
+        u"{0[tokens]} jeton(s) et {0[codes]} code(s) révoqués".format(result)
+    )
 
     return HTTPFound(request.current_route_path(_query={}))
 
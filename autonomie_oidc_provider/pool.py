@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Bounded worker pools used to run CPU or IO bound jobs outside of the request
+threads
+"""
+import sys
+import time
+import logging
+import threading
+
+from six import reraise
+from six.moves import queue
+
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolFull(Exception):
+    """
+    Raised when a job is submitted to a pool whose queue is full
+    """
+
+
+class Job(object):
+    """
+    A job submitted to a WorkerPool
+    """
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.result = None
+        self.exc_info = None
+        self._done = threading.Event()
+
+    def run(self):
+        self.started_at = time.time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to be done and return its result
+
+        :raises: The exception raised by the job
+        """
+        self._done.wait(timeout)
+        if self.exc_info is not None:
+            reraise(*self.exc_info)
+        return self.result
+
+    def done(self):
+        return self._done.is_set()
+
+
+class WorkerPool(object):
+    """
+    A pool of daemon threads consuming jobs from a bounded queue
+
+    Jobs are rejected with PoolFull as soon as the queue is full so that
+    callers can fail fast instead of piling up.
+
+    A pool with a size of 0 runs the jobs synchronously in the calling thread
+    """
+    def __init__(self, name, size=2, queue_size=32):
+        self.name = name
+        self.size = size
+        self.queue_size = queue_size
+        self._queue = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {
+            'submitted': 0,
+            'rejected': 0,
+            'completed': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def configure(self, size=None, queue_size=None):
+        """
+        Change the pool bounds, running workers are stopped and will be
+        started again on next submission
+        """
+        self.shutdown()
+        with self._lock:
+            if size is not None:
+                self.size = int(size)
+            if queue_size is not None:
+                self.queue_size = int(queue_size)
+            self._reset_stats()
+
+    def _start(self):
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                for index in range(self.size):
+                    thread = threading.Thread(
+                        target=self._work,
+                        args=(self._queue,),
+                        name="%s-%s" % (self.name, index),
+                    )
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        return self._queue
+
+    def _work(self, job_queue):
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            job.run()
+            self._record(job)
+
+    def _record(self, job):
+        wait_time = job.started_at - job.enqueued_at
+        with self._lock:
+            self._stats['completed'] += 1
+            self._stats['wait_time_total'] += wait_time
+            if wait_time > self._stats['wait_time_max']:
+                self._stats['wait_time_max'] = wait_time
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Submit a job to the pool
+
+        :returns: A Job instance
+        :raises: PoolFull if the pool's queue is full
+        """
+        job = Job(func, args, kwargs)
+        if self.size <= 0:
+            job.run()
+            self._record(job)
+            return job
+
+        job_queue = self._queue or self._start()
+        try:
+            job_queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            logger.warn(u"The %s pool is full, rejecting the job", self.name)
+            raise PoolFull(self.name)
+
+        with self._lock:
+            self._stats['submitted'] += 1
+        return job
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run func in the pool and wait for its result
+        """
+        return self.submit(func, *args, **kwargs).wait()
+
+    def stats(self):
+        """
+        Return the pool's metrics
+
+        :rtype: dict
+        """
+        with self._lock:
+            result = dict(self._stats)
+        completed = result['completed']
+        if completed:
+            result['wait_time_avg'] = result['wait_time_total'] / completed
+        else:
+            result['wait_time_avg'] = 0.0
+        result['queued'] = self._queue.qsize() if self._queue else 0
+        return result
+
+    def shutdown(self):
+        """
+        Stop the running workers
+        """
+        with self._lock:
+            job_queue, threads = self._queue, self._threads
+            self._queue, self._threads = None, []
+        for thread in threads:
+            job_queue.put(None)
+
+
+DERIVATION_POOL = WorkerPool('secret-derivation')
+
+
+def includeme(config):
+    """
+    Configure the pools regarding the current settings
+
+        oidc.derivation_pool.size
+
+            Number of threads deriving client secrets (0 derives them in the
+            request thread)
+
+        oidc.derivation_pool.queue_size
+
+            Number of derivations waiting for a worker before new ones are
+            rejected
+    """
+    settings = config.get_settings()
+    DERIVATION_POOL.configure(
+        size=oidc_settings(settings, 'derivation_pool.size', 2),
+        queue_size=oidc_settings(settings, 'derivation_pool.queue_size', 32),
+    )
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Process local registry of the OidcClient instances
+
+The client table is tiny and almost never changes, the registry keeps
+read-only snapshots of all the clients so that client resolution doesn't hit
+the database on the authorize/token/userinfo hot path.
+
+The registry is reloaded (in one query) after :
+
+    - An OidcClient/OidcRedirectUri insert/update/delete in the current
+      process (SQLAlchemy events)
+    - A change of the stamp file's modification time (see
+      oidc.client_registry.stamp_file), touched on each change so that
+      changes made by another process (Autonomie's admin views, oidc-manage)
+      are seen
+    - oidc.client_registry.ttl seconds
+"""
+import os
+import time
+import logging
+import threading
+
+from six.moves.urllib.parse import (
+    urlparse,
+    parse_qsl,
+    urlencode,
+)
+from sqlalchemy import event
+from sqlalchemy.orm import (
+    joinedload,
+    object_session,
+    Session,
+)
+
+from autonomie_oidc_provider.models import (
+    ClientMixin,
+    OidcClient,
+    OidcRedirectUri,
+)
+from autonomie_oidc_provider.util import (
+    oidc_settings,
+    normalize_redirect_uri,
+)
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_INFO_KEY = 'oidc_client_registry_dirty'
+
+
+class RedirectUriEntry(object):
+    """
+    Read-only snapshot of an OidcRedirectUri with its parsed form
+    """
+    def __init__(self, redirect_uri):
+        self.id = redirect_uri.id
+        self.uri = redirect_uri.uri
+        self.parsed = urlparse(self.uri)
+        self.query_params = tuple(parse_qsl(self.parsed.query))
+
+    def __repr__(self):
+        return "<RedirectUriEntry %s>" % self.uri
+
+    def build_url(self, params):
+        """
+        Build the redirection url adding the given params to the ones of the
+        registered uri
+
+        :param dict params: The query params to add
+        :rtype: str
+        """
+        query_params = dict(self.query_params)
+        query_params.update(params)
+        return self.parsed._replace(
+            query=urlencode(query_params),
+            fragment='',
+        ).geturl()
+
+
+class ClientEntry(ClientMixin):
+    """
+    Read-only snapshot of an OidcClient
+    """
+    def __init__(self, client):
+        self.id = client.id
+        self.name = client.name
+        self.client_id = client.client_id
+        self._client_secret = client._client_secret
+        self.salt = client.salt
+        self.revoked = client.revoked
+        self.scopes = client.scopes
+        self.scope_set = frozenset(client.get_scopes())
+        self.logout_uri = client.logout_uri
+        self.redirect_uris = tuple(
+            redirect_uri.uri for redirect_uri in client.redirect_uris
+        )
+        self.redirect_index = dict(
+            (
+                normalize_redirect_uri(redirect_uri.uri),
+                RedirectUriEntry(redirect_uri),
+            )
+            for redirect_uri in client.redirect_uris
+        )
+
+    def __repr__(self):
+        return "<ClientEntry %s %s>" % (self.id, self.client_id)
+
+    def check_scope(self, scopes):
+        return self.scope_set.issuperset(scopes)
+
+    def get_redirect_uri(self, uri):
+        """
+        Return the registered redirect uri matching the given one
+
+        :param str uri: The redirect uri provided by the client
+        :returns: A RedirectUriEntry instance or None
+        """
+        return self.redirect_index.get(normalize_redirect_uri(uri))
+
+    def _upgrade_secret_hash(self, client_secret):
+        client = OidcClient.get(self.id)
+        client.client_secret = client_secret
+        self._client_secret = client._client_secret
+
+
+class ClientRegistry(object):
+    """
+    Registry of ClientEntry instances indexed by client_id and primary key
+    """
+    def __init__(self, ttl=300, stamp_file=None):
+        self.ttl = ttl
+        self.stamp_file = stamp_file
+        self._by_client_id = {}
+        self._by_id = {}
+        self._generation = 0
+        self._loaded_generation = None
+        self._loaded_at = 0
+        self._stamp = None
+        self._stamp_checked_at = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def configure(self, ttl=None, stamp_file=None):
+        if ttl is not None:
+            self.ttl = int(ttl)
+        self.stamp_file = stamp_file
+        self._stamp = self._read_stamp()
+        self.invalidate(touch=False)
+
+    def _read_stamp(self):
+        if not self.stamp_file:
+            return None
+        try:
+            return os.stat(self.stamp_file).st_mtime
+        except OSError:
+            return None
+
+    def _touch_stamp(self):
+        try:
+            with open(self.stamp_file, 'a'):
+                os.utime(self.stamp_file, None)
+        except (IOError, OSError):
+            logger.exception(
+                u"Unable to touch the client registry stamp file %s",
+                self.stamp_file,
+            )
+
+    def invalidate(self, touch=True):
+        """
+        Mark the registry as stale, it will be reloaded on next access
+
+        :param bool touch: Should other processes be notified (through the
+        stamp file) ?
+        """
+        with self._lock:
+            self._generation += 1
+        if touch and self.stamp_file:
+            self._touch_stamp()
+            self._stamp = self._read_stamp()
+
+    def _check_stamp(self):
+        """
+        Check (at most once per second) if another process changed the
+        clients
+        """
+        now = time.time()
+        if now - self._stamp_checked_at < 1:
+            return
+        self._stamp_checked_at = now
+        stamp = self._read_stamp()
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self.invalidate(touch=False)
+
+    def _is_stale(self):
+        if self.stamp_file:
+            self._check_stamp()
+        if self._loaded_generation != self._generation:
+            return True
+        return bool(self.ttl) and time.time() - self._loaded_at > self.ttl
+
+    def load(self):
+        """
+        Load all the clients and their redirect uris in one query
+        """
+        generation = self._generation
+        query = OidcClient.query().options(
+            joinedload(OidcClient.redirect_uris)
+        )
+        entries = [ClientEntry(client) for client in query]
+        by_client_id = dict((entry.client_id, entry) for entry in entries)
+        by_id = dict((entry.id, entry) for entry in entries)
+        with self._lock:
+            self._by_client_id = by_client_id
+            self._by_id = by_id
+            self._loaded_generation = generation
+            self._loaded_at = time.time()
+        logger.debug(u"%s oidc clients loaded", len(entries))
+
+    def warm(self):
+        """
+        Load the registry outside of any request (on startup)
+        """
+        import transaction
+        from autonomie_base.models.base import DBSESSION
+        try:
+            with transaction.manager:
+                self.load()
+        except Exception:
+            logger.exception(u"Unable to warm the oidc client registry")
+        finally:
+            DBSESSION.remove()
+
+    def _ensure_loaded(self):
+        if self._is_stale():
+            with self._load_lock:
+                if self._is_stale():
+                    self.load()
+
+    def _filter(self, entry, valid):
+        if entry is not None and valid and entry.is_revoked():
+            entry = None
+        return entry
+
+    def get(self, client_id, valid=True):
+        """
+        Return the client matching the given client_id
+
+        :param str client_id: The client_id to look for
+        :param bool valid: Only non-revoked clients ?
+        :returns: A ClientEntry instance (default None)
+        :rtype: obj
+        """
+        self._ensure_loaded()
+        return self._filter(self._by_client_id.get(client_id), valid)
+
+    def get_by_id(self, id_, valid=True):
+        """
+        Return the client matching the given primary key
+
+        :param int id_: The OidcClient.id to look for
+        :param bool valid: Only non-revoked clients ?
+        :returns: A ClientEntry instance (default None)
+        :rtype: obj
+        """
+        self._ensure_loaded()
+        return self._filter(self._by_id.get(id_), valid)
+
+
+CLIENT_REGISTRY = ClientRegistry()
+
+
+def get_client(client_id, valid=True):
+    """
+    Return the client matching the given client_id from the registry
+
+    :param str client_id: The client_id to look for
+    :param bool valid: Only non-revoked clients ?
+    :returns: A ClientEntry instance (default None)
+    :rtype: obj
+    """
+    return CLIENT_REGISTRY.get(client_id, valid)
+
+
+def on_client_change(mapper, connection, target):
+    """
+    Invalidate the registry when a client or a redirect uri is changed
+
+    The registry is invalidated right now and again when the transaction ends
+    so that a reload made before the commit doesn't keep stale datas
+    """
+    CLIENT_REGISTRY.invalidate()
+    session = object_session(target)
+    if session is not None:
+        session.info[SESSION_INFO_KEY] = True
+
+
+def on_transaction_end(session, *args):
+    if session.info.pop(SESSION_INFO_KEY, False):
+        CLIENT_REGISTRY.invalidate()
+
+
+for model in (OidcClient, OidcRedirectUri):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, event_name, on_client_change)
+event.listen(Session, 'after_commit', on_transaction_end)
+event.listen(Session, 'after_rollback', on_transaction_end)
+
+
+def includeme(config):
+    """
+    Configure the client registry regarding the current settings
+
+        oidc.client_registry.ttl
+
+            Max number of seconds a client snapshot is kept (0 : no limit)
+
+        oidc.client_registry.stamp_file
+
+            Path to a file touched on each client change, used to notify the
+            other processes sharing the database (should be set whenever
+            clients are managed from Autonomie)
+    """
+    settings = config.get_settings()
+    CLIENT_REGISTRY.configure(
+        ttl=oidc_settings(settings, 'client_registry.ttl', 300),
+        stamp_file=oidc_settings(settings, 'client_registry.stamp_file'),
+    )
+    if not CLIENT_REGISTRY.stamp_file:
+        logger.warn(
+            u"No oidc.client_registry.stamp_file : clients changed by "
+            u"another process are seen after %ss", CLIENT_REGISTRY.ttl
+        )
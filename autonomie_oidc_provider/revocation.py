@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Bulk revocation of the codes and tokens
+
+When a client is revoked or gets a new secret, all its live codes and tokens
+are revoked through set-based UPDATEs of at most batch_size rows (selected by
+primary key on the indexed client_id column) : the client's rows are never
+loaded and each statement only locks a bounded number of rows.
+
+The command line passes transaction.commit so that each batch is committed on
+its own. The admin views run the batches in the request's transaction.
+
+Stateless (jwe) codes can't be revoked, they're refused with their client
+(revoked client or new secret).
+"""
+import logging
+
+from autonomie_oidc_provider.models import revoke_client_codes
+from autonomie_oidc_provider.token_store import get_token_store
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class Revoker(object):
+    """
+    Revoke codes and tokens by sets
+    """
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+
+    def configure(self, batch_size=None):
+        if batch_size is not None:
+            self.batch_size = int(batch_size)
+
+    def revoke_client_grants(self, client, commit=None):
+        """
+        Revoke all the live codes and tokens issued to the given client
+
+        :param obj client: The OidcClient instance
+        :param func commit: Called after each batch (see
+        models._revoke_in_batches)
+        :returns: The number of revoked rows by kind ('codes' and 'tokens')
+        :rtype: dict
+        """
+        # Read before any commit expires the instance
+        client_id = client.id
+        result = {
+            'codes': revoke_client_codes(client_id, self.batch_size, commit),
+            'tokens': get_token_store().revoke_client_tokens(
+                client_id, self.batch_size, commit
+            ),
+        }
+        logger.info(
+            u"Client %s : %s codes and %s tokens revoked",
+            client_id, result['codes'], result['tokens'],
+        )
+        return result
+
+
+REVOKER = Revoker()
+
+
+def includeme(config):
+    """
+    Configure the bulk revocation regarding the current settings
+
+        oidc.revocation.batch_size
+
+            Max number of rows revoked by UPDATE (default 1000)
+    """
+    settings = config.get_settings()
+    REVOKER.configure(
+        batch_size=oidc_settings(settings, 'revocation.batch_size'),
+    )
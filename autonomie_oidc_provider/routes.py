@@ -6,3 +6,7 @@ def includeme(config):
     config.add_route('/logout', '/logout')
     config.add_route('/token', '/token')
     config.add_route('/userinfo', '/userinfo')
+    config.add_route('/introspect', '/introspect')
+    config.add_route('/introspect/batch', '/introspect/batch')
+    config.add_route('/revoke', '/revoke')
+    config.add_route('/jwks', '/jwks')
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Schema upgrade of the existing databases
+
+New databases get the full schema from create_all. On databases created by a
+previous version, the columns, indexes and tables added since are created by
+"oidc-manage <config_uri> schemamigrate" (to be run before starting the new
+version, along with tokenmigrate). Each change is skipped if it's already
+applied : the command can be run several times.
+
+New columns are nullable, the ones with a scalar default get it on the
+existing rows.
+"""
+import logging
+
+from sqlalchemy import inspect
+
+from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.models import (
+    OidcCode,
+    OidcIdToken,
+    OidcLogoutRetry,
+    OidcToken,
+)
+
+
+logger = logging.getLogger(__name__)
+
+TABLES = (
+    OidcLogoutRetry,
+)
+# (model, column name)
+COLUMNS = (
+    (OidcToken, 'rotated'),
+    (OidcToken, 'scopes'),
+    (OidcCode, 'expires_at'),
+    (OidcToken, 'expires_at'),
+)
+# (model, indexed column names)
+INDEXES = (
+    (OidcCode, ('expires_at',)),
+    (OidcCode, ('client_id',)),
+    (OidcToken, ('expires_at',)),
+    (OidcToken, ('client_id',)),
+    (OidcToken, ('user_id', 'client_id')),
+    (OidcIdToken, ('expiration_time',)),
+)
+
+
+def _quote(engine, name):
+    return engine.dialect.identifier_preparer.quote(name)
+
+
+def add_column(engine, table, column_name):
+    """
+    Add the given column of the table if it's missing
+
+    :returns: True if the column was added
+    :rtype: bool
+    """
+    existing = set(
+        column['name'] for column in inspect(engine).get_columns(table.name)
+    )
+    if column_name in existing:
+        return False
+    column = table.c[column_name]
+    with engine.begin() as connection:
+        connection.execute(
+            "ALTER TABLE %s ADD COLUMN %s %s" % (
+                _quote(engine, table.name),
+                _quote(engine, column_name),
+                column.type.compile(dialect=engine.dialect),
+            )
+        )
+        if column.default is not None and column.default.is_scalar:
+            connection.execute(
+                table.update().where(column == None).values(  # NOQA
+                    {column_name: column.default.arg}
+                )
+            )
+    return True
+
+
+def add_index(engine, table, column_names):
+    """
+    Create the index of the table on the given columns if there is no index
+    on those columns yet (whatever its name)
+
+    :returns: True if the index was created
+    :rtype: bool
+    """
+    column_names = list(column_names)
+    for index in inspect(engine).get_indexes(table.name):
+        if index['column_names'] == column_names:
+            return False
+    for index in table.indexes:
+        if [column.name for column in index.columns] == column_names:
+            index.create(bind=engine)
+            return True
+    raise KeyError(
+        u"No index on %s(%s)" % (table.name, u", ".join(column_names))
+    )
+
+
+def add_table(engine, table):
+    """
+    Create the given table (and its indexes) if it's missing
+
+    :returns: True if the table was created
+    :rtype: bool
+    """
+    if table.name in inspect(engine).get_table_names():
+        return False
+    table.create(bind=engine)
+    return True
+
+
+def migrate_schema():
+    """
+    Apply the missing changes (on the database each model is bound to)
+
+    :returns: The applied changes
+    :rtype: list
+    """
+    result = []
+    for model in TABLES:
+        engine = DBSESSION().get_bind(mapper=inspect(model))
+        table = model.__table__
+        if add_table(engine, table):
+            change = "%s created" % table.name
+            logger.info(change)
+            result.append(change)
+    for model, column_name in COLUMNS:
+        engine = DBSESSION().get_bind(mapper=inspect(model))
+        table = model.__table__
+        if add_column(engine, table, column_name):
+            change = "%s.%s added" % (table.name, column_name)
+            logger.info(change)
+            result.append(change)
+    for model, column_names in INDEXES:
+        engine = DBSESSION().get_bind(mapper=inspect(model))
+        table = model.__table__
+        if add_index(engine, table, column_names):
+            change = "%s(%s) index created" % (
+                table.name, ", ".join(column_names)
+            )
+            logger.info(change)
+            result.append(change)
+    return result
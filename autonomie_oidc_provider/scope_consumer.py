@@ -5,9 +5,35 @@
 #       * Miotte Julien <j.m@majerti.fr>;
 import datetime
 
+from sqlalchemy import (
+    event,
+    inspect,
+)
+from sqlalchemy.orm import (
+    joinedload,
+    load_only,
+    object_session,
+    Session,
+)
+
+try:
+    from sqlalchemy.orm import selectinload
+except ImportError:
+    # SQLAlchemy < 1.2
+    from sqlalchemy.orm import subqueryload as selectinload
+
 from autonomie_base.utils.date import format_short_date
 from autonomie.models.user.user import User
 
+try:
+    from autonomie.models.user.login import Login
+except ImportError:
+    Login = None
+
+from autonomie_oidc_provider.cache import CLAIM_CACHE
+
+SESSION_INFO_KEY = 'oidc_claim_cache_dirty'
+
 FORMATTERS = {
     long: int,
     datetime.date: format_short_date,
@@ -27,63 +53,163 @@ def format_res_for_encoding(res):
     return res
 
 
+def _to_serializable(data):
+    if hasattr(data, '__json__'):
+        data = data.__json__(None)
+    return data
+
+
+def format_value(data):
+    """
+    Generic formatter : serialize the value (or the items of a list value)
+    and format it for json encoding
+    """
+    if isinstance(data, list):
+        data = [_to_serializable(item) for item in data]
+    else:
+        data = _to_serializable(data)
+    return format_res_for_encoding(data)
+
+
+def format_int(data):
+    if isinstance(data, long):
+        data = int(data)
+    return data
+
+
+def format_date(data):
+    if isinstance(data, datetime.date):
+        data = format_short_date(data)
+    return data
+
+
+def format_identity(data):
+    return data
+
+
+def _column_formatter(column):
+    """
+    Return the formatter matching the column's type
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return format_value
+    if issubclass(python_type, datetime.date):
+        return format_date
+    elif issubclass(python_type, (int, long)) and python_type is not bool:
+        return format_int
+    elif issubclass(python_type, (basestring, bool, float)):
+        return format_identity
+    return format_value
+
+
+def _build_accessor(data_key):
+    """
+    Build the function returning the value pointed by data_key on a user
+    object
+    """
+    if '.' not in data_key:
+        return lambda obj: getattr(obj, data_key, '')
+
+    path = tuple(data_key.split('.'))
+
+    def accessor(obj):
+        for segment in path:
+            obj = getattr(obj, segment, None)
+        return obj
+    return accessor
+
+
+def _empty_accessor(obj):
+    # Not implemented
+    return ''
+
+
+class ScopePlan(object):
+    """
+    Compiled form of a Scope : one accessor and one formatter per attribute,
+    the User columns to load and the User relationships that should be eager
+    loaded
+
+    When one of the attributes isn't a mapped column (a python property) and
+    the scope doesn't declare its dependencies, the whole row is needed
+    (full_row)
+    """
+    def __init__(self, scope, model):
+        mapper = inspect(model)
+        steps = []
+        columns = set()
+        relationships = set()
+        full_row = False
+        for label, data_key in scope.attributes:
+            if not data_key:
+                steps.append((label, _empty_accessor, format_identity))
+                continue
+
+            attribute = data_key.split('.', 1)[0]
+            formatter = format_value
+            if attribute in mapper.relationships:
+                relationships.add(attribute)
+            elif attribute in mapper.column_attrs:
+                columns.add(attribute)
+                if '.' not in data_key:
+                    formatter = _column_formatter(
+                        mapper.column_attrs[attribute].columns[0]
+                    )
+            elif attribute in scope.dependencies:
+                for dependency in scope.dependencies[attribute]:
+                    if dependency in mapper.relationships:
+                        relationships.add(dependency)
+                    else:
+                        columns.add(dependency)
+            else:
+                full_row = True
+            steps.append((label, _build_accessor(data_key), formatter))
+
+        if scope.relationships is not None:
+            relationships = set(scope.relationships)
+
+        self.key = scope.key
+        self.steps = tuple(steps)
+        self.columns = frozenset(columns)
+        self.relationships = frozenset(relationships)
+        self.full_row = full_row
+
+    def extract(self, user_object):
+        return dict(
+            (label, formatter(accessor(user_object)))
+            for label, accessor, formatter in self.steps
+        )
+
+
 class Scope(object):
     key = None
     attributes = ()
+    # The User columns and relationships needed by the python properties
+    # used as attributes (the others are inferred from the mapping)
+    dependencies = {}
+    # The User relationships needed by the attributes, inferred from the
+    # attributes if None
+    relationships = None
+    _plan = None
 
-    def _produce_from_dotted_key(self, data_key, user_object):
+    @classmethod
+    def get_plan(cls):
         """
-        Produce an attribute's value based on a dotted data key (that allows to
-        access related elements)
-        """
-        path = data_key.split('.')
-        data = user_object
-        for segment in path:
-            data = getattr(data, segment, None)
-        data = self._process_complex_value(data)
-        return data
-
-    def _process_serializable_object(self, data):
-        result = data
-        if hasattr(data, '__json__'):
-            result = data.__json__(None)
-        return result
-
-    def _process_list_value(self, data):
-        result = []
-        for d in data:
-            result.append(self._process_serializable_object(d))
-        return result
+        Return the compiled extraction plan of this scope (compiled on first
+        call)
 
-    def _process_complex_value(self, data):
+        :rtype: ScopePlan
         """
-        Process specific case of complex datas
-        :param data: The data to process
-        """
-        if isinstance(data, list):
-            data = self._process_list_value(data)
-        else:
-            data = self._process_serializable_object(data)
-        return data
+        plan = cls.__dict__.get('_plan')
+        if plan is None:
+            plan = ScopePlan(cls, User)
+            cls._plan = plan
+        return plan
 
     def produce(self, user_object):
-        res = {}
-        for label, data_key in self.attributes:
-            if data_key:
-                if '.' in data_key:
-                    data_value = self._produce_from_dotted_key(
-                        data_key,
-                        user_object
-                    )
-                else:
-                    data_value = getattr(user_object, data_key, '')
-                    data_value = self._process_complex_value(data_value)
-                res[label] = data_value
-            else:
-                # Not implemented
-                res[label] = ''
-        res = format_res_for_encoding(res)
-        return res
+        return self.get_plan().extract(user_object)
 
 
 class OpenIdScope(Scope):
@@ -104,24 +230,143 @@ class ProfileScope(Scope):
         ('login', 'login.login'),
         ('groups', '_groups'),
     )
+    dependencies = {
+        'label': ('firstname', 'lastname'),
+    }
+
+
+SCOPES = dict((scope.key, scope) for scope in (OpenIdScope, ProfileScope))
+
+
+def compile_plans():
+    """
+    Compile the extraction plans of all the scopes (called on startup)
+    """
+    for scope in SCOPES.values():
+        scope.get_plan()
+
+
+class UserStub(object):
+    """
+    Stands for the User when the requested scopes only need its id
+    """
+    def __init__(self, id_):
+        self.id = id_
+
+
+def _relationship_loader(relationship):
+    """
+    Return the loader option for the given User relationship : collections
+    are loaded in a second IN query, scalars are joined
+    """
+    if inspect(User).relationships[relationship].uselist:
+        return selectinload(getattr(User, relationship))
+    return joinedload(getattr(User, relationship))
+
+
+def load_user(user_id, plans):
+    """
+    Load the User with only the columns and relationships needed by the given
+    plans
+
+    :param int user_id: The user's id
+    :param list plans: The ScopePlan instances
+    :returns: A User, a UserStub if only the id is needed
+    """
+    columns = set()
+    relationships = set()
+    full_row = False
+    for plan in plans:
+        columns.update(plan.columns)
+        relationships.update(plan.relationships)
+        full_row = full_row or plan.full_row
+
+    primary_key = inspect(User).primary_key[0].key
+    if not full_row and not relationships and columns <= set([primary_key]):
+        return UserStub(user_id)
+
+    query = User.query().filter(User.id == user_id)
+    if not full_row:
+        query = query.options(load_only(*sorted(columns)))
+    for relationship in sorted(relationships):
+        query = query.options(_relationship_loader(relationship))
+    return query.first()
 
 
 def collect_claims(user_id, scopes):
     """
     Collect the claims described by the requested scopes for the given user_id
 
+    The User table is only queried if the requested scopes need more than the
+    user's id, and then only for the columns and relationships they declare
+
     :param int user_id: The id of the user
     :param list scopes: The list of scopes we want to collect claims for
     :returns: The claims
     :rtype: dict
     """
+    result = CLAIM_CACHE.get(user_id, scopes)
+    if result is not None:
+        return result
+
+    plans = [SCOPES[scope].get_plan() for scope in scopes if scope in SCOPES]
+    user = load_user(user_id, plans)
+
     result = {}
-    user = User.get(user_id)
-    for scope in scopes:
-        if scope == 'profile':
-            factory = ProfileScope()
-            result.update(factory.produce(user))
-        elif scope == 'openid':
-            factory = OpenIdScope()
-            result.update(factory.produce(user))
+    for plan in plans:
+        result.update(plan.extract(user))
+    CLAIM_CACHE.set(user_id, scopes, result)
     return result
+
+
+def _invalidate_user(target, user_id):
+    """
+    Drop the cached claims of the given user now and when the current
+    transaction ends (a request could cache the old datas in between)
+    """
+    if user_id is None:
+        return
+    CLAIM_CACHE.invalidate(user_id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(SESSION_INFO_KEY, set()).add(user_id)
+
+
+def on_user_change(mapper, connection, target):
+    _invalidate_user(target, target.id)
+
+
+def on_login_change(mapper, connection, target):
+    _invalidate_user(target, target.user_id)
+
+
+def on_user_groups_change(target, value, initiator):
+    _invalidate_user(target, target.id)
+
+
+def on_login_groups_change(target, value, initiator):
+    _invalidate_user(target, target.user_id)
+
+
+def on_transaction_end(session, *args):
+    for user_id in session.info.pop(SESSION_INFO_KEY, ()):
+        CLAIM_CACHE.invalidate(user_id)
+
+
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(User, event_name, on_user_change)
+    if Login is not None:
+        event.listen(Login, event_name, on_login_change)
+
+for model, listener in (
+    (User, on_user_groups_change),
+    (Login, on_login_groups_change),
+):
+    # Group membership is stored on User or Login depending on the Autonomie
+    # version
+    if model is not None and hasattr(model, '_groups'):
+        event.listen(model._groups, 'append', listener)
+        event.listen(model._groups, 'remove', listener)
+
+event.listen(Session, 'after_commit', on_transaction_end)
+event.listen(Session, 'after_rollback', on_transaction_end)
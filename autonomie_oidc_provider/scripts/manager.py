@@ -8,6 +8,8 @@ from autonomie.scripts.utils import (
     get_value,
 )
 
+REVOKED_TMPL = "{tokens} tokens and {codes} codes revoked"
+
 
 def add_client_command(args, env):
     """
@@ -21,6 +23,7 @@ def add_client_command(args, env):
         OidcClient,
         OidcRedirectUri,
     )
+    from autonomie_oidc_provider.registry import CLIENT_REGISTRY
     redirect_uri = get_value(args, 'uri')
     client_name = get_value(args, 'client')
     client_scopes = get_value(args, 'scopes')
@@ -52,6 +55,8 @@ def add_client_command(args, env):
     db.flush()
     redirecturi = OidcRedirectUri(client=client, uri=redirect_uri)
     db.add(redirecturi)
+    db.flush()
+    CLIENT_REGISTRY.invalidate()
     print(
         """New client {client.name} created :
 
@@ -72,10 +77,13 @@ def revoke_client_command(args, env):
     :param dict args: The arguments passed by command line
     :param dict env: an environment dict (pyramid_env returned after bootstrap)
     """
+    import transaction
     from autonomie_base.models.base import DBSESSION
     from autonomie_oidc_provider.models import (
         OidcClient,
     )
+    from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+    from autonomie_oidc_provider.revocation import REVOKER
     client_id = get_value(args, 'client_id')
 
     if client_id is None:
@@ -90,11 +98,16 @@ def revoke_client_command(args, env):
     client.revoke()
     db.merge(client)
     db.flush()
-
-    print(
-        """The client {client.name} with id {client.client_id} has been revoked
-        """.format(client=client)
+    CLIENT_REGISTRY.invalidate()
+    message = (
+        "The client {client.name} with id {client.client_id} has been "
+        "revoked".format(client=client)
     )
+    # Each batch is committed on its own, the revoked client with the first
+    result = REVOKER.revoke_client_grants(client, commit=transaction.commit)
+
+    print(message)
+    print(REVOKED_TMPL.format(**result))
 
 
 def refresh_secret_command(args, env):
@@ -104,10 +117,13 @@ def refresh_secret_command(args, env):
     :param dict args: The arguments passed by command line
     :param dict env: an environment dict (pyramid_env returned after bootstrap)
     """
+    import transaction
     from autonomie_base.models.base import DBSESSION
     from autonomie_oidc_provider.models import (
         OidcClient,
     )
+    from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+    from autonomie_oidc_provider.revocation import REVOKER
     client_id = get_value(args, 'client_id')
 
     if client_id is None:
@@ -123,9 +139,8 @@ def refresh_secret_command(args, env):
     client.revoked = False
     db.merge(client)
     db.flush()
-
-    print(
-        """New secret token generated for "{client.name}" :
+    CLIENT_REGISTRY.invalidate()
+    message = """New secret token generated for "{client.name}" :
 
         OpenId connect tokens :
           client id : {client.client_id}
@@ -134,6 +149,110 @@ def refresh_secret_command(args, env):
           WARNING : Those informations should be kept confidential since they
           are identification tokens
         """.format(client=client, secret=secret)
+    result = REVOKER.revoke_client_grants(client, commit=transaction.commit)
+
+    print(message)
+    print(REVOKED_TMPL.format(**result))
+
+
+def rotate_key_command(args, env):
+    """
+    Add a new id token signing key, the keys that aren't published anymore
+    are deleted
+
+    :param dict args: The arguments passed by command line
+    :param dict env: an environment dict (pyramid_env returned after bootstrap)
+    """
+    import time
+    from autonomie_oidc_provider.keys import (
+        SIGNING_KEYS,
+        get_jwks_max_age,
+    )
+    # By default, wait until the relying parties' cached key sets expire
+    activate_in = int(
+        get_value(args, 'activate_in', None) or
+        get_jwks_max_age(env['registry'].settings)
+    )
+
+    if SIGNING_KEYS.is_symmetric():
+        raise KeyError(
+            "Id tokens are signed with the client secrets, set the "
+            "oidc.id_token.signing_alg setting to RS256 or ES256"
+        )
+
+    key = SIGNING_KEYS.generate_key(activation=int(time.time()) + activate_in)
+    deleted = SIGNING_KEYS.prune()
+    print(
+        """New {key.alg} signing key {key.kid} generated
+        Deleted keys : {deleted}
+        """.format(key=key, deleted=", ".join(deleted) or "none")
+    )
+
+
+def purge_command(args, env):
+    """
+    Purge the expired codes and tokens
+
+    :param dict args: The arguments passed by command line
+    :param dict env: an environment dict (pyramid_env returned after bootstrap)
+    """
+    from autonomie_oidc_provider.janitor import JANITOR
+    batch_size = get_value(args, 'batch_size')
+    archive_dir = get_value(args, 'archive_dir')
+    if batch_size is not None:
+        JANITOR.batch_size = int(batch_size)
+    if archive_dir is not None:
+        JANITOR.archive_dir = archive_dir
+
+    stats = JANITOR.run_once()
+    for table, result in sorted(stats.items()):
+        print(
+            "{table} : {deleted} rows purged in {batches} batches, "
+            "{duration:.2f}s ({throughput:.0f} rows/s), "
+            "lag {lag:.0f}s".format(table=table, **result)
+        )
+
+
+def migrate_tokens_command(args, env):
+    """
+    Convert the legacy hexadecimal codes and tokens to binary storage
+
+    :param dict args: The arguments passed by command line
+    :param dict env: an environment dict (pyramid_env returned after bootstrap)
+    """
+    from autonomie_oidc_provider.token_migration import migrate_token_columns
+    batch_size = int(get_value(args, 'batch_size', 1000) or 1000)
+    result = migrate_token_columns(batch_size)
+    for column, count in sorted(result.items()):
+        print("{0} : {1} rows converted".format(column, count))
+
+
+def migrate_schema_command(args, env):
+    """
+    Add the columns, indexes and tables missing from an existing database
+
+    :param dict args: The arguments passed by command line
+    :param dict env: an environment dict (pyramid_env returned after bootstrap)
+    """
+    from autonomie_oidc_provider.schema_migration import migrate_schema
+    result = migrate_schema()
+    for change in result:
+        print(change)
+    print("{0} changes applied".format(len(result)))
+
+
+def retry_logout_command(args, env):
+    """
+    Retry the back-channel logout notifications that couldn't be delivered
+
+    :param dict args: The arguments passed by command line
+    :param dict env: an environment dict (pyramid_env returned after bootstrap)
+    """
+    from autonomie_oidc_provider.backchannel import BACKCHANNEL_LOGOUT
+    result = BACKCHANNEL_LOGOUT.retry_pending()
+    print(
+        "{delivered} notifications delivered, {failed} failed (will be "
+        "retried), {dropped} dropped".format(**result)
     )
 
 
@@ -144,9 +263,25 @@ def manage():
         oidc-manage <config_uri> clientadd --client=<client> --uri=<redirect_uri> --scopes=<scopes> --cert_salt=<cert_salt>
         oidc-manage <config_uri> clientrevoke --client_id=<client_id>
         oidc-manage <config_uri> clientrefresh --client_id=<client_id>
+        oidc-manage <config_uri> keyrotate [--activate_in=<activate_in>]
+        oidc-manage <config_uri> purge [--batch_size=<batch_size>] [--archive_dir=<archive_dir>]
+        oidc-manage <config_uri> tokenmigrate [--batch_size=<batch_size>]
+        oidc-manage <config_uri> schemamigrate
+        oidc-manage <config_uri> logoutretry
 
     o clientadd : get a client secret for this new client
-    o clientrevoke : revoke the given client
+    o clientrevoke : revoke the given client (and its codes and tokens)
+    o clientrefresh : generate a new secret for the given client (its codes
+    and tokens are revoked)
+    o keyrotate : add a new id token signing key (used after activate_in
+    seconds, defaults to oidc.jwks.max_age, the previous key stays published
+    during the configured overlap)
+    o purge : delete (and archive) the expired codes and tokens
+    o tokenmigrate : convert the codes and tokens columns to binary storage
+    (needed once when upgrading from the hexadecimal tokens)
+    o schemamigrate : add the columns, indexes and tables missing from a
+    database created by a previous version
+    o logoutretry : retry the back-channel logout notifications that are due
 
     Options:
 
@@ -159,6 +294,16 @@ def manage():
             func = revoke_client_command
         elif arguments['clientrefresh']:
             func = refresh_secret_command
+        elif arguments['keyrotate']:
+            func = rotate_key_command
+        elif arguments['purge']:
+            func = purge_command
+        elif arguments['tokenmigrate']:
+            func = migrate_tokens_command
+        elif arguments['schemamigrate']:
+            func = migrate_schema_command
+        elif arguments['logoutretry']:
+            func = retry_logout_command
         return func(arguments, env)
 
     try:
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import time
+import pytest
+
+
+@pytest.fixture
+def jwt_format():
+    from autonomie_oidc_provider.access_tokens import AccessTokenFormat
+    return AccessTokenFormat('jwt', key=b'provider key', issuer=u'issuer')
+
+
+def test_opaque_format(oidc_client, oidc_token):
+    from autonomie_oidc_provider.access_tokens import AccessTokenFormat
+    token_format = AccessTokenFormat()
+    assert token_format.serialize(oidc_token, oidc_client, ['openid']) == \
+        oidc_token.access_token
+    assert not token_format.looks_like_jwt(oidc_token.access_token)
+
+
+def test_jwt_format_key(jwt_format, oidc_client, oidc_token):
+    from autonomie_oidc_provider.access_tokens import AccessTokenFormat
+    from autonomie_oidc_provider.exceptions import InvalidToken
+    token_format = AccessTokenFormat()
+    with pytest.raises(KeyError):
+        token_format.configure(format_='jwt', key='')
+    # Without key, no jwt access token is accepted
+    token_str = jwt_format.serialize(oidc_token, oidc_client, ['openid'])
+    with pytest.raises(InvalidToken):
+        token_format.decode(token_str)
+
+
+def test_jwt_format(jwt_format, oidc_client, oidc_token, user):
+    token_str = jwt_format.serialize(
+        oidc_token, oidc_client, ['openid', 'profile']
+    )
+    assert jwt_format.looks_like_jwt(token_str)
+    claims = jwt_format.decode(token_str)
+    assert claims['sub'] == user.id
+    assert claims['client_id'] == oidc_client.client_id
+    assert claims['scope'] == u'openid profile'
+    assert claims['jti'] == oidc_token.access_token
+    assert claims['iss'] == u'issuer'
+
+
+def test_jwt_format_invalid(jwt_format, oidc_client, oidc_token):
+    from autonomie_oidc_provider.access_tokens import AccessTokenFormat
+    from autonomie_oidc_provider.exceptions import InvalidToken
+    token_str = jwt_format.serialize(oidc_token, oidc_client, ['openid'])
+
+    with pytest.raises(InvalidToken):
+        jwt_format.decode(token_str, now=time.time() + 2 * 60 * 60)
+
+    other_format = AccessTokenFormat('jwt', key=b'other key', issuer=u'issuer')
+    with pytest.raises(InvalidToken):
+        other_format.decode(token_str)
+
+    header, payload, signature = token_str.split('.')
+    with pytest.raises(InvalidToken):
+        jwt_format.decode('.'.join((header, payload, signature[:-4])))
+
+
+def test_revocation_set(sql_session, oidc_token):
+    from autonomie_oidc_provider.access_tokens import RevocationSet
+    revocation_set = RevocationSet(refresh_interval=60)
+    assert not revocation_set.is_revoked(oidc_token.access_token)
+
+    oidc_token.revoke()
+    sql_session.merge(oidc_token)
+    sql_session.flush()
+    # Not reloaded yet
+    assert not revocation_set.is_revoked(oidc_token.access_token)
+    revocation_set.invalidate()
+    assert revocation_set.is_revoked(oidc_token.access_token)
+
+
+def test_bulk_update_marks_token_revocations(
+    sql_session, oidc_code, oidc_token
+):
+    from autonomie_oidc_provider.access_tokens import SESSION_INFO_KEY
+    from autonomie_oidc_provider.models import (
+        OidcCode,
+        OidcToken,
+    )
+    sql_session.info.pop(SESSION_INFO_KEY, None)
+    sql_session.query(OidcCode).filter_by(id=oidc_code.id).update(
+        {'revoked': True}, synchronize_session=False
+    )
+    assert SESSION_INFO_KEY not in sql_session.info
+
+    sql_session.query(OidcToken).filter_by(id=oidc_token.id).update(
+        {'revoked': True}, synchronize_session=False
+    )
+    assert sql_session.info[SESSION_INFO_KEY]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import datetime
+import threading
+
+import pytest
+from six.moves.BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+from six.moves.urllib.parse import parse_qs
+
+
+@pytest.fixture
+def stub():
+    """
+    Local relying party answering the statuses listed in stub.statuses (200
+    once empty)
+    """
+    received = []
+    statuses = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            received.append(parse_qs(self.rfile.read(length)))
+            self.send_response(statuses.pop(0) if statuses else 200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.received = received
+    server.statuses = statuses
+    server.url = 'http://127.0.0.1:%s/logout' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def notifier(tmpdir):
+    from autonomie_oidc_provider.backchannel import BackChannelLogout
+    from autonomie_oidc_provider.keys import SIGNING_KEYS
+    SIGNING_KEYS.configure(alg='ES256', key_dir=str(tmpdir))
+    SIGNING_KEYS.ensure_key()
+    notifier = BackChannelLogout(
+        enabled=True,
+        issuer='http://myoidc/oidc/',
+        timeout=2,
+        retries=1,
+        backoff=0.01,
+    )
+    yield notifier
+    notifier.pool.shutdown()
+    SIGNING_KEYS.configure(alg='HS256', key_dir=None)
+
+
+@pytest.fixture
+def logout_client(sql_session, oidc_client, stub):
+    from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+    oidc_client.logout_uri = stub.url
+    sql_session.merge(oidc_client)
+    sql_session.flush()
+    CLIENT_REGISTRY.invalidate()
+    return oidc_client
+
+
+def test_notify(notifier, stub, logout_client, user):
+    from jwkest.jws import JWS
+    from autonomie_oidc_provider.backchannel import EVENT
+    from autonomie_oidc_provider.keys import SIGNING_KEYS
+
+    jobs = notifier.notify(user.id, [logout_client.id, 123456])
+    assert [job.wait(5) for job in jobs] == [True]
+
+    logout_token = stub.received[0]['logout_token'][0]
+    claims = JWS().verify_compact(
+        logout_token,
+        keys=[key.key for key in SIGNING_KEYS.published_keys()],
+    )
+    assert claims['aud'] == [logout_client.client_id]
+    assert claims['sub'] == unicode(user.id)
+    assert claims['iss'] == 'http://myoidc/oidc/'
+    assert EVENT in claims['events']
+    assert 'nonce' not in claims
+
+
+def test_notify_disabled(notifier, stub, logout_client, user):
+    notifier.enabled = False
+    assert notifier.notify(user.id, [logout_client.id]) == []
+
+
+def test_notify_retries(notifier, stub, sql_session, logout_client, user):
+    from autonomie_oidc_provider.models import OidcLogoutRetry
+    # Deliveries run synchronously, failures are added to sql_session
+    notifier.pool.configure(size=0)
+
+    stub.statuses.extend([500])
+    jobs = notifier.notify(user.id, [logout_client.id])
+    assert [job.wait() for job in jobs] == [True]
+    assert len(stub.received) == 2
+    assert OidcLogoutRetry.query().count() == 0
+
+    stub.statuses.extend([500, 503])
+    jobs = notifier.notify(user.id, [logout_client.id])
+    assert [job.wait() for job in jobs] == [False]
+    sql_session.flush()
+    retry = OidcLogoutRetry.query().one()
+    assert retry.client_id == logout_client.id
+    assert 'HTTP' in retry.last_error
+
+    later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    stub.statuses.extend([500])
+    assert notifier.retry_pending(now=later) == {
+        'delivered': 0, 'failed': 1, 'dropped': 0
+    }
+    assert OidcLogoutRetry.query().one().attempts == 1
+    # Not due yet
+    assert notifier.retry_pending(now=later) == {
+        'delivered': 0, 'failed': 0, 'dropped': 0
+    }
+
+    later += datetime.timedelta(days=1)
+    assert notifier.retry_pending(now=later) == {
+        'delivered': 1, 'failed': 0, 'dropped': 0
+    }
+    assert OidcLogoutRetry.query().count() == 0
+
+
+def test_post_timeout(notifier):
+    import socket
+    from autonomie_oidc_provider.backchannel import DeliveryError
+    # A relying party that never answers
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    notifier.timeout = 0.2
+    try:
+        with pytest.raises(DeliveryError):
+            notifier.post(
+                'http://127.0.0.1:%s/logout' % listener.getsockname()[1],
+                'token',
+            )
+    finally:
+        listener.close()
+
+
+def test_configure_enabled():
+    from autonomie_oidc_provider.backchannel import BackChannelLogout
+    notifier = BackChannelLogout()
+    for value in ('False', 'no', '0', 'off', False):
+        notifier.configure(enabled=value)
+        assert not notifier.enabled
+    notifier.configure(enabled='yes')
+    assert notifier.enabled
+    notifier.pool.shutdown()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import time
+
+
+def test_ttl_cache_lru():
+    from autonomie_oidc_provider.cache import TTLCache
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # b is the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_ttl_cache_expiry(monkeypatch):
+    from autonomie_oidc_provider.cache import TTLCache
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get('a') is None
+
+
+def test_verified_secret_cache():
+    from autonomie_oidc_provider.cache import VerifiedSecretCache
+    cache = VerifiedSecretCache()
+    cache.remember(u'client', u'secret', u'hash')
+
+    assert cache.is_verified(u'client', u'secret', u'hash')
+    assert not cache.is_verified(u'client', u'secret', u'otherhash')
+    assert not cache.is_verified(u'client', u'wrong', u'hash')
+    assert not cache.is_verified(u'other', u'secret', u'hash')
+    # The clear secret is never stored
+    for key, (expires, value) in cache._cache._data.items():
+        assert b'secret' not in key
+        assert u'secret' not in value
+
+    cache.invalidate(u'client')
+    assert not cache.is_verified(u'client', u'secret', u'hash')
+
+
+def test_check_secret_cache(oidc_client):
+    from autonomie_oidc_provider.cache import SECRET_CACHE
+    assert oidc_client.check_secret("client_secret_passphrase")
+    assert SECRET_CACHE.is_verified(
+        oidc_client.client_id,
+        "client_secret_passphrase",
+        oidc_client._client_secret,
+    )
+    oidc_client.new_client_secret()
+    assert not SECRET_CACHE.is_verified(
+        oidc_client.client_id,
+        "client_secret_passphrase",
+        oidc_client._client_secret,
+    )
+    assert not oidc_client.check_secret("client_secret_passphrase")
+
+
+def test_claim_cache():
+    from autonomie_oidc_provider.cache import ClaimCache
+    cache = ClaimCache()
+    claims = {'sub': 1, 'groups': ['admin']}
+    cache.set(1, ['openid', 'profile'], claims)
+    claims['groups'].append('other')
+
+    cached = cache.get(1, ['profile', 'openid'])
+    assert cached == {'sub': 1, 'groups': ['admin']}
+    # Callers get their own copy
+    cached['nonce'] = 'nonce'
+    assert 'nonce' not in cache.get(1, ['openid', 'profile'])
+    assert cache.get(1, ['openid']) is None
+
+    cache.invalidate(1)
+    assert cache.get(1, ['openid', 'profile']) is None
+
+
+def test_collect_claims_cache(sql_session, user):
+    from autonomie_oidc_provider.cache import CLAIM_CACHE
+    from autonomie_oidc_provider.scope_consumer import collect_claims
+    claims = collect_claims(user.id, ['openid', 'profile'])
+    assert CLAIM_CACHE.get(user.id, ['openid', 'profile']) == claims
+
+    user.firstname = u'Changed'
+    sql_session.merge(user)
+    sql_session.flush()
+    assert CLAIM_CACHE.get(user.id, ['openid', 'profile']) is None
+    claims = collect_claims(user.id, ['openid', 'profile'])
+    assert claims['firstname'] == u'Changed'
+
+
+def test_collect_claims_openid_only(connection, sql_session, user):
+    from sqlalchemy import event
+    from autonomie_oidc_provider.cache import CLAIM_CACHE
+    from autonomie_oidc_provider.scope_consumer import collect_claims
+    CLAIM_CACHE.clear()
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(connection, 'before_cursor_execute', record)
+    try:
+        claims = collect_claims(user.id, ['openid'])
+    finally:
+        event.remove(connection, 'before_cursor_execute', record)
+    assert claims == {'sub': user.id}
+    assert statements == []
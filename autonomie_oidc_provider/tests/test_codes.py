@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import pytest
+
+
+def test_replay_cache():
+    from autonomie_oidc_provider.codes import ReplayCache
+    cache = ReplayCache(horizon=10, max_size=2)
+    assert cache.add('a', 105, now=100)
+    assert not cache.add('a', 105, now=101)
+    assert cache.add('b', 108, now=101)
+    # Full : fails closed
+    assert not cache.add('c', 108, now=101)
+
+    # 'a' is dropped once the wheel passed its expiry
+    assert cache.add('c', 112, now=106)
+    assert len(cache) == 2
+    assert cache.add('a', 115, now=110)
+    assert len(cache) == 2
+
+
+def test_code_format(oidc_client):
+    from autonomie_oidc_provider.codes import CodeFormat
+    from autonomie_oidc_provider.exceptions import InvalidCredentials
+    code_format = CodeFormat('jwe', key='secret key')
+    code_str = code_format.serialize(
+        oidc_client, 12, u"http://test.com", u"openid profile", u"nonce"
+    )
+    assert code_format.looks_like_jwe(code_str)
+
+    code = code_format.decode(code_str)
+    assert code.audience == oidc_client.client_id
+    assert code.user_id == 12
+    assert code.uri == u"http://test.com"
+    assert code.scopes == u"openid profile"
+    assert code.nonce == u"nonce"
+    assert not code.is_expired()
+
+    assert code.consume()
+    assert not code.consume()
+
+    with pytest.raises(InvalidCredentials):
+        CodeFormat('jwe', key='other key').decode(code_str)
+
+
+def test_code_format_key():
+    from autonomie_oidc_provider.codes import CodeFormat
+    code_format = CodeFormat()
+    with pytest.raises(KeyError):
+        code_format.configure(format_='jwe', key='')
+    code_format.configure(format_='jwe', key='secret key')
+    assert code_format.is_stateless()
+
+
+def test_validate_stateless_code(oidc_client, monkeypatch):
+    from autonomie_oidc_provider.codes import CODE_FORMAT
+    from autonomie_oidc_provider.exceptions import InvalidCredentials
+    from autonomie_oidc_provider.views.token import validate_code
+    monkeypatch.setattr(CODE_FORMAT, 'format', 'jwe')
+    monkeypatch.setattr(CODE_FORMAT, 'key', b'secret key')
+    code_str = CODE_FORMAT.serialize(
+        oidc_client, 12, u"http://test.com", u"openid"
+    )
+    code = validate_code(code_str, oidc_client, u"http://test.com")
+    assert code.user_id == 12
+
+    with pytest.raises(InvalidCredentials):
+        validate_code(code_str, oidc_client, u"http://other.com")
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+
+
+def test_bind_oidc_models(tmpdir):
+    from sqlalchemy import (
+        create_engine,
+        inspect,
+    )
+    from sqlalchemy.orm import (
+        scoped_session,
+        sessionmaker,
+    )
+    from autonomie.models.user import User
+    from autonomie_oidc_provider.database import (
+        bind_oidc_models,
+        get_oidc_engine,
+    )
+    from autonomie_oidc_provider.models import (
+        OidcIdToken,
+        OidcToken,
+    )
+
+    assert get_oidc_engine({}) is None
+    oidc_engine = get_oidc_engine({
+        'oidc.sqlalchemy.url': 'sqlite:///%s' % tmpdir.join('oidc.sqlite'),
+    })
+    main_engine = create_engine('sqlite://')
+    session = scoped_session(sessionmaker(bind=main_engine))
+    bind_oidc_models(oidc_engine, session)
+
+    assert session().get_bind(inspect(OidcToken)) is oidc_engine
+    assert session().get_bind(
+        clause=OidcIdToken.__table__.insert()
+    ) is oidc_engine
+    assert session().get_bind(inspect(User)) is main_engine
+    assert oidc_engine.has_table(OidcToken.__tablename__)
+    session.remove()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+
+
+def test_sqlite_pragmas(tmpdir):
+    from autonomie_oidc_provider.engines import get_engine
+    engine = get_engine({
+        'sqlalchemy.url': 'sqlite:///%s' % tmpdir.join('oidc.sqlite'),
+        'oidc.sqlite.busy_timeout': '1234',
+    })
+    connection = engine.connect()
+    try:
+        assert connection.execute("PRAGMA journal_mode").scalar() == 'wal'
+        assert connection.execute("PRAGMA busy_timeout").scalar() == 1234
+        # NORMAL
+        assert connection.execute("PRAGMA synchronous").scalar() == 1
+    finally:
+        connection.close()
+        engine.dispose()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import binascii
+
+
+def test_gen_token():
+    from autonomie_oidc_provider.generators import (
+        TOKEN_BYTES,
+        TOKEN_LENGTH,
+        decode_token,
+        gen_token,
+    )
+    token = gen_token()
+    assert len(token) == TOKEN_LENGTH
+    assert len(decode_token(token)) == TOKEN_BYTES
+    assert gen_token() != token
+
+
+def test_decode_token():
+    from autonomie_oidc_provider.generators import (
+        decode_token,
+        encode_token,
+        normalize_token,
+    )
+    raw = b'\xff' * 32
+    legacy = binascii.hexlify(raw)
+    assert decode_token(legacy) == raw
+    assert decode_token(encode_token(raw)) == raw
+    assert normalize_token(legacy) == encode_token(raw)
+
+    for value in (None, u'', u'Bad token', u'é' * 43, u'g' * 64, u'+' * 43):
+        assert decode_token(value) is None
+
+
+def test_token_column(sql_session, oidc_client, user):
+    from autonomie_oidc_provider.generators import decode_token
+    from autonomie_oidc_provider.models import OidcToken
+    token = OidcToken(oidc_client, user.id)
+    sql_session.add(token)
+    sql_session.flush()
+    sql_session.expire(token)
+
+    assert len(token.access_token) == 43
+    assert OidcToken.find(token.access_token) == token
+    # Tokens issued before the binary storage was introduced
+    legacy = binascii.hexlify(decode_token(token.access_token))
+    assert OidcToken.find(legacy) == token
+    assert OidcToken.find(u"Bad token") is None
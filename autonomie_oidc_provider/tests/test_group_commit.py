@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import pytest
+
+
+def test_group_commit_batches(monkeypatch):
+    from autonomie_oidc_provider.group_commit import (
+        GroupCommitWriter,
+        _PendingWrite,
+    )
+    writer = GroupCommitWriter(enabled=True, max_batch=3, max_wait=0)
+    batches = []
+
+    def insert(batch):
+        batches.append([pending.row['value'] for pending in batch])
+        if any(pending.row['value'] == 'bad' for pending in batch):
+            raise ValueError(u"Bad row")
+
+    monkeypatch.setattr(writer, '_insert', insert)
+
+    pendings = [
+        _PendingWrite('table', {'value': value})
+        for value in ('a', 'bad', 'c', 'd')
+    ]
+    for pending in pendings:
+        writer._queue.put(pending)
+
+    batch = writer._next_batch()
+    assert len(batch) == 3
+    writer._commit(batch)
+    # The failed batch is retried row by row
+    assert batches == [['a', 'bad', 'c'], ['a'], ['bad'], ['c']]
+    assert pendings[0].done.is_set() and pendings[0].error is None
+    assert isinstance(pendings[1].error, ValueError)
+    assert pendings[2].done.is_set() and pendings[2].error is None
+
+    writer._commit(writer._next_batch())
+    assert pendings[3].done.is_set()
+    assert writer.stats() == {
+        'batches': 3, 'rows': 3, 'failed': 1, 'pending': 0
+    }
+
+
+@pytest.fixture
+def sqlite_file(tmpdir, connection):
+    """
+    Bind DBSESSION to a SQLite file : the writer thread and the request have
+    their own connections and share the database lock
+    """
+    from autonomie_base.models.base import (
+        DBBASE,
+        DBSESSION,
+    )
+    from autonomie_oidc_provider.engines import get_engine
+    from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+    engine = get_engine({
+        'sqlalchemy.url': 'sqlite:///%s' % tmpdir.join('oidc.sqlite'),
+        'oidc.sqlite.busy_timeout': 200,
+    })
+    DBBASE.metadata.create_all(engine)
+    DBSESSION.remove()
+    DBSESSION.configure(bind=engine)
+    CLIENT_REGISTRY.invalidate()
+    yield engine
+    DBSESSION.remove()
+    DBSESSION.configure(bind=connection)
+    CLIENT_REGISTRY.invalidate()
+    engine.dispose()
+
+
+def test_group_commit_token_view_sqlite(app, sqlite_file):
+    """
+    The code consumption and the refresh token rotation hold the SQLite write
+    lock : the new tokens can't wait for the writer thread
+    """
+    from base64 import b64encode
+    import transaction
+    from autonomie.models.user import User
+    from autonomie_base.models.base import DBSESSION
+    from autonomie_oidc_provider.group_commit import GROUP_COMMIT
+    from autonomie_oidc_provider.models import (
+        OidcClient,
+        OidcCode,
+        OidcRedirectUri,
+        OidcToken,
+    )
+
+    with transaction.manager:
+        session = DBSESSION()
+        user = User(login='admin', firstname='admin', lastname='admin',
+                    email='admin@admin.fr')
+        user.set_password('o')
+        client = OidcClient(name='Test client', scopes='openid profile',
+                            cert_salt="123456")
+        client.client_secret = "client_secret_passphrase"
+        session.add_all([user, client])
+        session.flush()
+        session.add(OidcRedirectUri(client=client, uri="http://test.com"))
+        code = OidcCode(client, user.id, u"http://test.com", u"openid")
+        session.add(code)
+        session.flush()
+        client_id = client.client_id
+        authcode = code.authcode
+
+    headers = {
+        "Authorization": "Basic %s" % b64encode(
+            "%s:%s" % (client_id, "client_secret_passphrase")
+        )
+    }
+    GROUP_COMMIT.configure(enabled=True, timeout=2)
+    try:
+        res = app.post("/token", headers=headers, params={
+            'code': authcode,
+            'redirect_uri': "http://test.com",
+            'grant_type': 'authorization_code',
+            'scope': 'openid',
+        })
+        refresh_token = res.json['refresh_token']
+        res = app.post("/token", headers=headers, params={
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+        })
+        new_refresh_token = res.json['refresh_token']
+    finally:
+        GROUP_COMMIT.configure(enabled=False)
+
+    DBSESSION.remove()
+    assert OidcToken.find_by_refresh_token(refresh_token).revoked
+    assert not OidcToken.find_by_refresh_token(new_refresh_token).revoked
+
+
+def test_group_commit_configure_enabled():
+    from autonomie_oidc_provider.group_commit import GroupCommitWriter
+    writer = GroupCommitWriter()
+    for value in ('False', 'no', '0', 'off', False):
+        writer.configure(enabled=value)
+        assert not writer.enabled
+    writer.configure(enabled='true')
+    assert writer.enabled
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import pytest
+
+
+@pytest.fixture
+def hmac_default(monkeypatch):
+    from autonomie_oidc_provider import hashers
+    registry = hashers.HasherRegistry()
+    registry.configure(algorithm='hmac_sha256', key='serverkey')
+    monkeypatch.setattr(hashers, 'HASHER_REGISTRY', registry)
+    return hashers
+
+
+def test_hmac_hasher(hmac_default):
+    hasher = hmac_default.HMACHasher(key='serverkey')
+    encoded = hasher.encode(u'secret')
+    algorithm, params, salt, digest = encoded.split(u'$')
+    assert algorithm == u'hmac_sha256'
+    assert hasher.verify(u'secret', encoded)
+    assert not hasher.verify(u'wrong', encoded)
+    assert not hmac_default.HMACHasher(key='other').verify(u'secret', encoded)
+
+
+def test_hmac_hasher_key(hmac_default):
+    with pytest.raises(KeyError):
+        hmac_default.HASHER_REGISTRY.configure(key='')
+    hmac_default.HASHER_REGISTRY.configure(algorithm='pbkdf2_sha256')
+
+
+def test_pbkdf2_hasher(hmac_default):
+    hasher = hmac_default.PBKDF2Hasher(iterations=1000)
+    encoded = hasher.encode(u'secret')
+    algorithm, params, salt, digest = encoded.split(u'$')
+    assert algorithm == u'pbkdf2_sha256'
+    assert params == u'1000'
+    assert hasher.verify(u'secret', encoded)
+    assert not hasher.verify(u'wrong', encoded)
+    # Produced with another scheme than the default one
+    assert hmac_default.needs_rehash(encoded)
+
+
+def test_legacy_hash(hmac_default):
+    from autonomie_oidc_provider.generators import crypt_secret
+    legacy = crypt_secret(b'secret', u'clientsalt').decode('ascii')
+    hasher = hmac_default.identify_hasher(legacy)
+    assert hasher is hmac_default.HASHER_REGISTRY.legacy_hasher
+    assert hasher.verify(u'secret', legacy, u'clientsalt')
+    assert not hasher.verify(u'wrong', legacy, u'clientsalt')
+    assert hmac_default.needs_rehash(legacy)
+
+
+def test_check_secret_upgrades_legacy_hash(oidc_client, hmac_default):
+    from autonomie_oidc_provider.generators import crypt_secret
+    oidc_client._client_secret = crypt_secret(
+        b'legacy_secret', oidc_client.salt
+    ).decode('ascii')
+
+    assert not oidc_client.check_secret(u'wrong secret')
+    assert u'$' not in oidc_client._client_secret
+
+    assert oidc_client.check_secret(u'legacy_secret', upgrade=False)
+    assert u'$' not in oidc_client._client_secret
+
+    assert oidc_client.check_secret(u'legacy_secret')
+    assert oidc_client._client_secret.startswith(u'hmac_sha256$')
+    assert oidc_client.check_secret(u'legacy_secret')
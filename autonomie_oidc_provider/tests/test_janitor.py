@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import os
+import json
+import datetime
+
+
+def _expire(sql_session, instance, seconds):
+    instance.expires_at = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=seconds
+    )
+    sql_session.merge(instance)
+    sql_session.flush()
+
+
+def test_janitor(tmpdir, sql_session, oidc_client, oidc_code, user):
+    from autonomie_oidc_provider.janitor import Janitor
+    from autonomie_oidc_provider.models import (
+        OidcCode,
+        OidcToken,
+    )
+    old_token = OidcToken(oidc_client, user.id)
+    refreshable_token = OidcToken(oidc_client, user.id)
+    fresh_token = OidcToken(oidc_client, user.id)
+    sql_session.add_all((old_token, refreshable_token, fresh_token))
+    sql_session.flush()
+    _expire(sql_session, oidc_code, 1)
+    _expire(sql_session, old_token, 120)
+    _expire(sql_session, refreshable_token, 30)
+    ids = (old_token.id, refreshable_token.id, fresh_token.id)
+
+    janitor = Janitor(
+        batch_size=1,
+        archive_dir=str(tmpdir),
+        refresh_token_lifetime=60,
+    )
+    stats = janitor.run_once()
+    assert stats[OidcCode.__table__.name]['deleted'] == 1
+    assert stats[OidcToken.__table__.name]['deleted'] == 1
+    assert stats[OidcToken.__table__.name]['lag'] >= 60
+
+    remaining = [
+        token.id for token in OidcToken.query().filter(OidcToken.id.in_(ids))
+    ]
+    assert sorted(remaining) == sorted(ids[1:])
+
+    archive = [
+        filename for filename in os.listdir(str(tmpdir))
+        if filename.startswith(OidcToken.__table__.name)
+    ]
+    with open(os.path.join(str(tmpdir), archive[0])) as fbuf:
+        rows = [json.loads(line) for line in fbuf]
+    assert [row['id'] for row in rows] == [ids[0]]
+    assert 'access_token' not in rows[0]
+
+
+def test_janitor_keeps_tokens_without_refresh_lifetime(
+    sql_session, oidc_token
+):
+    from autonomie_oidc_provider.janitor import Janitor
+    from autonomie_oidc_provider.models import OidcToken
+    _expire(sql_session, oidc_token, 3600 * 24 * 365)
+    janitor = Janitor(refresh_token_lifetime=0)
+    assert janitor.run_once()[OidcToken.__table__.name]['deleted'] == 0
+
+
+def test_background_threads_start_on_first_request(monkeypatch):
+    import threading
+    import autonomie_oidc_provider
+    from autonomie_oidc_provider.janitor import JANITOR
+    from autonomie_oidc_provider.backchannel import BACKCHANNEL_LOGOUT
+    started = []
+    monkeypatch.setattr(
+        autonomie_oidc_provider, '_THREADS_STARTED', threading.Event()
+    )
+    monkeypatch.setattr(JANITOR, 'start', lambda: started.append('janitor'))
+    monkeypatch.setattr(
+        BACKCHANNEL_LOGOUT, 'start', lambda: started.append('backchannel')
+    )
+
+    autonomie_oidc_provider.start_background_threads(None)
+    autonomie_oidc_provider.start_background_threads(None)
+    assert started == ['janitor', 'backchannel']
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import json
+import pytest
+
+
+@pytest.fixture
+def key_set(tmpdir):
+    from autonomie_oidc_provider.keys import KeySet
+    return KeySet(alg='ES256', key_dir=str(tmpdir), overlap=100)
+
+
+def test_key_rotation(key_set):
+    first = key_set.generate_key(activation=1000)
+    assert key_set.get_signing_key(now=1001).kid == first.kid
+
+    second = key_set.generate_key(activation=2000)
+    # Published before its activation
+    assert [key.kid for key in key_set.published_keys(now=1500)] == [
+        first.kid, second.kid
+    ]
+    assert key_set.get_signing_key(now=1500).kid == first.kid
+    assert key_set.get_signing_key(now=2001).kid == second.kid
+    # The retired key is still published during the overlap
+    assert len(key_set.published_keys(now=2050)) == 2
+    assert [key.kid for key in key_set.published_keys(now=2101)] == [
+        second.kid
+    ]
+
+    assert key_set.prune(now=2101) == [first.kid]
+    assert key_set.get_key(first.kid) is None
+
+
+def test_get_jwks(key_set):
+    key = key_set.generate_key(activation=1000)
+    body, etag = key_set.get_jwks(now=1001)
+    jwks = json.loads(body)
+    assert jwks['keys'][0]['kid'] == key.kid
+    assert 'd' not in jwks['keys'][0]
+    assert key_set.get_jwks(now=1001)[1] == etag
+
+    key_set.generate_key(activation=1000)
+    assert key_set.get_jwks(now=1001)[1] != etag
+
+
+@pytest.mark.parametrize('alg', ['RS256', 'ES256'])
+def test_id_token_signature(
+    alg, tmpdir, registry, oidc_client, oidc_code, user
+):
+    from pyramid.testing import DummyRequest
+    from jwkest.jwk import keyrep
+    from jwkest.jws import JWS
+    from autonomie_oidc_provider.keys import SIGNING_KEYS
+    from autonomie_oidc_provider.models import OidcIdToken
+
+    SIGNING_KEYS.configure(alg=alg, key_dir=str(tmpdir))
+    try:
+        SIGNING_KEYS.ensure_key()
+        req = DummyRequest()
+        req.registry = registry
+        id_token = OidcIdToken('issuer', oidc_client, oidc_code)
+        token_str = id_token.__jwt__(req, {}, 'client_secret_passphrase')
+
+        body, etag = SIGNING_KEYS.get_jwks()
+        keys = [keyrep(jwk) for jwk in json.loads(body)['keys']]
+        datas = JWS().verify_compact(token_str, keys=keys)
+        assert datas['sub'] == user.id
+    finally:
+        SIGNING_KEYS.configure(alg='HS256', key_dir=None)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import threading
+import pytest
+
+
+def test_worker_pool_run():
+    from autonomie_oidc_provider.pool import WorkerPool
+    pool = WorkerPool('test', size=2, queue_size=4)
+    try:
+        assert pool.run(lambda a, b: a + b, 1, b=2) == 3
+        with pytest.raises(ZeroDivisionError):
+            pool.run(lambda: 1 / 0)
+        stats = pool.stats()
+        assert stats['completed'] == 2
+        assert stats['rejected'] == 0
+    finally:
+        pool.shutdown()
+
+
+def test_worker_pool_inline():
+    from autonomie_oidc_provider.pool import WorkerPool
+    pool = WorkerPool('test', size=0)
+    thread_names = []
+    pool.run(lambda: thread_names.append(threading.current_thread().name))
+    assert thread_names == [threading.current_thread().name]
+
+
+def test_worker_pool_full():
+    from autonomie_oidc_provider.pool import WorkerPool, PoolFull
+    pool = WorkerPool('test', size=1, queue_size=1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait()
+
+    try:
+        first = pool.submit(blocking)
+        started.wait()
+        # The worker is busy, this one waits in the queue
+        second = pool.submit(blocking)
+        with pytest.raises(PoolFull):
+            pool.submit(blocking)
+        assert pool.stats()['rejected'] == 1
+        release.set()
+        first.wait()
+        second.wait()
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_validate_client_overloaded(oidc_client, monkeypatch):
+    from autonomie_oidc_provider.pool import PoolFull
+    from autonomie_oidc_provider.cache import SECRET_CACHE
+    from autonomie_oidc_provider.hashers import PBKDF2Hasher
+    from autonomie_oidc_provider.exceptions import TemporarilyUnavailable
+    from autonomie_oidc_provider.views.token import validate_client
+
+    def full(*args, **kwargs):
+        raise PoolFull('secret-derivation')
+
+    # Only the expensive schemes are run in the pool
+    oidc_client._client_secret = PBKDF2Hasher(iterations=1000).encode(
+        "client_secret_passphrase"
+    )
+    SECRET_CACHE.clear()
+    monkeypatch.setattr(
+        'autonomie_oidc_provider.pool.DERIVATION_POOL.run', full
+    )
+    with pytest.raises(TemporarilyUnavailable):
+        validate_client(oidc_client.client_id, "client_secret_passphrase")
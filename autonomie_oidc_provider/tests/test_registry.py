@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+
+
+def test_registry_get(oidc_client, oidc_redirect_uri):
+    from autonomie_oidc_provider.registry import ClientRegistry
+    registry = ClientRegistry()
+
+    entry = registry.get(oidc_client.client_id)
+    assert entry.id == oidc_client.id
+    assert entry.redirect_uris == (oidc_redirect_uri.uri,)
+    assert entry.scope_set == frozenset(['openid', 'profile'])
+    assert entry.check_scope(['openid'])
+    assert not entry.check_scope(['openid', 'other'])
+    assert entry.check_secret("client_secret_passphrase")
+    assert registry.get_by_id(oidc_client.id) is entry
+    assert registry.get("unknown client id") is None
+
+
+def test_registry_no_query_on_hit(oidc_client, connection):
+    from sqlalchemy import event
+    from autonomie_oidc_provider.registry import ClientRegistry
+    registry = ClientRegistry()
+    registry.get(oidc_client.client_id)
+
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    event.listen(connection, 'before_cursor_execute', count)
+    try:
+        assert registry.get(oidc_client.client_id) is not None
+        assert registry.get_by_id(oidc_client.id) is not None
+    finally:
+        event.remove(connection, 'before_cursor_execute', count)
+    assert statements == []
+
+
+def test_registry_invalidation(sql_session, oidc_client):
+    from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+    assert CLIENT_REGISTRY.get(oidc_client.client_id) is not None
+
+    oidc_client.revoke()
+    sql_session.merge(oidc_client)
+    sql_session.flush()
+
+    assert CLIENT_REGISTRY.get(oidc_client.client_id) is None
+    assert CLIENT_REGISTRY.get(oidc_client.client_id, valid=False).revoked
+
+
+def test_registry_stamp_file(tmpdir, oidc_client):
+    import os
+    from autonomie_oidc_provider.registry import ClientRegistry
+    stamp_file = str(tmpdir.join('stamp'))
+    registry = ClientRegistry()
+    registry.configure(ttl=0, stamp_file=stamp_file)
+    registry.get(oidc_client.client_id)
+    assert not registry._is_stale()
+
+    # Another process touched the stamp file
+    open(stamp_file, 'a').close()
+    os.utime(stamp_file, (1, 1))
+    registry._stamp_checked_at = 0
+    assert registry._is_stale()
+
+
+def test_redirect_uri_entry():
+    from six.moves.urllib.parse import urlparse, parse_qsl
+    from autonomie_oidc_provider.registry import RedirectUriEntry
+
+    class Dummy:
+        id = 1
+        uri = "http://example.com/callback?come_from=oidc#fragment"
+
+    entry = RedirectUriEntry(Dummy())
+    url = entry.build_url({'code': 'thecode'})
+    parsed = urlparse(url)
+    assert parsed.path == '/callback'
+    assert parsed.fragment == ''
+    assert dict(parse_qsl(parsed.query)) == {
+        'come_from': 'oidc', 'code': 'thecode'
+    }
+
+
+def test_client_entry_redirect_index(oidc_client, oidc_redirect_uri):
+    from autonomie_oidc_provider.registry import ClientRegistry
+    entry = ClientRegistry().get(oidc_client.client_id)
+    assert entry.get_redirect_uri("http%3A//test.com").uri == "http://test.com"
+    assert entry.get_redirect_uri("http://malicious.com") is None
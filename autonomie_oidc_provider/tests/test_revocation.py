@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+
+
+def test_revoke_client_grants(
+    sql_session, oidc_client, oidc_code, oidc_token, user
+):
+    from autonomie_oidc_provider.models import (
+        OidcClient,
+        OidcCode,
+        OidcToken,
+    )
+    from autonomie_oidc_provider.revocation import Revoker
+    other_client = OidcClient(name='Other client', scopes='openid')
+    sql_session.add(other_client)
+    sql_session.flush()
+    tokens = [OidcToken(oidc_client, user.id) for index in range(4)]
+    other_token = OidcToken(other_client, user.id)
+    sql_session.add_all(tokens + [other_token])
+    sql_session.flush()
+
+    commits = []
+    revoker = Revoker(batch_size=2)
+    result = revoker.revoke_client_grants(
+        oidc_client, commit=lambda: commits.append(True)
+    )
+    assert result == {'codes': 1, 'tokens': 5}
+    # 1 code batch and 3 token batches
+    assert len(commits) == 4
+
+    sql_session.expire_all()
+    assert OidcCode.query().filter_by(
+        client_id=oidc_client.id, revoked=False
+    ).count() == 0
+    assert OidcToken.query().filter_by(
+        client_id=oidc_client.id, revoked=False
+    ).count() == 0
+    assert not other_token.revoked
+
+    # Nothing left to revoke
+    assert revoker.revoke_client_grants(oidc_client) == {
+        'codes': 0, 'tokens': 0
+    }
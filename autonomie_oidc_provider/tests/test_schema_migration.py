@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+
+
+def test_add_column(tmpdir):
+    from sqlalchemy import create_engine
+    from autonomie_oidc_provider.models import OidcToken
+    from autonomie_oidc_provider.schema_migration import add_column
+    engine = create_engine('sqlite:///%s' % tmpdir.join('legacy.sqlite'))
+    # Token table created before the refresh token rotation
+    engine.execute(
+        "CREATE TABLE oidc_token (id INTEGER PRIMARY KEY, "
+        "user_id INTEGER NOT NULL, revoked BOOLEAN)"
+    )
+    engine.execute("INSERT INTO oidc_token (user_id, revoked) VALUES (1, 0)")
+
+    table = OidcToken.__table__
+    assert add_column(engine, table, 'rotated')
+    assert add_column(engine, table, 'scopes')
+    # Already added
+    assert not add_column(engine, table, 'rotated')
+
+    row = engine.execute("SELECT rotated, scopes FROM oidc_token").first()
+    # The default is set on the existing rows
+    assert not row[0] and row[0] is not None
+    assert row[1] is None
+
+
+def test_add_index(tmpdir):
+    from sqlalchemy import create_engine
+    from autonomie_oidc_provider.models import OidcToken
+    from autonomie_oidc_provider.schema_migration import add_index
+    engine = create_engine('sqlite:///%s' % tmpdir.join('legacy.sqlite'))
+    engine.execute(
+        "CREATE TABLE oidc_token (id INTEGER PRIMARY KEY, "
+        "user_id INTEGER NOT NULL, client_id INTEGER, expires_at DATETIME)"
+    )
+    engine.execute("CREATE INDEX legacy_name ON oidc_token (client_id)")
+
+    table = OidcToken.__table__
+    assert add_index(engine, table, ('user_id', 'client_id'))
+    assert add_index(engine, table, ('expires_at',))
+    assert not add_index(engine, table, ('expires_at',))
+    # Already indexed under another name
+    assert not add_index(engine, table, ('client_id',))
+
+
+def test_add_table(tmpdir):
+    from sqlalchemy import create_engine
+    from autonomie_oidc_provider.models import (
+        OidcClient,
+        OidcLogoutRetry,
+    )
+    from autonomie_oidc_provider.schema_migration import add_table
+    engine = create_engine('sqlite:///%s' % tmpdir.join('legacy.sqlite'))
+    OidcClient.__table__.create(bind=engine)
+
+    assert add_table(engine, OidcLogoutRetry.__table__)
+    assert not add_table(engine, OidcLogoutRetry.__table__)
+    assert OidcLogoutRetry.__table__.name in engine.table_names()
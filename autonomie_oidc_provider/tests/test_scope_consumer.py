@@ -5,6 +5,78 @@
 #       * Miotte Julien <j.m@majerti.fr>;
 import pytest
 from autonomie_oidc_provider import scope_consumer
+from autonomie_oidc_provider.scope_consumer import format_res_for_encoding
+
+
+class BaselineScope(object):
+    """
+    The attribute walking Scope implementation the compiled plans replaced
+    (kept as is to check the plans produce the same claims)
+    """
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+    def _produce_from_dotted_key(self, data_key, user_object):
+        """
+        Produce an attribute's value based on a dotted data key (that allows to
+        access related elements)
+        """
+        path = data_key.split('.')
+        data = user_object
+        for segment in path:
+            data = getattr(data, segment, None)
+        data = self._process_complex_value(data)
+        return data
+
+    def _process_serializable_object(self, data):
+        result = data
+        if hasattr(data, '__json__'):
+            result = data.__json__(None)
+        return result
+
+    def _process_list_value(self, data):
+        result = []
+        for d in data:
+            result.append(self._process_serializable_object(d))
+        return result
+
+    def _process_complex_value(self, data):
+        """
+        Process specific case of complex datas
+        :param data: The data to process
+        """
+        if isinstance(data, list):
+            data = self._process_list_value(data)
+        else:
+            data = self._process_serializable_object(data)
+        return data
+
+    def produce(self, user_object):
+        res = {}
+        for label, data_key in self.attributes:
+            if data_key:
+                if '.' in data_key:
+                    data_value = self._produce_from_dotted_key(
+                        data_key,
+                        user_object
+                    )
+                else:
+                    data_value = getattr(user_object, data_key, '')
+                    data_value = self._process_complex_value(data_value)
+                res[label] = data_value
+            else:
+                # Not implemented
+                res[label] = ''
+        res = format_res_for_encoding(res)
+        return res
+
+
+def produce_uncompiled(scope, user_object):
+    """
+    Produce the claims of the given Scope class with the baseline
+    implementation
+    """
+    return BaselineScope(scope.attributes).produce(user_object)
 
 
 class Dummy:
@@ -34,3 +106,49 @@ def test_profile_scope(user):
 
     assert claims['email'] == user.email
     assert claims['login'] == 'login'
+
+
+def test_compiled_plan(user):
+    user.id = 12L
+    user.label = u"Firstname Lastname"
+    user._groups = [
+        Dummy(__json__=lambda request: 'admin'),
+        'contractor',
+    ]
+    for scope in scope_consumer.SCOPES.values():
+        assert scope().produce(user) == produce_uncompiled(scope, user)
+
+    claims = scope_consumer.ProfileScope().produce(user)
+    assert claims['user_id'] == 12
+    assert type(claims['user_id']) is int
+    assert claims['groups'] == ['admin', 'contractor']
+
+
+def test_plan_is_compiled_once():
+    plan = scope_consumer.ProfileScope.get_plan()
+    assert scope_consumer.ProfileScope().get_plan() is plan
+    assert scope_consumer.OpenIdScope.get_plan() is not plan
+    assert scope_consumer.OpenIdScope.get_plan().relationships == frozenset()
+
+
+def test_openid_fast_path():
+    plan = scope_consumer.OpenIdScope.get_plan()
+    assert plan.columns == frozenset(['id'])
+    user = scope_consumer.load_user(12, [plan])
+    assert isinstance(user, scope_consumer.UserStub)
+    assert plan.extract(user) == {'sub': 12}
+
+
+def test_profile_scope_columns():
+    plan = scope_consumer.ProfileScope.get_plan()
+    assert not plan.full_row
+    # Inferred from the attributes and from label's dependencies
+    assert plan.columns == frozenset(['id', 'firstname', 'lastname', 'email'])
+
+
+def test_undeclared_property_needs_full_row():
+    class LabelScope(scope_consumer.Scope):
+        key = 'label'
+        attributes = (('name', 'label'),)
+
+    assert LabelScope.get_plan().full_row
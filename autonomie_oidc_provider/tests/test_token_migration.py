@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import binascii
+import os
+
+
+def test_migrate_column(tmpdir):
+    from sqlalchemy import create_engine
+    from autonomie_oidc_provider.token_migration import migrate_column
+    engine = create_engine('sqlite:///%s' % tmpdir.join('legacy.sqlite'))
+    engine.execute(
+        "CREATE TABLE oidc_code (id INTEGER PRIMARY KEY, "
+        "authcode VARCHAR(64) NOT NULL UNIQUE)"
+    )
+    raws = [os.urandom(32) for index in range(5)]
+    for raw in raws:
+        engine.execute(
+            "INSERT INTO oidc_code (authcode) VALUES (?)",
+            (binascii.hexlify(raw).decode('ascii'),)
+        )
+
+    assert migrate_column(engine, 'oidc_code', 'authcode', batch_size=2) == 5
+    rows = engine.execute("SELECT authcode FROM oidc_code ORDER BY id")
+    assert [bytes(row[0]) for row in rows] == raws
+    # Already migrated
+    assert migrate_column(engine, 'oidc_code', 'authcode') == 0
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import datetime
+
+import pytest
+
+
+@pytest.fixture
+def sqlite_store(tmpdir):
+    from autonomie_oidc_provider.token_store import SqliteTokenStore
+    store = SqliteTokenStore(str(tmpdir.join('tokens.sqlite')))
+    yield store
+    store.close()
+
+
+def test_sqlite_token_store(sqlite_store, oidc_client):
+    from autonomie_oidc_provider.models import OidcToken
+    token = OidcToken(oidc_client, 12)
+    sqlite_store.add(token)
+
+    found = sqlite_store.find(token.access_token)
+    assert found.refresh_token == token.refresh_token
+    assert found.user_id == 12
+    assert found.client_id == oidc_client.id
+    assert not found.revoked
+    assert abs(
+        (found.get_expiry() - token.get_expiry()).total_seconds()
+    ) < 0.001
+
+    assert sqlite_store.find_many(
+        [token.access_token, u'unknown']
+    ).keys() == [token.access_token]
+    assert sqlite_store.find_by_refresh_token(
+        token.refresh_token
+    ).access_token == token.access_token
+
+
+def test_sqlite_token_store_refresh(sqlite_store, oidc_client, monkeypatch):
+    from autonomie_oidc_provider.models import OidcToken
+    from autonomie_oidc_provider import token_store
+    notified = []
+    monkeypatch.setattr(
+        token_store, 'REVOCATION_LISTENERS', [lambda: notified.append(True)]
+    )
+
+    token = OidcToken(oidc_client, 12, u'openid')
+    sqlite_store.add(token)
+    new_token = sqlite_store.refresh(token, oidc_client)
+    assert new_token is not None
+    assert sqlite_store.find(new_token.access_token).scopes == u'openid'
+    assert token.rotated
+    assert sqlite_store.find(token.access_token) is None
+    assert sqlite_store.find(new_token.access_token) is not None
+    assert sqlite_store.find_by_refresh_token(token.refresh_token).rotated
+    # Already rotated
+    assert sqlite_store.refresh(token, oidc_client) is None
+    assert notified
+
+    now = datetime.datetime.utcnow()
+    assert sqlite_store.revoked_access_tokens(now) == [token.access_token]
+    assert sqlite_store.revoke_user_tokens(12, oidc_client.id) == 1
+    assert set(sqlite_store.revoked_access_tokens(now)) == set(
+        [token.access_token, new_token.access_token]
+    )
+
+    later = now + datetime.timedelta(days=1)
+    assert sqlite_store.purge(later, batch_size=1) == 2
+    assert sqlite_store.find_many([new_token.access_token]) == {}
+
+
+def test_sqlite_token_store_upgrade(tmpdir, oidc_client):
+    import sqlite3
+    from autonomie_oidc_provider.models import OidcToken
+    from autonomie_oidc_provider.token_store import SqliteTokenStore
+    path = str(tmpdir.join('old.sqlite'))
+    # File created before the scopes column was added
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE oidc_token (access_token TEXT PRIMARY KEY, "
+        "refresh_token TEXT NOT NULL UNIQUE, user_id INTEGER NOT NULL, "
+        "client_id INTEGER NOT NULL, expires_in INTEGER NOT NULL, "
+        "creation_date REAL NOT NULL, expires_at REAL NOT NULL, "
+        "revoked INTEGER NOT NULL DEFAULT 0, "
+        "rotated INTEGER NOT NULL DEFAULT 0, revocation_date REAL)"
+    )
+    connection.close()
+
+    store = SqliteTokenStore(path)
+    try:
+        token = OidcToken(oidc_client, 12, u'openid')
+        store.add(token)
+        assert store.find(token.access_token).scopes == u'openid'
+    finally:
+        store.close()
+
+
+def test_sql_token_store(sql_session, oidc_client, oidc_token):
+    from autonomie_oidc_provider.token_store import SqlTokenStore
+    store = SqlTokenStore()
+    assert store.find(oidc_token.access_token) == oidc_token
+    new_token = store.refresh(oidc_token, oidc_client)
+    sql_session.flush()
+    assert store.find(oidc_token.access_token) is None
+    assert store.find(new_token.access_token) == new_token
+    assert store.purge(datetime.datetime.utcnow()) is None
+
+
+def test_sqlite_token_store_revoke_client(sqlite_store, oidc_client):
+    from autonomie_oidc_provider.models import OidcToken
+    tokens = [OidcToken(oidc_client, 12) for index in range(5)]
+    for token in tokens:
+        sqlite_store.add(token)
+    assert sqlite_store.revoke_client_tokens(oidc_client.id, batch_size=2) == 5
+    for token in tokens:
+        assert sqlite_store.find(token.access_token) is None
+    assert sqlite_store.revoke_client_tokens(oidc_client.id) == 0
+
+
+def test_sqlite_token_store_revoke_tokens(sqlite_store, oidc_client):
+    from autonomie_oidc_provider.models import OidcToken
+    first, second, third = [OidcToken(oidc_client, 12) for index in range(3)]
+    for token in (first, second, third):
+        sqlite_store.add(token)
+    assert sqlite_store.revoke_tokens(
+        oidc_client.id, [first.access_token, second.refresh_token]
+    ) == 2
+    assert sqlite_store.revoke_tokens(
+        oidc_client.id + 1, [third.access_token]
+    ) == 0
+    assert sqlite_store.find(first.access_token) is None
+    assert sqlite_store.find(second.access_token) is None
+    assert sqlite_store.find(third.access_token) is not None
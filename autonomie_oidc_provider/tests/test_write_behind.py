@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+
+
+def test_write_behind_buffer(sql_session, oidc_client, oidc_code, monkeypatch):
+    from autonomie_oidc_provider.models import OidcIdToken
+    from autonomie_oidc_provider.write_behind import WriteBehindBuffer
+    buffer_ = WriteBehindBuffer(
+        OidcIdToken.__table__, batch_size=2, max_size=3
+    )
+    # Flushed by hand
+    monkeypatch.setattr(buffer_, '_start', lambda: None)
+
+    for index in range(4):
+        buffer_.add(OidcIdToken('issuer', oidc_client, oidc_code))
+    assert buffer_.stats()['dropped'] == 1
+
+    assert buffer_.flush() == 3
+    assert buffer_.stats()['pending'] == 0
+    id_tokens = OidcIdToken.query().filter_by(issuer='issuer').all()
+    assert len(id_tokens) == 3
+    assert not id_tokens[0].revoked
+
+
+def test_persist_id_token_none(sql_session, oidc_client, oidc_code,
+                               monkeypatch):
+    from autonomie_oidc_provider import write_behind
+    from autonomie_oidc_provider.models import OidcIdToken
+    monkeypatch.setattr(write_behind.PERSISTENCE, 'mode', 'none')
+    id_token = OidcIdToken('issuer', oidc_client, oidc_code)
+    write_behind.persist_id_token(sql_session, id_token)
+    sql_session.flush()
+    assert id_token.id is None
@@ -16,7 +16,7 @@ def test_validate_client(oidc_client):
     client_id = oidc_client.client_id
     from autonomie_oidc_provider.views.authorize import validate_client
     from autonomie_oidc_provider.exceptions import InvalidRequest
-    assert validate_client(client_id) == oidc_client
+    assert validate_client(client_id).id == oidc_client.id
 
     with pytest.raises(InvalidRequest):
         validate_client("okokokokoyfvuedhduehiudhi")
@@ -25,12 +25,26 @@ def test_validate_client(oidc_client):
 def test_validate_redirect_uri(oidc_client, oidc_redirect_uri):
     from autonomie_oidc_provider.views.authorize import validate_redirect_uri
     from autonomie_oidc_provider.exceptions import InvalidRequest
+    from autonomie_oidc_provider.registry import get_client
+    client = get_client(oidc_client.client_id)
     assert validate_redirect_uri(
         oidc_redirect_uri.uri,
-        oidc_client) == oidc_redirect_uri
+        client).uri == oidc_redirect_uri.uri
 
     with pytest.raises(InvalidRequest):
-        validate_redirect_uri("http://example.com", oidc_client)
+        validate_redirect_uri("http://example.com", client)
+
+
+def test_validate_scopes(oidc_client):
+    from autonomie_oidc_provider.views.authorize import validate_scopes
+    from autonomie_oidc_provider.exceptions import InvalidScope
+    from autonomie_oidc_provider.registry import get_client
+    client = get_client(oidc_client.client_id)
+    assert validate_scopes('openid otherone profile', client) == \
+        'openid profile'
+
+    with pytest.raises(InvalidScope):
+        validate_scopes('profile', client)
 
 
 def test_view_redirect(app, oidc_client, oidc_redirect_uri):
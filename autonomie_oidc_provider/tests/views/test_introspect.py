@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import pytest
+
+
+@pytest.fixture
+def headers(oidc_client):
+    from base64 import b64encode
+    return {
+        "Authorization": "Basic %s" % (
+            b64encode(
+                "%s:%s" % (
+                    oidc_client.client_id, "client_secret_passphrase"
+                )
+            )
+        )
+    }
+
+
+def test_introspect_tokens(sql_session, oidc_client, oidc_token, user):
+    from autonomie_oidc_provider.views.introspect import introspect_tokens
+
+    result = introspect_tokens([oidc_token.access_token, "unknown"])
+    assert result[0]['active']
+    assert result[0]['sub'] == user.id
+    assert result[0]['client_id'] == oidc_client.client_id
+    assert result[0]['scope'] == u'openid profile'
+    assert result[1] == {'active': False}
+
+    oidc_token.revoke()
+    sql_session.merge(oidc_token)
+    sql_session.flush()
+    assert introspect_tokens([oidc_token.access_token]) == [
+        {'active': False}
+    ]
+
+
+def test_introspect_view(app, headers, oidc_token):
+    res = app.post(
+        "/introspect",
+        headers=headers,
+        params={'token': oidc_token.access_token},
+    )
+    assert res.json['active']
+    assert res.cache_control.no_store
+
+    app.post(
+        "/introspect",
+        headers={'Authorization': 'Basic d3Jvbmc6d3Jvbmc='},
+        params={'token': oidc_token.access_token},
+        status=401,
+    )
+
+
+def test_introspect_batch_view(app, connection, headers, oidc_token):
+    from sqlalchemy import event
+    from autonomie_oidc_provider.models import OidcToken
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if OidcToken.__table__.name in statement:
+            statements.append(statement)
+
+    event.listen(connection, 'before_cursor_execute', record)
+    try:
+        res = app.post(
+            "/introspect/batch",
+            headers=headers,
+            params=[
+                ('token', oidc_token.access_token),
+                ('token', 'unknown'),
+                ('token', oidc_token.access_token),
+            ],
+        )
+    finally:
+        event.remove(connection, 'before_cursor_execute', record)
+
+    assert [item['active'] for item in res.json['tokens']] == [
+        True, False, True
+    ]
+    assert len(statements) == 1
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+
+
+def test_jwks_view(app, tmpdir):
+    from autonomie_oidc_provider.keys import SIGNING_KEYS
+    SIGNING_KEYS.configure(alg='RS256', key_dir=str(tmpdir))
+    try:
+        key = SIGNING_KEYS.generate_key()
+        resp = app.get('/jwks')
+        assert resp.json['keys'][0]['kid'] == key.kid
+        assert resp.cache_control.max_age == 3600
+        assert resp.etag
+
+        app.get(
+            '/jwks',
+            headers={'If-None-Match': '"%s"' % resp.etag},
+            status=304,
+        )
+    finally:
+        SIGNING_KEYS.configure(alg='HS256', key_dir=None)
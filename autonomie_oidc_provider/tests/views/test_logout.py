@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import pytest
+
+
+@pytest.fixture
+def id_token_hint(oidc_client, oidc_code):
+    from pyramid import testing
+    from autonomie_oidc_provider.models import OidcIdToken
+    id_token = OidcIdToken('http://myoidc/oidc/', oidc_client, oidc_code)
+    return id_token.__jwt__(
+        testing.DummyRequest(), {}, 'client_secret_passphrase'
+    )
+
+
+def test_get_id_token_hint_claims(id_token_hint, oidc_client, user):
+    from autonomie_oidc_provider.views.logout import get_id_token_hint_claims
+    claims = get_id_token_hint_claims(id_token_hint)
+    assert claims['aud'] == oidc_client.client_id
+    assert claims['sub'] == user.id
+    assert get_id_token_hint_claims('invalid') is None
+
+
+@pytest.mark.user('admin')
+def test_logout_view(app, sql_session, id_token_hint, oidc_token):
+    app.get('/logout', params={'id_token_hint': id_token_hint})
+    sql_session.expire_all()
+    assert oidc_token.revoked
+
+
+def test_logout_view_anonymous(app, sql_session, id_token_hint, oidc_token):
+    app.get('/logout', params={'id_token_hint': id_token_hint})
+    sql_session.expire_all()
+    assert not oidc_token.revoked
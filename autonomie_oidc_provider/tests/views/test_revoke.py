@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+import pytest
+
+
+@pytest.fixture
+def headers(oidc_client):
+    from base64 import b64encode
+    return {
+        "Authorization": "Basic %s" % (
+            b64encode(
+                "%s:%s" % (
+                    oidc_client.client_id, "client_secret_passphrase"
+                )
+            )
+        )
+    }
+
+
+def test_revoke_tokens(sql_session, oidc_client, oidc_token, user):
+    from autonomie_oidc_provider.models import (
+        OidcClient,
+        OidcToken,
+    )
+    from autonomie_oidc_provider.registry import get_client
+    from autonomie_oidc_provider.views.revoke import revoke_tokens
+    refreshed = OidcToken(oidc_client, user.id)
+    other_client = OidcClient(name='Other client', scopes='openid')
+    sql_session.add_all([refreshed, other_client])
+    sql_session.flush()
+    other_token = OidcToken(other_client, user.id)
+    sql_session.add(other_token)
+    sql_session.flush()
+
+    client = get_client(oidc_client.client_id)
+    assert revoke_tokens(
+        client,
+        [
+            oidc_token.access_token,
+            refreshed.refresh_token,
+            other_token.access_token,
+            'unknown',
+        ],
+    ) == 2
+    sql_session.expire_all()
+    assert oidc_token.revoked
+    assert refreshed.revoked
+    assert not other_token.revoked
+    # Already revoked
+    assert revoke_tokens(client, [oidc_token.access_token]) == 0
+
+
+def test_revoke_view(app, headers, oidc_token):
+    res = app.post(
+        "/revoke",
+        headers=headers,
+        params=[('token', oidc_token.access_token), ('token', 'unknown')],
+    )
+    assert res.status_int == 200
+    assert res.body == ''
+    assert res.cache_control.no_store
+
+    app.post("/revoke", headers=headers, status=400)
+    app.post(
+        "/revoke",
+        headers={'Authorization': 'Basic d3Jvbmc6d3Jvbmc='},
+        params={'token': oidc_token.access_token},
+        status=401,
+    )
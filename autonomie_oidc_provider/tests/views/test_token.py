@@ -134,3 +134,225 @@ def test_token_view(app, user, oidc_client, oidc_code, oidc_redirect_uri):
     )
     assert 'access_token' in res.json
 
+
+def test_validate_expired_code(sql_session, oidc_code, oidc_client):
+    import datetime
+    from autonomie_oidc_provider.exceptions import InvalidCredentials
+    from autonomie_oidc_provider.views.token import validate_code
+
+    oidc_code.expires_at = datetime.datetime.utcnow() - \
+        datetime.timedelta(seconds=1)
+    sql_session.merge(oidc_code)
+    sql_session.flush()
+    with pytest.raises(InvalidCredentials):
+        validate_code(oidc_code.authcode, oidc_client)
+
+
+@pytest.mark.user('admin')
+def test_token_view_statements(
+    app, connection, user, oidc_client, oidc_code, oidc_redirect_uri
+):
+    """
+    A token exchange costs one query for the code, one conditional update
+    consuming it and one batched flush
+    """
+    from base64 import b64encode
+    from sqlalchemy import event
+    from autonomie_oidc_provider.models import (
+        OidcClient,
+        OidcCode,
+        OidcIdToken,
+        OidcToken,
+    )
+    from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+
+    # The registry is warmed on startup
+    CLIENT_REGISTRY.get(oidc_client.client_id)
+
+    tables = [
+        model.__table__.name
+        for model in (OidcClient, OidcCode, OidcIdToken, OidcToken)
+    ]
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if any(table in statement for table in tables):
+            statements.append(statement.split()[0].upper())
+
+    headers = {
+        "Authorization": "Basic %s" % (
+            b64encode(
+                "%s:%s" % (
+                    oidc_client.client_id, "client_secret_passphrase"
+                )
+            )
+        )
+    }
+    params = {
+        'code': oidc_code.authcode,
+        'redirect_uri': oidc_redirect_uri.uri,
+        'grant_type': 'authorization_code',
+        'scope': 'openid',
+    }
+    event.listen(connection, 'before_cursor_execute', record)
+    try:
+        res = app.post("/token", headers=headers, params=params)
+    finally:
+        event.remove(connection, 'before_cursor_execute', record)
+
+    assert 'access_token' in res.json
+    assert statements == ['SELECT', 'UPDATE', 'INSERT', 'INSERT']
+
+
+def test_validate_grant_type_refresh_token():
+    from autonomie_oidc_provider.views.token import validate_grant_type
+    assert validate_grant_type('refresh_token') == 'refresh_token'
+
+
+def test_validate_refresh_token(sql_session, oidc_client, oidc_token):
+    import datetime
+    from autonomie_oidc_provider.exceptions import InvalidCredentials
+    from autonomie_oidc_provider.views.token import validate_refresh_token
+
+    token = validate_refresh_token(oidc_token.refresh_token, oidc_client, 60)
+    assert token == oidc_token
+
+    with pytest.raises(InvalidCredentials):
+        validate_refresh_token("Bad token", oidc_client, 60)
+
+    with pytest.raises(InvalidCredentials):
+        validate_refresh_token(oidc_token.access_token, oidc_client, 60)
+
+    oidc_token.creation_date = datetime.datetime.utcnow() - \
+        datetime.timedelta(seconds=61)
+    sql_session.merge(oidc_token)
+    sql_session.flush()
+    with pytest.raises(InvalidCredentials):
+        validate_refresh_token(oidc_token.refresh_token, oidc_client, 60)
+    # 0 : no limit
+    validate_refresh_token(oidc_token.refresh_token, oidc_client, 0)
+
+
+def test_refresh_rotation(sql_session, oidc_client, oidc_token):
+    new_token = oidc_token.refresh(oidc_client)
+    assert new_token is not None
+    assert new_token.refresh_token != oidc_token.refresh_token
+    assert oidc_token.revoked
+    assert oidc_token.rotated
+    # The refresh token can only be used once
+    assert oidc_token.refresh(oidc_client) is None
+
+
+def test_refresh_keeps_scopes(sql_session, oidc_client, user):
+    from autonomie_oidc_provider.models import OidcToken
+    token = OidcToken(oidc_client, user.id, u'openid')
+    sql_session.add(token)
+    sql_session.flush()
+
+    new_token = token.refresh(oidc_client)
+    assert new_token.scopes == u'openid'
+    # Not widened to all the client's scopes
+    assert new_token.get_scopes(oidc_client) == [u'openid']
+
+
+@pytest.mark.user('admin')
+def test_token_view_refresh_token(
+    app, sql_session, user, oidc_client, oidc_token
+):
+    from base64 import b64encode
+    from autonomie_oidc_provider.models import OidcToken
+    headers = {
+        "Authorization": "Basic %s" % (
+            b64encode(
+                "%s:%s" % (
+                    oidc_client.client_id, "client_secret_passphrase"
+                )
+            )
+        )
+    }
+    params = {
+        'grant_type': 'refresh_token',
+        'refresh_token': oidc_token.refresh_token,
+    }
+    res = app.post("/token", headers=headers, params=params)
+    assert 'access_token' in res.json
+    assert 'refresh_token' in res.json
+    assert 'id_token' not in res.json
+    new_refresh_token = res.json['refresh_token']
+    assert new_refresh_token != oidc_token.refresh_token
+
+    new_token = OidcToken.find_by_refresh_token(new_refresh_token)
+    assert not new_token.revoked
+
+    # Replaying the rotated refresh token revokes the whole family
+    res = app.post("/token", headers=headers, params=params, status=403)
+    assert res.json['error'] == 'invalid_grant'
+    sql_session.refresh(new_token)
+    assert new_token.revoked
+
+
+def test_consume_code(sql_session, oidc_code, oidc_client):
+    from autonomie_oidc_provider.exceptions import InvalidCredentials
+    from autonomie_oidc_provider.views.token import (
+        consume_code,
+        validate_code,
+    )
+    assert consume_code(oidc_code) == oidc_code
+    assert oidc_code.revoked
+
+    with pytest.raises(InvalidCredentials):
+        consume_code(oidc_code)
+    with pytest.raises(InvalidCredentials):
+        validate_code(oidc_code.authcode, oidc_client)
+
+
+def test_consume_code_concurrently(tmpdir, oidc_client):
+    """
+    Parallel exchanges of the same code : exactly one consumes it
+    """
+    import threading
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from autonomie_oidc_provider.models import (
+        OidcClient,
+        OidcCode,
+    )
+
+    engine = create_engine(
+        'sqlite:///%s' % tmpdir.join('codes.sqlite'),
+        connect_args={'timeout': 30, 'check_same_thread': False},
+    )
+    OidcClient.metadata.create_all(
+        engine, tables=[OidcClient.__table__, OidcCode.__table__]
+    )
+    factory = sessionmaker(bind=engine)
+    session = factory()
+    code = OidcCode(oidc_client, 1, u"http://test.com", u"openid")
+    session.add(code)
+    session.commit()
+    code_id = code.id
+    session.close()
+
+    start = threading.Event()
+    results = []
+
+    def exchange():
+        session = factory()
+        try:
+            code = session.query(OidcCode).get(code_id)
+            start.wait()
+            results.append(code.consume())
+            session.commit()
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=exchange) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    assert len(results) == 8
+    assert results.count(True) == 1
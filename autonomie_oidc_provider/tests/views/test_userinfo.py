@@ -17,3 +17,46 @@ def test_user_info_view(app, oidc_client, oidc_token, user):
     assert resp.json['email'] == user.email
     assert resp.json['user_id'] == user.id
     assert resp.json['sub'] == user.id
+
+
+def test_user_info_view_jwt(app, oidc_client, oidc_token, user, monkeypatch):
+    from autonomie_oidc_provider.access_tokens import (
+        AccessTokenFormat,
+        ACCESS_TOKENS,
+    )
+    monkeypatch.setattr(ACCESS_TOKENS, 'key', b'provider key')
+    token_format = AccessTokenFormat(
+        'jwt', key=ACCESS_TOKENS.key, issuer=ACCESS_TOKENS.issuer
+    )
+    token_str = token_format.serialize(oidc_token, oidc_client, ['openid'])
+    headers = [['Authorization', 'Bearer %s' % token_str]]
+    resp = app.post('/userinfo', headers=headers)
+    assert resp.status_int == 200
+    assert resp.json['sub'] == user.id
+
+    headers = [['Authorization', 'Bearer %s' % token_str[:-4]]]
+    resp = app.post('/userinfo', headers=headers, status=401)
+
+
+def test_user_info_view_expired_token(app, sql_session, oidc_token):
+    import datetime
+    from autonomie_oidc_provider.models import OidcToken
+    oidc_token.expires_at = datetime.datetime.utcnow() - \
+        datetime.timedelta(seconds=1)
+    sql_session.merge(oidc_token)
+    sql_session.flush()
+
+    headers = [['Authorization', 'Bearer %s' % oidc_token.access_token]]
+    app.post('/userinfo', headers=headers, status=401)
+    # Expiry is checked without marking the row as revoked
+    assert not OidcToken.get(oidc_token.id).revoked
+
+
+def test_id_token_is_revoked(oidc_client, oidc_code):
+    import datetime
+    from autonomie_oidc_provider.models import OidcIdToken
+    id_token = OidcIdToken('issuer', oidc_client, oidc_code)
+    assert not id_token.is_revoked()
+    later = id_token.expiration_time + datetime.timedelta(seconds=1)
+    assert id_token.is_revoked(later)
+    assert not id_token.revoked
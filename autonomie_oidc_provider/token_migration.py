@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Migration of the token columns to binary storage
+
+Codes, access and refresh tokens used to be stored as 64 characters
+hexadecimal strings, they're now stored as 32 raw bytes (see models.Token).
+The hexadecimal value of a legacy token is its raw value : legacy rows are
+converted in place and the tokens already sent to the clients stay valid.
+
+    PostgreSQL
+
+        ALTER ... TYPE BYTEA USING decode(..., 'hex')
+
+    MySQL
+
+        The column is turned into a VARBINARY(64), the rows are converted in
+        batches, the column is then turned into a BINARY(32)
+
+    SQLite
+
+        The rows are converted in batches (no column type change needed)
+
+Run it through "oidc-manage <config_uri> tokenmigrate" before starting the new
+version, it can be run several times.
+"""
+import binascii
+import logging
+
+from sqlalchemy import (
+    bindparam,
+    func,
+    inspect,
+    select,
+    sql,
+)
+from sqlalchemy.sql.sqltypes import _Binary
+from sqlalchemy.types import (
+    Integer,
+    LargeBinary,
+    String,
+)
+
+from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.generators import TOKEN_BYTES
+from autonomie_oidc_provider.models import (
+    OidcCode,
+    OidcToken,
+)
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN_COLUMNS = (
+    (OidcCode, ('authcode',)),
+    (OidcToken, ('access_token', 'refresh_token')),
+)
+LEGACY_LENGTH = TOKEN_BYTES * 2
+
+
+def _is_binary(engine, table_name, column_name):
+    for column in inspect(engine).get_columns(table_name):
+        if column['name'] == column_name:
+            return isinstance(column['type'], _Binary)
+    raise KeyError(u"Unknown column %s.%s" % (table_name, column_name))
+
+
+def _convert_rows(engine, table_name, column_name, batch_size):
+    """
+    Convert the legacy hexadecimal values of the given column in batches
+
+    :returns: The number of converted rows
+    """
+    table = sql.table(
+        table_name,
+        sql.column('id', Integer),
+        sql.column(column_name, String),
+    )
+    column = table.c[column_name]
+    query = select([table.c.id, column]).where(
+        func.length(column) == LEGACY_LENGTH
+    ).limit(batch_size)
+    update = table.update().where(
+        table.c.id == bindparam('_id')
+    ).values({column_name: bindparam('_value', type_=LargeBinary)})
+
+    converted = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(query).fetchall()
+            if rows:
+                connection.execute(update, [
+                    {'_id': row[0], '_value': binascii.unhexlify(row[1])}
+                    for row in rows
+                ])
+        converted += len(rows)
+        if len(rows) < batch_size:
+            return converted
+
+
+def migrate_column(engine, table_name, column_name, batch_size=1000):
+    """
+    Migrate one token column
+
+    :returns: The number of converted rows
+    :rtype: int
+    """
+    dialect = engine.dialect.name
+    if dialect == 'postgresql':
+        if _is_binary(engine, table_name, column_name):
+            return 0
+        with engine.begin() as connection:
+            count = connection.execute(
+                "SELECT COUNT(*) FROM %s" % table_name
+            ).scalar()
+            connection.execute(
+                "ALTER TABLE {table} ALTER COLUMN {column} TYPE BYTEA "
+                "USING decode({column}, 'hex')".format(
+                    table=table_name, column=column_name
+                )
+            )
+        return count
+
+    if dialect == 'mysql':
+        engine.execute(
+            "ALTER TABLE %s MODIFY %s VARBINARY(%s) NOT NULL" % (
+                table_name, column_name, LEGACY_LENGTH
+            )
+        )
+    converted = _convert_rows(engine, table_name, column_name, batch_size)
+    if dialect == 'mysql':
+        engine.execute(
+            "ALTER TABLE %s MODIFY %s BINARY(%s) NOT NULL" % (
+                table_name, column_name, TOKEN_BYTES
+            )
+        )
+    return converted
+
+
+def migrate_token_columns(batch_size=1000):
+    """
+    Migrate all the token columns (on the database each model is bound to)
+
+    :returns: The number of converted rows by column
+    :rtype: dict
+    """
+    result = {}
+    for model, column_names in TOKEN_COLUMNS:
+        engine = DBSESSION().get_bind(mapper=inspect(model))
+        table_name = model.__table__.name
+        for column_name in column_names:
+            count = migrate_column(engine, table_name, column_name, batch_size)
+            key = "%s.%s" % (table_name, column_name)
+            result[key] = count
+            logger.info(u"%s : %s rows converted", key, count)
+    return result
@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Access and refresh token storage
+
+sql (default)
+
+    Tokens are OidcToken rows in the Autonomie database, written in the
+    request's transaction
+
+sqlite
+
+    Tokens are stored in a local SQLite file in WAL mode (see
+    oidc.token_store.path), out of the Autonomie database : issuing, looking
+    up and revoking tokens doesn't compete with the ERP's traffic. Writes are
+    committed immediately, not with the request's transaction. All the
+    processes of the provider must share the file (same host).
+
+Both backends return OidcToken instances, sqlite ones are transient (never
+added to the SQLAlchemy session).
+"""
+import abc
+import calendar
+import datetime
+import logging
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+import six
+
+from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.group_commit import insert
+from autonomie_oidc_provider.models import (
+    OidcToken,
+    get_tokens_by_access_token,
+    revoke_client_tokens,
+    revoke_tokens,
+    revoke_user_tokens,
+)
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+# Called (without argument) when tokens are revoked outside of the
+# SQLAlchemy session
+REVOCATION_LISTENERS = []
+
+
+def add_revocation_listener(listener):
+    REVOCATION_LISTENERS.append(listener)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class TokenStore(object):
+    """
+    Token storage interface
+    """
+    name = None
+
+    @abc.abstractmethod
+    def add(self, token):
+        """
+        Store a new token
+
+        :param obj token: A new OidcToken instance
+        """
+
+    @abc.abstractmethod
+    def find(self, access_token):
+        """
+        Return the non-revoked token matching the given access token (None if
+        not found)
+        """
+
+    @abc.abstractmethod
+    def find_many(self, access_tokens):
+        """
+        Load the tokens matching the given access tokens (revoked ones
+        included)
+
+        :returns: A dict access_token -> OidcToken
+        :rtype: dict
+        """
+
+    @abc.abstractmethod
+    def find_by_refresh_token(self, refresh_token):
+        """
+        Return the token matching the given refresh token (revoked ones
+        included, used for replay detection)
+        """
+
+    @abc.abstractmethod
+    def rotate(self, token):
+        """
+        Atomically mark the token's refresh token as used (and the token as
+        revoked)
+
+        :returns: True if this call rotated the token
+        :rtype: bool
+        """
+
+    def refresh(self, token, client):
+        """
+        Rotate the given token and store a new one for the same client, user
+        and scopes
+
+        :returns: The new OidcToken or None if the refresh token was already
+        used
+        """
+        if not self.rotate(token):
+            return None
+        new_token = OidcToken(client, token.user_id, token.scopes)
+        self.add(new_token)
+        return new_token
+
+    @abc.abstractmethod
+    def find_user_client_ids(self, user_id):
+        """
+        Return the ids of the clients the user has non-revoked tokens with
+
+        :rtype: set
+        """
+
+    @abc.abstractmethod
+    def revoke_tokens(self, client_id, token_values):
+        """
+        Revoke the tokens of a client matching the given access or refresh
+        token values (one statement)
+
+        :param int client_id: The OidcClient's primary key
+        :param list token_values: Access and/or refresh token values
+        :returns: The number of revoked tokens
+        :rtype: int
+        """
+
+    @abc.abstractmethod
+    def revoke_user_tokens(self, user_id, client_id):
+        """
+        Revoke all the active tokens issued to a user for a given client
+
+        :param int client_id: The OidcClient's primary key
+        :returns: The number of revoked tokens
+        :rtype: int
+        """
+
+    @abc.abstractmethod
+    def revoke_client_tokens(self, client_id, batch_size=1000, commit=None):
+        """
+        Revoke all the tokens issued to a client, batch_size tokens at a time
+
+        :param int client_id: The OidcClient's primary key
+        :param func commit: Called after each batch written in the SQLAlchemy
+        session
+        :returns: The number of revoked tokens
+        :rtype: int
+        """
+
+    @abc.abstractmethod
+    def revoked_access_tokens(self, now):
+        """
+        Return the access tokens of the revoked and not yet expired tokens
+        """
+
+    def purge(self, cutoff, batch_size=1000):
+        """
+        Delete the tokens expired before cutoff (if the janitor doesn't take
+        care of them)
+
+        :returns: The number of deleted tokens or None
+        """
+        return None
+
+
+class SqlTokenStore(TokenStore):
+    """
+    OidcToken rows in the Autonomie database
+    """
+    name = 'sql'
+
+    def add(self, token):
+        # Written on the next flush (batched with the other rows) or by the
+        # group commit writer
+        insert(DBSESSION(), token)
+
+    def find(self, access_token):
+        return OidcToken.find(access_token)
+
+    def find_many(self, access_tokens):
+        return get_tokens_by_access_token(access_tokens)
+
+    def find_by_refresh_token(self, refresh_token):
+        return OidcToken.find_by_refresh_token(refresh_token)
+
+    def rotate(self, token):
+        return token.rotate()
+
+    def find_user_client_ids(self, user_id):
+        query = OidcToken.query().with_entities(OidcToken.client_id)
+        query = query.filter_by(user_id=user_id, revoked=False).distinct()
+        return set(row[0] for row in query)
+
+    def revoke_tokens(self, client_id, token_values):
+        return revoke_tokens(client_id, token_values)
+
+    def revoke_user_tokens(self, user_id, client_id):
+        return revoke_user_tokens(user_id, client_id)
+
+    def revoke_client_tokens(self, client_id, batch_size=1000, commit=None):
+        return revoke_client_tokens(client_id, batch_size, commit)
+
+    def revoked_access_tokens(self, now):
+        query = OidcToken.query().with_entities(OidcToken.access_token)
+        query = query.filter(OidcToken.revoked == True)  # NOQA
+        query = query.filter(OidcToken.expires_at >= now)
+        return [row[0] for row in query]
+
+
+def _to_timestamp(value):
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def _from_timestamp(value):
+    if value is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(value)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS oidc_token (
+    access_token TEXT PRIMARY KEY,
+    refresh_token TEXT NOT NULL UNIQUE,
+    user_id INTEGER NOT NULL,
+    client_id INTEGER NOT NULL,
+    expires_in INTEGER NOT NULL,
+    creation_date REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    revoked INTEGER NOT NULL DEFAULT 0,
+    rotated INTEGER NOT NULL DEFAULT 0,
+    revocation_date REAL,
+    scopes TEXT
+);
+CREATE INDEX IF NOT EXISTS oidc_token_user ON oidc_token (user_id, client_id);
+CREATE INDEX IF NOT EXISTS oidc_token_expires_at ON oidc_token (expires_at);
+"""
+
+SQLITE_COLUMNS = (
+    'access_token', 'refresh_token', 'user_id', 'client_id', 'expires_in',
+    'creation_date', 'expires_at', 'revoked', 'rotated', 'revocation_date',
+    'scopes',
+)
+DATE_COLUMNS = ('creation_date', 'expires_at', 'revocation_date')
+BOOLEAN_COLUMNS = ('revoked', 'rotated')
+SELECT_TOKEN = "SELECT %s FROM oidc_token" % ", ".join(SQLITE_COLUMNS)
+
+
+class SqliteTokenStore(TokenStore):
+    """
+    Tokens stored in a local SQLite file in WAL mode, one connection per
+    thread
+    """
+    name = 'sqlite'
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Autocommit, transactions are explicit (see _transaction)
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SQLITE_SCHEMA)
+            self._upgrade_schema(connection)
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _upgrade_schema(connection):
+        """
+        Add the columns missing from files created by a previous version
+        """
+        existing = set(
+            row[1] for row in connection.execute(
+                "PRAGMA table_info(oidc_token)"
+            )
+        )
+        if 'scopes' not in existing:
+            connection.execute("ALTER TABLE oidc_token ADD COLUMN scopes TEXT")
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    @staticmethod
+    def _to_row(token):
+        row = []
+        for column in SQLITE_COLUMNS:
+            value = getattr(token, column)
+            if column in DATE_COLUMNS:
+                value = _to_timestamp(value)
+            elif column in BOOLEAN_COLUMNS:
+                value = int(bool(value))
+            row.append(value)
+        return row
+
+    @staticmethod
+    def _to_token(row):
+        # Transient instance, the constructor would generate new tokens
+        token = OidcToken.__mapper__.class_manager.new_instance()
+        for column, value in zip(SQLITE_COLUMNS, row):
+            if column in DATE_COLUMNS:
+                value = _from_timestamp(value)
+            elif column in BOOLEAN_COLUMNS:
+                value = bool(value)
+            setattr(token, column, value)
+        return token
+
+    def _insert(self, connection, token):
+        connection.execute(
+            "INSERT INTO oidc_token (%s) VALUES (%s)" % (
+                ", ".join(SQLITE_COLUMNS),
+                ", ".join("?" * len(SQLITE_COLUMNS)),
+            ),
+            self._to_row(token),
+        )
+
+    def add(self, token):
+        self._insert(self._get_connection(), token)
+
+    def _find_one(self, where, param):
+        row = self._get_connection().execute(
+            "%s WHERE %s" % (SELECT_TOKEN, where), (param,)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._to_token(row)
+
+    def find(self, access_token):
+        return self._find_one("access_token = ? AND revoked = 0", access_token)
+
+    def find_many(self, access_tokens):
+        access_tokens = list(set(access_tokens))
+        if not access_tokens:
+            return {}
+        rows = self._get_connection().execute(
+            "%s WHERE access_token IN (%s)" % (
+                SELECT_TOKEN, ", ".join("?" * len(access_tokens))
+            ),
+            access_tokens,
+        )
+        return dict((row[0], self._to_token(row)) for row in rows)
+
+    def find_by_refresh_token(self, refresh_token):
+        return self._find_one("refresh_token = ?", refresh_token)
+
+    def _rotate(self, connection, token):
+        now = datetime.datetime.utcnow()
+        count = connection.execute(
+            "UPDATE oidc_token SET revoked = 1, rotated = 1, "
+            "revocation_date = ? "
+            "WHERE access_token = ? AND revoked = 0 AND rotated = 0",
+            (_to_timestamp(now), token.access_token),
+        ).rowcount
+        if count:
+            token.revoked = True
+            token.rotated = True
+            token.revocation_date = now
+        return count == 1
+
+    def rotate(self, token):
+        with self._transaction() as connection:
+            result = self._rotate(connection, token)
+        self._notify()
+        return result
+
+    def refresh(self, token, client):
+        # The rotation and the new token are committed together
+        with self._transaction() as connection:
+            if not self._rotate(connection, token):
+                return None
+            new_token = OidcToken(client, token.user_id, token.scopes)
+            self._insert(connection, new_token)
+        self._notify()
+        return new_token
+
+    def find_user_client_ids(self, user_id):
+        rows = self._get_connection().execute(
+            "SELECT DISTINCT client_id FROM oidc_token "
+            "WHERE user_id = ? AND revoked = 0",
+            (user_id,),
+        )
+        return set(row[0] for row in rows)
+
+    def revoke_tokens(self, client_id, token_values):
+        token_values = list(set(token_values))
+        if not token_values:
+            return 0
+        placeholders = ", ".join("?" * len(token_values))
+        count = self._get_connection().execute(
+            "UPDATE oidc_token SET revoked = 1, revocation_date = ? "
+            "WHERE client_id = ? AND revoked = 0 "
+            "AND (access_token IN (%s) OR refresh_token IN (%s))" % (
+                placeholders, placeholders
+            ),
+            [_to_timestamp(datetime.datetime.utcnow()), client_id] +
+            token_values + token_values,
+        ).rowcount
+        if count:
+            self._notify()
+        return count
+
+    def revoke_user_tokens(self, user_id, client_id):
+        count = self._get_connection().execute(
+            "UPDATE oidc_token SET revoked = 1, revocation_date = ? "
+            "WHERE user_id = ? AND client_id = ? AND revoked = 0",
+            (_to_timestamp(datetime.datetime.utcnow()), user_id, client_id),
+        ).rowcount
+        if count:
+            self._notify()
+        return count
+
+    def revoke_client_tokens(self, client_id, batch_size=1000, commit=None):
+        # Each batch is committed on its own (autocommit connection)
+        connection = self._get_connection()
+        now = _to_timestamp(datetime.datetime.utcnow())
+        revoked = 0
+        while True:
+            count = connection.execute(
+                "UPDATE oidc_token SET revoked = 1, revocation_date = ? "
+                "WHERE rowid IN (SELECT rowid FROM oidc_token "
+                "WHERE client_id = ? AND revoked = 0 LIMIT ?)",
+                (now, client_id, batch_size),
+            ).rowcount
+            revoked += count
+            if count < batch_size:
+                break
+        if revoked:
+            self._notify()
+        return revoked
+
+    def revoked_access_tokens(self, now):
+        rows = self._get_connection().execute(
+            "SELECT access_token FROM oidc_token "
+            "WHERE revoked = 1 AND expires_at >= ?",
+            (_to_timestamp(now),),
+        )
+        return [row[0] for row in rows]
+
+    def purge(self, cutoff, batch_size=1000):
+        connection = self._get_connection()
+        deleted = 0
+        while True:
+            count = connection.execute(
+                "DELETE FROM oidc_token WHERE rowid IN ("
+                "SELECT rowid FROM oidc_token WHERE expires_at < ? LIMIT ?)",
+                (_to_timestamp(cutoff), batch_size),
+            ).rowcount
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    @staticmethod
+    def _notify():
+        for listener in REVOCATION_LISTENERS:
+            listener()
+
+
+TOKEN_STORES = {
+    'sql': SqlTokenStore,
+    'sqlite': SqliteTokenStore,
+}
+
+
+class TokenStoreSetting(object):
+    """
+    The configured TokenStore backend
+    """
+    def __init__(self):
+        self.store = SqlTokenStore()
+
+    def configure(self, name=None, path=None):
+        """
+        :param str name: The backend name (see TOKEN_STORES)
+        :param str path: Path of the SQLite file (sqlite backend)
+        :raises: KeyError if the backend is unknown or misconfigured
+        """
+        if name is None:
+            return
+        if name not in TOKEN_STORES:
+            raise KeyError(u"Unknown token store %s" % name)
+        if name == 'sqlite':
+            if not path:
+                raise KeyError(u"Missing oidc.token_store.path setting")
+            self.store = SqliteTokenStore(path)
+        else:
+            self.store = SqlTokenStore()
+
+
+TOKEN_STORE = TokenStoreSetting()
+
+
+def get_token_store():
+    """
+    Return the configured TokenStore
+    """
+    return TOKEN_STORE.store
+
+
+def includeme(config):
+    """
+    Configure the token store regarding the current settings
+
+        oidc.token_store
+
+            sql (default) or sqlite
+
+        oidc.token_store.path
+
+            Path of the SQLite file (sqlite backend)
+    """
+    settings = config.get_settings()
+    TOKEN_STORE.configure(
+        name=oidc_settings(settings, 'token_store', 'sql'),
+        path=oidc_settings(settings, 'token_store.path'),
+    )
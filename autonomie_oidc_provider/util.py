@@ -19,6 +19,7 @@ from six.moves.urllib.parse import (
     ParseResult,
     urlencode,
     parse_qsl,
+    unquote,
 )
 
 from autonomie_oidc_provider.exceptions import (
@@ -28,6 +29,9 @@ from autonomie_oidc_provider.exceptions import (
 
 logger = logging.getLogger(__name__)
 
+# Default refresh token lifetime in seconds (30 days)
+REFRESH_TOKEN_LIFETIME = 30 * 24 * 60 * 60
+
 
 def oidc_settings(settings, key=None, default=None):
     """
@@ -50,6 +54,20 @@ def oidc_settings(settings, key=None, default=None):
                     if x.startswith('oidc.'))
 
 
+def get_refresh_token_lifetime(settings):
+    """
+    Return the refresh token lifetime in seconds (oidc.refresh_token_lifetime)
+
+    :param dict settings: The current settings
+    :rtype: int
+    """
+    return int(
+        oidc_settings(
+            settings, 'refresh_token_lifetime', REFRESH_TOKEN_LIFETIME
+        )
+    )
+
+
 def get_client_credentials(request):
     """
     Get the client credentials from the request headers
@@ -160,3 +178,15 @@ def add_get_params(url, params):
         ''
     )
     return url.geturl()
+
+
+def normalize_redirect_uri(uri):
+    """
+    Normalize a redirect uri so that it can be compared to the registered
+    ones
+
+    :param str uri: The redirect uri as provided in the request params
+    :returns: The normalized uri
+    :rtype: str
+    """
+    return unquote(uri)
@@ -2,6 +2,7 @@
 import logging
 from pyramid.httpexceptions import HTTPBadRequest
 import json
+import transaction
 
 from autonomie_base.utils.ascii import (
     force_ascii,
@@ -38,6 +39,26 @@ def require_ssl(handler):
     return wrapped
 
 
+def doom_transaction(request):
+    """
+    Doom the current request's transaction : pyramid_tm aborts it instead of
+    committing it (nothing is written, no lock is kept until the commit)
+    """
+    manager = getattr(request, 'tm', None) or transaction.manager
+    manager.get().doom()
+
+
+def read_only(handler):
+    """
+    Run the given view in a doomed transaction, validation only views should
+    never write to the database
+    """
+    def wrapped(request):
+        doom_transaction(request)
+        return handler(request)
+    return wrapped
+
+
 def http_error(request, exception, in_headers=False):
     """
     Return a pyramid http error given an exception instance
@@ -6,10 +6,7 @@
 import logging
 from six.moves.urllib.parse import (
     urlparse,
-    parse_qsl,
-    ParseResult,
     urlencode,
-    unquote,
 )
 from pyramid.httpexceptions import (
     HTTPFound,
@@ -22,16 +19,15 @@ from autonomie_base.models.base import DBSESSION
 
 from autonomie.models.user.login import Login
 
+from autonomie_oidc_provider.codes import CODE_FORMAT
+from autonomie_oidc_provider.group_commit import insert
 from autonomie_oidc_provider.exceptions import (
     InvalidRequest,
     InvalidScope,
     UnsupportedGrantType,
 )
-from autonomie_oidc_provider.models import (
-    get_client_by_client_id,
-    OidcCode,
-    OidcRedirectUri,
-)
+from autonomie_oidc_provider.models import OidcCode
+from autonomie_oidc_provider.registry import get_client
 from autonomie_oidc_provider.views import (
     require_ssl,
     http_error,
@@ -70,22 +66,18 @@ def raise_authentication_error(
 
 def get_redirection_uri(redirect_uri, client):
     """
-    Retrieve the OidcRedirectUri object associated to the given redirect_uri
-    Ensure it belongs to the given client
+    Retrieve the redirect uri registered for the given client matching the
+    given redirect_uri
 
     :param str redirect_uri: The redirect uri given in the parameters
-    :param obj client: OidcClient instance
-    :returns: A OidcRedirectUri instance or None
+    :param obj client: registry.ClientEntry instance
+    :returns: A registry.RedirectUriEntry instance or None
     :rtype: obj
     """
-    redirect_uri = unquote(redirect_uri)
     if redirect_uri is None:
         result = None
     else:
-        query = OidcRedirectUri.query()
-        query = query.filter_by(uri=redirect_uri)
-        query = query.filter_by(client_id=client.id)
-        result = query.first()
+        result = client.get_redirect_uri(redirect_uri)
     return result
 
 
@@ -97,8 +89,8 @@ def handle_authcode(
     with the authcode embeded in the url)
 
     :param obj request: The Pyramid request
-    :param obj client: The OidcClient instance
-    :param obj redirection_uri: The OidcRedirectUri instance
+    :param obj client: The registry.ClientEntry instance
+    :param obj redirection_uri: The registry.RedirectUriEntry instance
     :param str scopes: The scopes associated to this code
     :param str state: The state initially transmitted by the Resource Consumer
     (RC)
@@ -108,34 +100,29 @@ def handle_authcode(
     :returns: A HTTPFound instance
     """
     logger.debug("Handling the creation of an auth code")
-    db = DBSESSION()
-    parts = urlparse(redirection_uri.uri)
-    qparams = dict(parse_qsl(parts.query))
-
     user_login = authenticated_userid(request)
     user_id = Login.query().filter_by(login=user_login).first().user_id
-    auth_code = OidcCode(client, user_id, redirection_uri.uri, scopes)
-    if nonce is not None:
-        auth_code.nonce = nonce
-    db.add(auth_code)
-    db.flush()
-    logger.debug("An auth_code has been added")
-    logger.debug(auth_code)
-    logger.debug(auth_code.id)
-
-    qparams['code'] = auth_code.authcode
+
+    if CODE_FORMAT.is_stateless():
+        code_str = CODE_FORMAT.serialize(
+            client, user_id, redirection_uri.uri, scopes, nonce
+        )
+    else:
+        db = DBSESSION()
+        auth_code = OidcCode(client, user_id, redirection_uri.uri, scopes)
+        if nonce is not None:
+            auth_code.nonce = nonce
+        insert(db, auth_code)
+        db.flush()
+        logger.debug("An auth_code has been added")
+        logger.debug(auth_code)
+        code_str = auth_code.authcode
+
+    qparams = {'code': code_str}
     if state is not None:
         qparams['state'] = state
 
-    parts = ParseResult(
-        parts.scheme,
-        parts.netloc,
-        parts.path,
-        parts.params,
-        urlencode(qparams),
-        ''
-    )
-    return HTTPFound(location=parts.geturl())
+    return HTTPFound(location=redirection_uri.build_url(qparams))
 
 
 def validate_client(client_id):
@@ -143,9 +130,9 @@ def validate_client(client_id):
     Validate the provided client id and return it back
 
     :param str client_id: The provided client_id
-    :returns: An OidcClient instance
+    :returns: A registry.ClientEntry instance
     """
-    client = get_client_by_client_id(client_id)
+    client = get_client(client_id)
     if client is None:
         raise InvalidRequest(
             error_description='Invalid client credentials'
@@ -159,7 +146,7 @@ def validate_redirect_uri(redirect_uri, client):
 
     :param str redirect_uri: The redirect_uri passed through the request
     :param obj client: The associated client object
-    :returns: A OidcRedirectUri instance
+    :returns: A registry.RedirectUriEntry instance
     """
     redirection_uri = get_redirection_uri(redirect_uri, client)
     if redirection_uri is None:
@@ -175,7 +162,7 @@ def validate_scopes(scope_str, client):
     http://openid.net/specs/openid-connect-core-1_0.html#AuthRequest
 
     :param str scope_str: The space delimited list of requested scopes
-    :param obj client: An OidcClient
+    :param obj client: A registry.ClientEntry instance
     :returns: A space delimited list of scopes
     :rtype: str
     :raises: InvalidRequest if wrong scope
@@ -186,7 +173,7 @@ def validate_scopes(scope_str, client):
         )
     scopes = scope_str.split(' ')
     return ' '.join(
-        [scope for scope in scopes if scope in client.scopes.split(' ')]
+        [scope for scope in scopes if scope in client.scope_set]
     )
 
 
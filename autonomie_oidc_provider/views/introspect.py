@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Token introspection endpoint as described in :
+    https://tools.ietf.org/html/rfc7662
+
+Resource servers authenticate as oidc clients (same credentials as on the
+token endpoint) and get the state of an access token without building the
+user's claims.
+
+The batch variant (/introspect/batch) accepts several token parameters and
+checks them all with one query.
+
+Both views never write : outdated client secret hashes are upgraded on the
+token endpoint only.
+"""
+import logging
+
+from pyramid.security import NO_PERMISSION_REQUIRED
+
+from autonomie_oidc_provider.access_tokens import ACCESS_TOKENS
+from autonomie_oidc_provider.exceptions import (
+    InvalidClient,
+    InvalidCredentials,
+    InvalidRequest,
+    InvalidToken,
+    TemporarilyUnavailable,
+    UnauthorizedClient,
+)
+from autonomie_oidc_provider.generators import normalize_token
+from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+from autonomie_oidc_provider.token_store import get_token_store
+from autonomie_oidc_provider.util import (
+    dt_to_timestamp,
+    get_client_credentials,
+    oidc_settings,
+)
+from autonomie_oidc_provider.views import (
+    read_only,
+    require_ssl,
+    http_json_error,
+)
+from autonomie_oidc_provider.views.token import validate_client
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_lookup_key(token_str):
+    """
+    Return the value stored in OidcToken.access_token for the given bearer
+    token (the jti of jwt access tokens)
+
+    :returns: The lookup key (canonical form) or None if the token is invalid
+    """
+    if ACCESS_TOKENS.looks_like_jwt(token_str):
+        try:
+            token_str = ACCESS_TOKENS.decode(token_str)['jti']
+        except InvalidToken:
+            return None
+    return normalize_token(token_str)
+
+
+def introspect_tokens(token_strs):
+    """
+    Build the introspection responses of the given tokens
+
+    :param list token_strs: The bearer tokens to introspect
+    :returns: The list of introspection responses (same order)
+    :rtype: list
+    """
+    keys = [get_lookup_key(token_str) for token_str in token_strs]
+    tokens = get_token_store().find_many([key for key in keys if key])
+
+    result = []
+    for key in keys:
+        token = tokens.get(key)
+        client = None
+        if token is not None and not token.revoked \
+                and not token.is_expired():
+            client = CLIENT_REGISTRY.get_by_id(token.client_id)
+
+        if client is None:
+            result.append({'active': False})
+        else:
+            result.append({
+                'active': True,
+                'scope': u' '.join(token.get_scopes(client)),
+                'client_id': client.client_id,
+                'sub': token.user_id,
+                'token_type': 'Bearer',
+                'exp': dt_to_timestamp(token.get_expiry()),
+                'iat': dt_to_timestamp(token.creation_date),
+            })
+    return result
+
+
+def authenticate_client(request):
+    """
+    Authenticate the calling client (its secret hash isn't upgraded)
+
+    :returns: A registry.ClientEntry instance
+    :raises: one of the exceptions.BaseOauth2Error subclasses
+    """
+    client_id, client_secret = get_client_credentials(request)
+    return validate_client(client_id, client_secret, upgrade=False)
+
+
+@require_ssl
+@read_only
+def introspect_view(request):
+    """
+    Introspection endpoint
+
+    Calls MUST contain :
+
+        token
+
+            The access token to introspect
+
+    Returns :
+
+    {
+        "active": true,
+        "scope": "openid profile",
+        "client_id": "<the client the token was issued to>",
+        "sub": 12,
+        "token_type": "Bearer",
+        "exp": 1419356238,
+        "iat": 1419350238
+    }
+
+    or {"active": false}
+    """
+    try:
+        authenticate_client(request)
+    except (
+        InvalidRequest,
+        InvalidCredentials,
+        InvalidClient,
+        UnauthorizedClient,
+        TemporarilyUnavailable,
+    ) as exc:
+        logger.exception("Invalid client authentication")
+        return http_json_error(request, exc)
+
+    token_str = request.POST.get('token')
+    if not token_str:
+        exc = InvalidRequest(error_description=u"Missing token parameter")
+        return http_json_error(request, exc)
+
+    request.response.cache_control.no_store = True
+    return introspect_tokens([token_str])[0]
+
+
+@require_ssl
+@read_only
+def introspect_batch_view(request):
+    """
+    Batch introspection endpoint
+
+    Calls MUST contain one or more token parameters (at most
+    oidc.introspect.batch_size, default 100)
+
+    Returns :
+
+    {"tokens": [<introspection response>, ...]} in the same order as the
+    token parameters
+    """
+    try:
+        authenticate_client(request)
+    except (
+        InvalidRequest,
+        InvalidCredentials,
+        InvalidClient,
+        UnauthorizedClient,
+        TemporarilyUnavailable,
+    ) as exc:
+        logger.exception("Invalid client authentication")
+        return http_json_error(request, exc)
+
+    token_strs = request.POST.getall('token')
+    batch_size = int(
+        oidc_settings(request.registry.settings, 'introspect.batch_size', 100)
+    )
+    if not token_strs:
+        exc = InvalidRequest(error_description=u"Missing token parameter")
+        return http_json_error(request, exc)
+    elif len(token_strs) > batch_size:
+        exc = InvalidRequest(
+            error_description=u"Too many tokens (max %s)" % batch_size
+        )
+        return http_json_error(request, exc)
+
+    request.response.cache_control.no_store = True
+    return {'tokens': introspect_tokens(token_strs)}
+
+
+def includeme(config):
+    """
+    Add the introspection views
+    """
+    config.add_view(
+        introspect_view,
+        route_name='/introspect',
+        renderer='json',
+        permission=NO_PERMISSION_REQUIRED,
+        request_method='POST',
+    )
+    config.add_view(
+        introspect_batch_view,
+        route_name='/introspect/batch',
+        renderer='json',
+        permission=NO_PERMISSION_REQUIRED,
+        request_method='POST',
+    )
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Public key set endpoint :
+    https://tools.ietf.org/html/rfc7517#section-5
+"""
+import logging
+
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.security import NO_PERMISSION_REQUIRED
+
+from autonomie_oidc_provider.keys import (
+    SIGNING_KEYS,
+    get_jwks_max_age,
+)
+from autonomie_oidc_provider.views import read_only
+
+
+logger = logging.getLogger(__name__)
+
+
+@read_only
+def jwks_view(request):
+    """
+    Return the provider's public keys
+
+    The response can be cached by the relying parties (oidc.jwks.max_age
+    seconds, default 3600) and revalidated through its ETag
+    """
+    body, etag = SIGNING_KEYS.get_jwks()
+    max_age = get_jwks_max_age(request.registry.settings)
+
+    if etag in request.if_none_match:
+        response = HTTPNotModified()
+    else:
+        response = request.response
+        response.content_type = 'application/json'
+        response.body = body
+
+    response.etag = etag
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
+
+
+def includeme(config):
+    """
+    Add the jwks view
+    """
+    config.add_view(
+        jwks_view,
+        route_name='/jwks',
+        permission=NO_PERMISSION_REQUIRED,
+        request_method='GET',
+    )
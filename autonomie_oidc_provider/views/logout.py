@@ -5,14 +5,31 @@
 #       * Miotte Julien <j.m@majerti.fr>;
 """
 Logout view
+
+When an id_token_hint is given, the tokens issued to the logged in user for
+the hint's client(s) are revoked (one UPDATE by client).
+
+When the back-channel logout is enabled, the clients the user has tokens with
+are notified (see backchannel.py).
 """
 import logging
+import binascii
 
+from jwkest import JWKESTException
+from jwkest.jws import JWS
+from jwkest.jwt import JWT
 from pyramid.security import (
     NO_PERMISSION_REQUIRED,
+    authenticated_userid,
     forget,
 )
 from pyramid.httpexceptions import HTTPFound
+
+from autonomie.models.user.login import Login
+from autonomie_oidc_provider.backchannel import BACKCHANNEL_LOGOUT
+from autonomie_oidc_provider.keys import SIGNING_KEYS
+from autonomie_oidc_provider.registry import get_client
+from autonomie_oidc_provider.token_store import get_token_store
 from autonomie_oidc_provider.util import (
     add_get_params,
 )
@@ -21,6 +38,84 @@ from autonomie_oidc_provider.util import (
 logger = logging.getLogger(__name__)
 
 
+def get_id_token_hint_claims(id_token_hint):
+    """
+    Return the claims of the given id token (expired ones are accepted)
+
+    With RS256/ES256 the signature is checked against the published keys.
+    HS256 id tokens are signed with the client secret (only its hash is
+    stored) : their signature can't be checked, the claims only designate the
+    client(s), the user is always the logged in one.
+
+    :param str id_token_hint: The id token transmitted by the client
+    :returns: The claims or None if the id token is invalid
+    :rtype: dict
+    """
+    try:
+        if SIGNING_KEYS.is_symmetric():
+            claims = JWT().unpack(id_token_hint).payload()
+        else:
+            claims = JWS().verify_compact(
+                id_token_hint,
+                keys=[key.key for key in SIGNING_KEYS.published_keys()],
+            )
+    except (
+        JWKESTException, binascii.Error, ValueError, TypeError, KeyError
+    ):
+        logger.exception(u"Invalid id_token_hint")
+        return None
+    if not isinstance(claims, dict):
+        return None
+    return claims
+
+
+def get_logged_in_user_id(request):
+    """
+    Return the id of the logged in user (None if anonymous)
+    """
+    user_login = authenticated_userid(request)
+    if user_login is None:
+        return None
+    login = Login.query().filter_by(login=user_login).first()
+    if login is None:
+        return None
+    return login.user_id
+
+
+def revoke_logout_tokens(request, user_id, claims):
+    """
+    Revoke the tokens issued to the logged in user for the client(s) of the
+    given id token claims
+
+    :param obj request: The pyramid request object
+    :param int user_id: The logged in user's id
+    :param dict claims: The claims of the id_token_hint
+    :returns: The number of revoked tokens
+    :rtype: int
+    """
+    issuer = request.registry.settings.get('oidc.issuer_url')
+    if issuer and claims.get('iss') != issuer:
+        logger.warn(
+            u"id_token_hint from another issuer : %s", claims.get('iss')
+        )
+        return 0
+    if unicode(claims.get('sub')) != unicode(user_id):
+        logger.warn(u"id_token_hint issued to another user")
+        return 0
+
+    audience = claims.get('aud')
+    if not isinstance(audience, list):
+        audience = [audience]
+    revoked = 0
+    store = get_token_store()
+    for client_id in audience:
+        client = get_client(client_id, valid=False)
+        if client is not None:
+            revoked += store.revoke_user_tokens(user_id, client.id)
+    logger.info(u"%s tokens revoked on logout", revoked)
+    return revoked
+
+
 def logout_view(request):
     """
     Handle a basic logout of the current connected user
@@ -31,8 +126,8 @@ def logout_view(request):
 
         id_token_hint
 
-            An id token corresponding to the user's auth, the audience of the
-            token should include the current server
+            An id token corresponding to the user's auth, the user's tokens
+            for the token's audience are revoked
 
         post_logout_redirect_uri
 
@@ -43,7 +138,22 @@ def logout_view(request):
             The state to be persisted if a redirect is also asked
     """
     # TODO : add a confirmation form for logout
-    # TODO : add support for id_token_hint parameter
+    user_id = get_logged_in_user_id(request)
+    if user_id is not None:
+        client_ids = ()
+        if BACKCHANNEL_LOGOUT.enabled:
+            # Looked up before the hint's tokens are revoked
+            client_ids = get_token_store().find_user_client_ids(user_id)
+
+        id_token_hint = request.params.get('id_token_hint')
+        if id_token_hint:
+            claims = get_id_token_hint_claims(id_token_hint)
+            if claims is not None:
+                revoke_logout_tokens(request, user_id, claims)
+
+        # The deliveries run in the background
+        BACKCHANNEL_LOGOUT.notify(user_id, client_ids)
+
     redirect_uri = request.params.get('post_logout_redirect_uri', None)
     if redirect_uri is not None:
         state = request.params.get('state', None)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Token revocation endpoint as described in :
+    https://tools.ietf.org/html/rfc7009
+
+Clients authenticate (same credentials as on the token endpoint) and revoke
+one or more of their access or refresh tokens, all the given tokens are
+revoked by a single UPDATE. Access and refresh tokens share the same row :
+revoking one revokes the other.
+"""
+import logging
+
+from pyramid.security import NO_PERMISSION_REQUIRED
+
+from autonomie_oidc_provider.exceptions import (
+    InvalidClient,
+    InvalidCredentials,
+    InvalidRequest,
+    TemporarilyUnavailable,
+    UnauthorizedClient,
+)
+from autonomie_oidc_provider.token_store import get_token_store
+from autonomie_oidc_provider.util import (
+    get_client_credentials,
+    oidc_settings,
+)
+from autonomie_oidc_provider.views import (
+    require_ssl,
+    http_json_error,
+)
+from autonomie_oidc_provider.views.introspect import get_lookup_key
+from autonomie_oidc_provider.views.token import validate_client
+
+
+logger = logging.getLogger(__name__)
+
+
+def revoke_tokens(client, token_strs):
+    """
+    Revoke the given tokens if they were issued to the given client
+
+    :param obj client: The authenticated registry.ClientEntry
+    :param list token_strs: Access tokens (opaque or jwt) and/or refresh
+    tokens
+    :returns: The number of revoked tokens
+    :rtype: int
+    """
+    keys = [get_lookup_key(token_str) for token_str in token_strs]
+    return get_token_store().revoke_tokens(
+        client.id, [key for key in keys if key]
+    )
+
+
+@require_ssl
+def revoke_view(request):
+    """
+    Revocation endpoint
+
+    Calls MUST contain one or more token parameters (at most
+    oidc.revocation.max_tokens, default 100)
+
+    Calls MAY contain :
+
+        token_type_hint
+
+            access_token or refresh_token, both kinds are looked up by the
+            same statement so the hint isn't needed
+
+    Returns an empty 200 response, whether the tokens were valid or not (see
+    RFC 7009 section 2.2)
+    """
+    try:
+        client_id, client_secret = get_client_credentials(request)
+        client = validate_client(client_id, client_secret)
+    except (
+        InvalidRequest,
+        InvalidCredentials,
+        InvalidClient,
+        UnauthorizedClient,
+        TemporarilyUnavailable,
+    ) as exc:
+        logger.exception("Invalid client authentication")
+        return http_json_error(request, exc)
+
+    token_strs = request.POST.getall('token')
+    max_tokens = int(
+        oidc_settings(request.registry.settings, 'revocation.max_tokens', 100)
+    )
+    if not token_strs:
+        exc = InvalidRequest(error_description=u"Missing token parameter")
+        return http_json_error(request, exc)
+    elif len(token_strs) > max_tokens:
+        exc = InvalidRequest(
+            error_description=u"Too many tokens (max %s)" % max_tokens
+        )
+        return http_json_error(request, exc)
+
+    count = revoke_tokens(client, token_strs)
+    logger.info(
+        u"%s of %s tokens revoked by client %s",
+        count, len(token_strs), client.client_id,
+    )
+    request.response.cache_control.no_store = True
+    return request.response
+
+
+def includeme(config):
+    """
+    Add the revocation view
+    """
+    config.add_view(
+        revoke_view,
+        route_name='/revoke',
+        permission=NO_PERMISSION_REQUIRED,
+        request_method='POST',
+    )
@@ -6,36 +6,45 @@
 import logging
 
 from pyramid.security import NO_PERMISSION_REQUIRED
-from six.moves.urllib.parse import (
-    unquote,
-)
 
 from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.codes import CODE_FORMAT
 from autonomie_oidc_provider.exceptions import (
     InvalidCredentials,
     InvalidRequest,
     InvalidClient,
     UnauthorizedClient,
+    TemporarilyUnavailable,
 )
+from autonomie_oidc_provider.access_tokens import ACCESS_TOKENS
+from autonomie_oidc_provider.pool import PoolFull
+from autonomie_oidc_provider.token_store import get_token_store
 from autonomie_oidc_provider.scope_consumer import (
     collect_claims,
 )
 
-from autonomie_oidc_provider.util import get_client_credentials
+from autonomie_oidc_provider.util import (
+    get_client_credentials,
+    get_refresh_token_lifetime,
+    normalize_redirect_uri,
+)
 from autonomie_oidc_provider.views import (
     require_ssl,
     http_json_error,
 )
 from autonomie_oidc_provider.models import (
-    get_client_by_client_id,
-    get_code_by_client_id,
+    get_code_for_exchange,
     OidcToken,
     OidcIdToken,
 )
+from autonomie_oidc_provider.registry import get_client
+from autonomie_oidc_provider.write_behind import persist_id_token
 
 
 logger = logging.getLogger(__name__)
 
+GRANT_TYPES = ('authorization_code', 'refresh_token')
+
 
 def get_claims(code, scopes):
     """
@@ -53,7 +62,9 @@ def get_claims(code, scopes):
     return claims
 
 
-def handle_authcode_token(request, client, code, claims, client_secret):
+def handle_authcode_token(
+    request, client, code, claims, client_secret, scopes=None
+):
     """
     Handle the token response for authentication code request types
 
@@ -67,16 +78,19 @@ def handle_authcode_token(request, client, code, claims, client_secret):
         "id_token": <JWT representation of the id token>
     }
 
-    :param obj client: A OidcClient
+    :param obj client: A registry.ClientEntry
     :param obj code: A OidcCode
     :param dict claims: Claims queried by the given client
     :param str client_secret: The secret key used to authenticate (used for
     encryption)
+    :param list scopes: The scopes granted to the access token (default :
+    the code's scopes)
     :returns: A dict to be used as json response
     :rtype: dict
     """
-    token = OidcToken(client, code.user_id)
-    DBSESSION().add(token)
+    if scopes is None:
+        scopes = code.scopes.split(' ')
+    token = OidcToken(client, code.user_id, u' '.join(scopes))
 
     issuer = request.registry.settings.get('oidc.issuer_url')
     logger.debug("The current issuer url : %s" % issuer)
@@ -86,12 +100,17 @@ def handle_authcode_token(request, client, code, claims, client_secret):
         client,
         code
     )
-    DBSESSION().add(id_token)
-    DBSESSION().flush()
-
-    claims['at_hash'] = token.at_hash()
+    # Both rows are written in a single flush (if the id token is persisted
+    # synchronously)
+    db = DBSESSION()
+    get_token_store().add(token)
+    persist_id_token(db, id_token)
+    db.flush()
 
     result = token.__json__(request)
+    result['access_token'] = ACCESS_TOKENS.serialize(token, client, scopes)
+    claims['at_hash'] = token.at_hash(result['access_token'])
+
     logger.debug("Signing with %s" % client_secret)
     result['id_token'] = id_token.__jwt__(request, claims, client_secret)
 
@@ -102,22 +121,89 @@ def handle_authcode_token(request, client, code, claims, client_secret):
     return result
 
 
-def validate_client(client_id, client_secret):
+def revoke_token_family(token):
+    """
+    Revoke all the tokens issued to the token's user for the token's client
+
+    Called when an already rotated refresh token is presented again : either
+    the client or an attacker holds a stolen token, none of them can be
+    trusted anymore
+
+    :param obj token: The replayed OidcToken
+    """
+    count = get_token_store().revoke_user_tokens(
+        token.user_id, token.client_id
+    )
+    logger.warn(
+        "Refresh token replay detected for user %s and client %s, "
+        "%s token(s) revoked",
+        token.user_id,
+        token.client_id,
+        count,
+    )
+
+
+def handle_refresh_token(request, client, token):
+    """
+    Handle the token response for refresh token requests : the given token
+    is revoked and a new one is issued (refresh token rotation)
+
+    Returns :
+
+    {
+        "access_token":"2YotnFZFEjr1zCsicMWpAA",
+        "token_type":"Bearer",
+        "expires_in":3600,
+        "refresh_token":"tGzv3JOkF0XG5Qx2TlKWIA",
+    }
+
+    :param obj client: A registry.ClientEntry
+    :param obj token: The OidcToken whose refresh token was provided
+    :returns: A dict to be used as json response
+    :rtype: dict
+    :raises: InvalidCredentials
+    """
+    new_token = get_token_store().refresh(token, client)
+    if new_token is None:
+        # The token was rotated by another request since we loaded it
+        revoke_token_family(token)
+        raise InvalidCredentials(error_description="Invalid refresh token")
+
+    DBSESSION().flush()
+    result = new_token.__json__(request)
+    result['access_token'] = ACCESS_TOKENS.serialize(
+        new_token, client, new_token.get_scopes(client)
+    )
+    return result
+
+
+def validate_client(client_id, client_secret, upgrade=True):
     """
     Retrieve the client given a client id and validate it
 
     :param str client_id: The client id
     :param str client_secret: The client secret object
+    :param bool upgrade: Should an outdated secret hash be replaced ?
 
-    :returns: A OidcClient instance
+    :returns: A registry.ClientEntry instance
     :raises: InvalidClient
     :raises: UnauthorizedClient
+    :raises: TemporarilyUnavailable
     """
-    client = get_client_by_client_id(client_id)
+    client = get_client(client_id)
     if client is None:
         logger.error("Invalid oidc client : %s", client_id)
         raise InvalidClient(error_description=u"Unknown client")
-    elif not client.check_secret(client_secret):
+
+    try:
+        valid_secret = client.check_secret(client_secret, upgrade)
+    except PoolFull:
+        logger.error("Too many pending client secret verifications")
+        raise TemporarilyUnavailable(
+            error_description=u"Server overloaded, retry later"
+        )
+
+    if not valid_secret:
         logger.warn("Invalid oidc client_secret : %s", client_secret)
         raise UnauthorizedClient(error_description=u"Unknown client")
 
@@ -129,28 +215,91 @@ def validate_grant_type(grant_type):
     Validate it's a supported grant type
 
     :param str grant_type: The asked grant_type
-    :raises: InvalidCredentials
+    :raises: InvalidRequest
     """
-    if grant_type != 'authorization_code':
+    if grant_type not in GRANT_TYPES:
         logger.warn("Invalid grant type : %s", grant_type)
         raise InvalidRequest(error_description="unsupported_grant_type")
+    return grant_type
 
 
-def validate_code(code, client):
+def validate_refresh_token(refresh_token, client, lifetime):
+    """
+    Retrieve the OidcToken matching the given refresh token
+
+    A refresh token that was already rotated revokes the whole token family
+
+    :param str refresh_token: The refresh token
+    :param obj client: The registry.ClientEntry instance
+    :param int lifetime: The refresh token lifetime in seconds
+    :returns: the OidcToken instance
+    :raises: InvalidCredentials
+    """
+    token = None
+    if refresh_token is not None:
+        token = get_token_store().find_by_refresh_token(refresh_token)
+
+    if token is None or token.client_id != client.id:
+        logger.warn("Wrong refresh token provided")
+        raise InvalidCredentials(error_description="Invalid refresh token")
+    elif token.rotated:
+        revoke_token_family(token)
+        raise InvalidCredentials(error_description="Invalid refresh token")
+    elif token.revoked:
+        logger.warn("Revoked refresh token provided")
+        raise InvalidCredentials(error_description="Revoked refresh token")
+    elif token.is_refresh_expired(lifetime):
+        logger.warn("Expired refresh token provided")
+        raise InvalidCredentials(error_description="Expired refresh token")
+    return token
+
+
+def validate_code(code, client, redirect_uri=None):
     """
     Retrieve an OidcCode instance
 
+    The code, its client, its redirect uri and its revocation state are
+    checked in a single query, the expiry is then checked on the loaded row.
+    Encrypted codes (see codes.py) are decrypted, no query is made.
+
     :param str code: The auth code
-    :param obj client: The OidcClient instance
-    :returns: the OidcCode instance
+    :param obj client: The registry.ClientEntry instance
+    :param str redirect_uri: The redirect_uri found in the request params
+    :returns: the OidcCode (or codes.StatelessCode) instance
     :raises: InvalidCredentials
     """
     if code is not None:
-        code = get_code_by_client_id(client.id, code)
+        if redirect_uri is not None:
+            redirect_uri = normalize_redirect_uri(redirect_uri)
+        if CODE_FORMAT.looks_like_jwe(code):
+            code = CODE_FORMAT.decode(code)
+            if code.audience != client.client_id or (
+                redirect_uri is not None and code.uri != redirect_uri
+            ):
+                code = None
+        else:
+            code = get_code_for_exchange(client.client_id, code, redirect_uri)
 
     if code is None:
         logger.warn("Wrong auth code provided")
         raise InvalidCredentials(error_description="Invalid auth code")
+    elif code.is_expired():
+        logger.warn("Expired auth code provided")
+        raise InvalidCredentials(error_description="Expired auth code")
+    return code
+
+
+def consume_code(code):
+    """
+    Mark the code as used, a code can only be exchanged once
+
+    :param obj code: OidcCode instance
+    :raises: InvalidCredentials if the code has already been used (or has
+    just expired)
+    """
+    if not code.consume():
+        logger.warn("Auth code already used")
+        raise InvalidCredentials(error_description="Invalid auth code")
     return code
 
 
@@ -162,7 +311,8 @@ def validate_redirect_uri(redirect_uri, code):
     :param obj code: OidcCode instance
     :raises: InvalidCredentials
     """
-    redirect_uri = unquote(redirect_uri)
+    if redirect_uri is not None:
+        redirect_uri = normalize_redirect_uri(redirect_uri)
     if redirect_uri is None or code.uri != redirect_uri:
         logger.error(
             "Provided redirect uri {0} doesn't match the "
@@ -211,6 +361,12 @@ def token_view(request):
 
             The confidential client secret key
 
+        grant_type
+
+            authorization_code or refresh_token
+
+    Authorization code requests MUST contain :
+
         redirect_uri
 
             The redirect_uri used on the step 1 of the Authorization code auth
@@ -220,6 +376,13 @@ def token_view(request):
 
             The code issued by the auth endpoint on step 1
 
+    Refresh token requests MUST contain :
+
+        refresh_token
+
+            The refresh token issued with the current access token
+            https://tools.ietf.org/html/rfc6749#section-6
+
     Calls to the token endpoint CAN contain :
 
         state
@@ -250,7 +413,7 @@ def token_view(request):
     # Issue token ...
     try:
         client = validate_client(client_id, client_secret)
-    except InvalidClient as exc:
+    except (InvalidClient, TemporarilyUnavailable) as exc:
         return http_json_error(request, exc)
 
     grant_type = request.POST.get('grant_type')
@@ -261,15 +424,26 @@ def token_view(request):
 
     logger.debug("POST Params : %s" % request.POST)
 
+    if grant_type == 'refresh_token':
+        lifetime = get_refresh_token_lifetime(request.registry.settings)
+        try:
+            token = validate_refresh_token(
+                request.POST.get('refresh_token'),
+                client,
+                lifetime,
+            )
+            return handle_refresh_token(request, client, token)
+        except InvalidCredentials as exc:
+            return http_json_error(request, exc)
+
     auth_code = request.POST.get('code')
+    redirect_uri = request.POST.get('redirect_uri')
 
     try:
-        code = validate_code(auth_code, client)
+        code = validate_code(auth_code, client, redirect_uri)
     except InvalidCredentials as exc:
         return http_json_error(request, exc)
 
-    redirect_uri = request.POST.get('redirect_uri')
-
     try:
         redirect_uri = validate_redirect_uri(redirect_uri, code)
     except InvalidCredentials as exc:
@@ -282,8 +456,17 @@ def token_view(request):
     except InvalidRequest as exc:
         return http_json_error(request, exc)
 
+    # Before building the claims and signing : concurrent or retried
+    # exchanges of the same code stop here
+    try:
+        consume_code(code)
+    except InvalidCredentials as exc:
+        return http_json_error(request, exc)
+
     claims = get_claims(code, scopes)
-    resp = handle_authcode_token(request, client, code, claims, client_secret)
+    resp = handle_authcode_token(
+        request, client, code, claims, client_secret, scopes
+    )
     return resp
 
 
@@ -15,12 +15,20 @@ from autonomie_oidc_provider.exceptions import (
     InvalidRequest,
     InvalidToken,
 )
+from autonomie_oidc_provider.access_tokens import (
+    ACCESS_TOKENS,
+    REVOCATION_SET,
+)
 from autonomie_oidc_provider.util import get_access_token
-from autonomie_oidc_provider.models import OidcToken
+from autonomie_oidc_provider.registry import CLIENT_REGISTRY
+from autonomie_oidc_provider.token_store import get_token_store
 from autonomie_oidc_provider.scope_consumer import (
     collect_claims,
 )
-from autonomie_oidc_provider.views import http_json_error
+from autonomie_oidc_provider.views import (
+    http_json_error,
+    read_only,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -30,7 +38,7 @@ def validate_token(token_str):
     """
     Validate a bearer token trying to retrieve the associated OidcToken
     """
-    token = OidcToken.find(token_str)
+    token = get_token_store().find(token_str)
     if token is None:
         raise InvalidToken(error_description=u"Unknown token")
 
@@ -39,9 +47,28 @@ def validate_token(token_str):
     return token
 
 
+def validate_jwt_token(token_str):
+    """
+    Validate a jwt bearer token through its signature, its expiry and the
+    revocation set (no database lookup)
+
+    :returns: The token's claims
+    :rtype: dict
+    """
+    claims = ACCESS_TOKENS.decode(token_str)
+    if REVOCATION_SET.is_revoked(claims['jti']):
+        raise InvalidToken(error_description=u"Revoked token")
+    return claims
+
+
+@read_only
 def userinfo_view(request):
     """
     The userinfo view
+
+    Jwt access tokens are validated without database lookup, opaque ones are
+    looked up in the token table. The view never writes : its transaction is
+    doomed
     """
     logger.debug("Calling the userinfo_view")
     logger.debug("  + POST params")
@@ -55,14 +82,27 @@ def userinfo_view(request):
         return http_json_error(request, exc)
 
     try:
-        oidc_token = validate_token(token)
+        if ACCESS_TOKENS.looks_like_jwt(token):
+            claims = validate_jwt_token(token)
+            user_id = claims['sub']
+            client = CLIENT_REGISTRY.get(claims['client_id'], valid=False)
+            scopes = claims['scope'].split(' ')
+        else:
+            oidc_token = validate_token(token)
+            user_id = oidc_token.user_id
+            client = CLIENT_REGISTRY.get_by_id(
+                oidc_token.client_id, valid=False
+            )
+            scopes = [] if client is None else oidc_token.get_scopes(client)
     except InvalidToken as exc:
         logger.exception(u"Invalid token")
         return http_json_error(request, exc)
 
     # Here the user is authenticated
-    scopes = oidc_token.client.get_scopes()
-    return collect_claims(oidc_token.user_id, scopes)
+    if client is None:
+        exc = InvalidToken(error_description=u"Unknown client")
+        return http_json_error(request, exc)
+    return collect_claims(user_id, scopes)
 
 
 def includeme(config):
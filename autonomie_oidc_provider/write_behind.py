@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Id token persistence
+
+The OidcIdToken rows are only kept for audit purpose, nothing reads them back.
+The oidc.id_token.persistence setting tells how they're written :
+
+    sync (default)
+
+        In the token request transaction
+
+    none
+
+        Never
+
+    write_behind
+
+        Buffered in memory and written in bulk inserts by a background thread
+        (every oidc.id_token.write_behind.interval seconds or as soon as
+        batch_size records are pending). Records are dropped if the buffer is
+        full and lost if the process is killed before they're written.
+"""
+import atexit
+import logging
+import threading
+
+from collections import deque
+
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from autonomie_base.models.base import DBSESSION
+from autonomie_oidc_provider.models import OidcIdToken
+from autonomie_oidc_provider.util import oidc_settings
+
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_MODES = ('sync', 'none', 'write_behind')
+
+
+def instance_to_row(table, instance):
+    """
+    Build the values inserted in table for the given (transient) model
+    instance
+
+    :rtype: dict
+    """
+    row = {}
+    for column in table.columns:
+        if column.primary_key:
+            continue
+        value = getattr(instance, column.key)
+        # Column defaults are only applied on flush
+        if value is None and column.default is not None \
+                and column.default.is_scalar:
+            value = column.default.arg
+        row[column.key] = value
+    return row
+
+
+class WriteBehindBuffer(object):
+    """
+    Bounded in-memory buffer of rows inserted in bulk by a background thread
+    """
+    def __init__(self, table, interval=5, batch_size=500, max_size=10000):
+        self.table = table
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self._rows = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stats = {'enqueued': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+
+    def configure(self, interval=None, batch_size=None, max_size=None):
+        if interval is not None:
+            self.interval = float(interval)
+        if batch_size is not None:
+            self.batch_size = int(batch_size)
+        if max_size is not None:
+            self.max_size = int(max_size)
+
+    def add(self, instance):
+        """
+        Buffer the given model instance
+
+        :returns: False if the buffer is full and the row was dropped
+        :rtype: bool
+        """
+        row = instance_to_row(self.table, instance)
+        with self._lock:
+            if len(self._rows) >= self.max_size:
+                self._stats['dropped'] += 1
+                logger.warn(u"The %s buffer is full", self.table.name)
+                return False
+            self._rows.append(row)
+            self._stats['enqueued'] += 1
+            pending = len(self._rows)
+        self._start()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _take(self):
+        with self._lock:
+            count = min(len(self._rows), self.batch_size)
+            return [self._rows.popleft() for index in range(count)]
+
+    def flush(self):
+        """
+        Write all the pending rows (in batches of batch_size rows)
+
+        :returns: The number of written rows
+        :rtype: int
+        """
+        written = 0
+        rows = self._take()
+        while rows:
+            try:
+                with transaction.manager:
+                    session = DBSESSION()
+                    session.execute(self.table.insert(), rows)
+                    mark_changed(session)
+            except Exception:
+                logger.exception(
+                    u"Unable to write %s rows in %s", len(rows),
+                    self.table.name
+                )
+                with self._lock:
+                    self._stats['failed'] += len(rows)
+            else:
+                written += len(rows)
+                with self._lock:
+                    self._stats['written'] += len(rows)
+            rows = self._take()
+        return written
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                DBSESSION.remove()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._loop,
+                    name='%s-writer' % self.table.name,
+                )
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['pending'] = len(self._rows)
+        return result
+
+
+ID_TOKEN_BUFFER = WriteBehindBuffer(OidcIdToken.__table__)
+
+
+class IdTokenPersistence(object):
+    """
+    Persistence of the issued id tokens (sync, none or write_behind)
+    """
+    def __init__(self, mode='sync', buffer_=ID_TOKEN_BUFFER):
+        self.mode = mode
+        self.buffer = buffer_
+
+    def configure(self, mode=None):
+        if mode is not None:
+            if mode not in PERSISTENCE_MODES:
+                raise KeyError(
+                    u"Unknown id token persistence mode %s" % mode
+                )
+            self.mode = mode
+
+    def persist(self, session, id_token):
+        """
+        Persist the given OidcIdToken regarding the configured mode
+
+        :param obj session: The current request's session
+        :param obj id_token: The OidcIdToken instance
+        """
+        if self.mode == 'sync':
+            session.add(id_token)
+        elif self.mode == 'write_behind':
+            self.buffer.add(id_token)
+
+
+PERSISTENCE = IdTokenPersistence()
+
+
+def persist_id_token(session, id_token):
+    PERSISTENCE.persist(session, id_token)
+
+
+def _flush_at_exit():
+    if ID_TOKEN_BUFFER.stats()['pending']:
+        ID_TOKEN_BUFFER.flush()
+
+
+atexit.register(_flush_at_exit)
+
+
+def includeme(config):
+    """
+    Configure the id token persistence regarding the current settings
+
+        oidc.id_token.persistence
+
+            sync (default), none or write_behind
+
+        oidc.id_token.write_behind.interval
+
+            Max number of seconds a record waits in the buffer (default 5)
+
+        oidc.id_token.write_behind.batch_size
+
+            Max number of rows per insert (default 500)
+
+        oidc.id_token.write_behind.max_size
+
+            Max number of buffered records (default 10000)
+    """
+    settings = config.get_settings()
+    PERSISTENCE.configure(
+        mode=oidc_settings(settings, 'id_token.persistence', 'sync')
+    )
+    ID_TOKEN_BUFFER.configure(
+        interval=oidc_settings(settings, 'id_token.write_behind.interval'),
+        batch_size=oidc_settings(
+            settings, 'id_token.write_behind.batch_size'
+        ),
+        max_size=oidc_settings(settings, 'id_token.write_behind.max_size'),
+    )
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Claims extraction micro-benchmark : compiled extraction plans vs the
+attribute walking implementation
+
+Usage :
+
+    python benchmarks/bench_claims.py [number of iterations]
+"""
+import sys
+import datetime
+import timeit
+
+from autonomie_oidc_provider.scope_consumer import (
+    compile_plans,
+    ProfileScope,
+    OpenIdScope,
+)
+from autonomie_oidc_provider.tests.test_scope_consumer import (
+    produce_uncompiled,
+)
+
+
+class Dummy(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class Group(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __json__(self, request):
+        return self.name
+
+
+def build_user():
+    return Dummy(
+        id=12L,
+        label=u"Firstname Lastname",
+        firstname=u"Firstname",
+        lastname=u"Lastname",
+        email=u"firstname@example.com",
+        login=Dummy(login=u"flastname"),
+        _groups=[Group(u'admin'), Group(u'contractor'), Group(u'manager')],
+        created_at=datetime.datetime.now(),
+    )
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    compile_plans()
+    user = build_user()
+
+    def uncompiled():
+        for scope in (OpenIdScope, ProfileScope):
+            produce_uncompiled(scope, user)
+
+    def compiled():
+        for scope in (OpenIdScope, ProfileScope):
+            scope.get_plan().extract(user)
+
+    assert [scope().produce(user) for scope in (OpenIdScope, ProfileScope)] \
+        == [produce_uncompiled(scope, user)
+            for scope in (OpenIdScope, ProfileScope)]
+
+    results = {}
+    for name, func in (('uncompiled', uncompiled), ('compiled', compiled)):
+        duration = min(timeit.repeat(func, number=number, repeat=3))
+        results[name] = duration
+        print(
+            "%-12s %8.3fs  %6.2f us/call" % (
+                name, duration, duration * 1e6 / number
+            )
+        )
+    print("speedup : x%.2f" % (results['uncompiled'] / results['compiled']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# * Authors:
+#       * TJEBBES Gaston <g.t@majerti.fr>
+#       * Arezki Feth <f.a@majerti.fr>;
+#       * Miotte Julien <j.m@majerti.fr>;
+"""
+Token store benchmark : issue and lookup throughput of the sql and the sqlite
+backends (one transaction per token, as on the token and userinfo endpoints)
+
+Usage :
+
+    python benchmarks/bench_token_store.py [number of tokens] [sqlalchemy url]
+
+The sql backend uses a temporary SQLite database unless an url is given (use
+the Autonomie database's url to measure the real contention)
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+
+class Dummy(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+def setup_sql(url):
+    from sqlalchemy import create_engine
+    from autonomie_base.models.base import DBSESSION
+    from autonomie_oidc_provider.models import (
+        OidcClient,
+        OidcToken,
+    )
+    engine = create_engine(url)
+    OidcClient.metadata.create_all(
+        engine, tables=[OidcClient.__table__, OidcToken.__table__]
+    )
+    DBSESSION.configure(bind=engine)
+
+
+def run(name, store, client, number):
+    import transaction
+    from autonomie_base.models.base import DBSESSION
+    from autonomie_oidc_provider.models import OidcToken
+
+    access_tokens = []
+    start = time.time()
+    for index in range(number):
+        token = OidcToken(client, index)
+        store.add(token)
+        transaction.commit()
+        access_tokens.append(token.access_token)
+    issue = time.time() - start
+
+    start = time.time()
+    for access_token in access_tokens:
+        assert store.find(access_token) is not None
+        transaction.abort()
+    lookup = time.time() - start
+    DBSESSION.remove()
+
+    print(
+        "%-8s issue %8.0f tokens/s   lookup %8.0f tokens/s" % (
+            name, number / issue, number / lookup
+        )
+    )
+
+
+def main():
+    from autonomie_oidc_provider.token_store import (
+        SqlTokenStore,
+        SqliteTokenStore,
+    )
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        url = sys.argv[2] if len(sys.argv) > 2 else \
+            'sqlite:///%s' % os.path.join(tmpdir, 'sql.sqlite')
+        setup_sql(url)
+        client = Dummy(id=1, client_id=u'bench_client')
+
+        run('sql', SqlTokenStore(), client, number)
+        store = SqliteTokenStore(os.path.join(tmpdir, 'store.sqlite'))
+        run('sqlite', store, client, number)
+        store.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()